@@ -3,62 +3,375 @@ import logging
 logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
 from libwifi import *
 from wpaspy import Ctrl
-import os, stat, socket, select, atexit
+import os, stat, socket, select, atexit, argparse, multiprocessing, zlib, collections, math, sqlite3, signal
+import libwifi
 
+# Interval between retransmitted Msg3's, which hostapd is told to use for each client
 HANDSHAKE_TRANSMIT_INTERVAL = 2
+VERDICT_TIMEOUT = 60
+# Chance that a retransmitted Msg3 makes a vulnerable client reset its IV (it may be lost)
+MSG3_RESET_PROBABILITY = 0.9
+# Chance that a vulnerable client replies to the replayed broadcast ARP request sent after a group
+# key handshake (the group Msg1 or the request may be lost)
+GROUP_REPLY_PROBABILITY = 0.9
+# Accepted chance of marking a vulnerable client as patched
+PATCHED_ERROR_RATE = 0.001
+# Mean time a client needs to process a Msg3 before its data frames use the reinstalled key
+MSG3_PROCESSING_TIME = 0.1
+# Intervals of 2 * HANDSHAKE_TRANSMIT_INTERVAL + 1 seconds without an IV reset before a client is
+# marked as patched, when hostapd doesn't report its Msg3's (e.g. when replaying a capture). The
+# attempts within such an interval are unknown, so they can't be used in a sequential test.
+PATCHED_INTERVALS_NEEDED = 5
+# Unique replies to replayed broadcast ARP requests before a client is marked as vulnerable. Not
+# one, because the requests sent right after a group key handshake may still use an unused IV.
+GROUP_REPLIES_NEEDED = 3
+# Unicast ARP requests per second sent to a client after each Msg3 or group Msg1 (0 to disable)
+ELICIT_RATE = 10
+
+# Metrics of the processing stages and of hostapd, which are exposed using --metrics
+STAGE_FILTER = stage_histogram("filter")
+STAGE_KEY_FETCH = stage_histogram("key_fetch")
+STAGE_DECRYPT = stage_histogram("decrypt")
+STAGE_IV_CHECK = stage_histogram("iv_check")
+STAGE_INJECT = stage_histogram("inject")
+FRAMES_ANALYSED = metrics.counter("krack_frames_analysed_total", "Encrypted frames of clients that were analysed.")
+FRAMES_INJECTED = metrics.counter("krack_frames_injected_total", "Frames injected to test clients or to elicit traffic.")
+CTRL_RTT = metrics.histogram("krack_ctrl_rtt_seconds", "Round-trip time of commands sent to hostapd.")
+CTRL_RTT_LAST = metrics.gauge("krack_ctrl_rtt_last_seconds", "Round-trip time of the last command sent to hostapd.")
+
+def observe_ctrl_rtt(seconds):
+    CTRL_RTT.observe(seconds)
+    CTRL_RTT_LAST.set(seconds)
 
 def hostapd_command(hostapd_ctrl, cmd):
+    start = time.time()
     rval = hostapd_ctrl.request(cmd)
+    observe_ctrl_rtt(time.time() - start)
     if "UNKNOWN COMMAND" in rval:
         log(ERROR, "Hostapd did not recognize the command %s. Did you (re)compile hostapd?" % cmd.split()[0])
         quit(1)
     return rval
 
+def hostapd_command_async(hostapd_ctrl, cmd):
+    """Send a command to hostapd without waiting on its reply, and only report failures"""
+    start = time.time()
+    def check_reply(rval):
+        observe_ctrl_rtt(time.time() - start)
+        if "UNKNOWN COMMAND" in rval:
+            log(ERROR, "Hostapd did not recognize the command %s. Did you (re)compile hostapd?" % cmd.split()[0])
+        elif "FAIL" in rval:
+            log(WARNING, "Hostapd failed to execute the command %s" % cmd)
+    hostapd_ctrl.request_async(cmd, check_reply)
+
+def group_attempts_needed():
+    """After this many group key handshakes that were each followed by an unanswered broadcast
+    ARP request, a vulnerable client would have replied at least once, except with probability
+    PATCHED_ERROR_RATE: the smallest k with (1 - GROUP_REPLY_PROBABILITY)^k <= PATCHED_ERROR_RATE."""
+    return int(math.ceil(math.log(PATCHED_ERROR_RATE) / math.log(1 - GROUP_REPLY_PROBABILITY)))
+
+def msg3_reset_visible(delay):
+    """Chance that a frame sent delay seconds after a Msg3 reuses an IV, if the client is vulnerable.
+    The Msg3 must arrive, and the client must have processed it, where the processing time is
+    taken to be exponentially distributed with mean MSG3_PROCESSING_TIME."""
+    if delay <= 0: return 0.0
+    return MSG3_RESET_PROBABILITY * (1 - math.exp(-delay / MSG3_PROCESSING_TIME))
+
+def hostapd_event_params(fields):
+    """Parse the key=value fields of a hostapd event into a dictionary"""
+    return dict(field.split("=", 1) for field in fields if "=" in field)
+
+
+def parse_time(value):
+    """Argument type of a local time given as YYYY-MM-DD[ HH:MM[:SS]], or as seconds since the epoch"""
+    for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    try:
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid time %r" % value)
+
+
+class PocEvent():
+    """Action of the handshake tests in hostapd, as reported by an AP-STA-POC-EVENT"""
+    def __init__(self, type, replay_counter, keyidx, timestamp):
+        self.type = type
+        self.replay_counter = replay_counter
+        self.keyidx = keyidx
+        # Monotonic clock of hostapd, only comparable to other events
+        self.timestamp = timestamp
+        self.recv_time = time.time()
+
+
+class VerdictStore():
+    """Append-only SQLite database of all verdict transitions, with the evidence that caused them. It
+    uses write-ahead logging, so other programs can query it while tests are running. Records are
+    tagged, e.g. with the firmware version of the tested devices. They are committed in batches, at
+    most commit_interval seconds after they were recorded if commit is called periodically."""
+    def __init__(self, filename, tag=None, commit_interval=1.0):
+        self.tag = tag
+        self.commit_interval = commit_interval
+        # Time of the oldest record that wasn't committed yet
+        self.pending_since = None
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS verdicts (id INTEGER PRIMARY KEY, time REAL, mac TEXT, tag TEXT, " +
+            "test TEXT, verdict TEXT, iv INTEGER, seq INTEGER, key_generation INTEGER, detail TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS verdicts_mac ON verdicts (mac, time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS verdicts_tag ON verdicts (tag, time)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS verdicts_time ON verdicts (time)")
+        self.db.commit()
+
+    def record(self, timestamp, mac, test, verdict, iv=None, seq=None, key_generation=None, detail=None):
+        self.db.execute("INSERT INTO verdicts (time, mac, tag, test, verdict, iv, seq, key_generation, detail) " +
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (timestamp, mac, self.tag, test, verdict, iv, seq, key_generation, detail))
+        if self.pending_since is None:
+            self.pending_since = time.time()
+        self.commit(self.commit_interval)
+
+    def commit(self, min_age=0):
+        """Commit the pending records if the oldest one is at least min_age seconds old"""
+        if self.pending_since is not None and time.time() - self.pending_since >= min_age:
+            self.db.commit()
+            self.pending_since = None
+
+    def query(self, mac=None, tag=None, since=None, until=None):
+        """Returns the recorded transitions, in order, optionally filtered on MAC, tag, and time range"""
+        conditions, params = [], []
+        for condition, value in [("mac = ?", mac), ("tag = ?", tag), ("time >= ?", since), ("time < ?", until)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+        return self.db.execute("SELECT time, mac, tag, test, verdict, iv, seq, key_generation, detail FROM verdicts" +
+            where + " ORDER BY id", params).fetchall()
+
+    def final_verdicts(self, mac):
+        """Last verdict of each test of the client that was recorded with our tag"""
+        rows = self.db.execute("SELECT test, verdict FROM verdicts WHERE mac = ? AND tag IS ? ORDER BY id", (mac, self.tag))
+        return dict(rows.fetchall())
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
 
 class ClientState():
     UNKNOWN, VULNERABLE, PATCHED = range(3)
+    VERDICT_NAMES = ["unknown", "vulnerable", "patched"]
+    # State of the current test: waiting on the client to (re)connect, running, received
+    # frames of the client while running, and all tests are done.
     IDLE, STARTED, GOT_CANARY, FINISHED = range(4)
+    STATE_NAMES = ["idle", "started", "got canary", "finished"]
+    # The tests that are executed in order against each client
+    TEST_4WAY, TEST_GROUP, TEST_TPTK, TEST_TPTK_RAND = range(4)
+    TEST_NAMES = ["4-way handshake", "group key handshake", "TPTK construction", "TPTK construction (random ANonce)"]
+    # The tests that detect pairwise key reinstallations in the 4-way handshake
+    PAIRWISE_TESTS = [TEST_4WAY, TEST_TPTK, TEST_TPTK_RAND]
 
     def __init__(self, clientmac):
         self.mac = clientmac
         self.TK = None
-        self.vuln_4way = ClientState.UNKNOWN
-        self.vuln_group = ClientState.UNKNOWN   
+        self.crypto = None
+        self.ptk_generation = 0
+        self.ptk_installed_time = None
+        self.allzero_crypto = CcmpContext("\x00" * 16, clientmac)
+        self.test = ClientState.TEST_4WAY
+        self.state = ClientState.IDLE
+        self.verdicts = [ClientState.UNKNOWN] * len(ClientState.TEST_NAMES)
+        # Incremented whenever the pairwise test restarts, to ignore outdated worker results
+        self.epoch = 0
+        # Called as listener(client, verdict, evidence, detail) when the verdict of the current test
+        # changes, where evidence is the (time, IV, seq) of the frame that caused it, or None.
+        self.verdict_listener = None
+        self.verdict_evidence = None
+        self.verdict_detail = None
 
         self.ivs = IvCollection()
         self.pairkey_sent_time_prev_iv = None
         self.pairkey_intervals_no_iv_reuse = 0
+        self.pairkey_msg3_events = False
+        # Send times of the Msg3's that are still part of the sequential test, and the summed log
+        # likelihoods of older Msg3's, whose term no longer changes.
+        self.pairkey_msg3_times = []
+        self.pairkey_msg3_settled = 0.0
+        self.pairkey_msg3_attempts = 0
+
+        # Scheduled actions of this client, by name
+        self.timers = dict()
+        # Recent actions of the modified hostapd against this client
+        self.poc_events = collections.deque(maxlen=64)
+        # Raw broadcast ARP request to the client and the IP it was built for
+        self.group_arp = (None, None)
+        self.reset_groupkey()
+
+    def reset_pairwise(self):
+        """Forget the IVs of a previous connection, e.g. when the client reconnects. Hostapd
+        already reported the new key, because it is installed before the client is connected."""
+        self.ivs.reset()
+        self.pairkey_sent_time_prev_iv = None
+        self.pairkey_intervals_no_iv_reuse = 0
+        self.pairkey_msg3_events = False
+        # Send times of the Msg3's that are still part of the sequential test, and the summed log
+        # likelihoods of older Msg3's, whose term no longer changes.
+        self.pairkey_msg3_times = []
+        self.pairkey_msg3_settled = 0.0
+        self.pairkey_msg3_attempts = 0
+
+    def reset_groupkey(self):
+        """Forget the replies of a previous group key handshake test"""
+        # Number of group Msg1's hostapd sent to the client during the group key handshake test
+        self.groupkey_handshakes = 0
+        # Injection tick of the last broadcast ARP request, and the number of group key handshakes
+        # that were executed before it was sent.
+        self.groupkey_request = None
+        self.groupkey_reply_tick = None
+        self.groupkey_num_replies = 0
+        self.groupkey_attempt_handshakes = 0
+        self.groupkey_attempts_no_reply = 0
+
+    def is_testing_pairwise(self):
+        running = self.state in [ClientState.STARTED, ClientState.GOT_CANARY]
+        return running and self.test in ClientState.PAIRWISE_TESTS
+
+    def is_testing_group(self):
+        running = self.state in [ClientState.STARTED, ClientState.GOT_CANARY]
+        return running and self.test == ClientState.TEST_GROUP
+
+    def get_verdict(self):
+        """Verdict of the current test"""
+        return self.verdicts[self.test]
+
+    def set_verdict(self, verdict, evidence=None, detail=None):
+        if verdict == self.verdicts[self.test]: return
+        self.verdicts[self.test] = verdict
+        self.verdict_evidence = evidence
+        self.verdict_detail = detail
+        if self.verdict_listener is not None:
+            self.verdict_listener(self, verdict, evidence, detail)
+
+    def frame_evidence(self, p):
+        return (p.time, p.iv, dot11_get_seqnum(p))
+
+    def restore_verdicts(self, verdicts):
+        """Use the verdicts of an earlier run, given as a dictionary from test name to verdict name"""
+        for test, verdict in verdicts.items():
+            if test in ClientState.TEST_NAMES and verdict in ClientState.VERDICT_NAMES:
+                self.verdicts[ClientState.TEST_NAMES.index(test)] = ClientState.VERDICT_NAMES.index(verdict)
+        if not ClientState.UNKNOWN in self.verdicts:
+            self.state = ClientState.FINISHED
+
+    def report(self):
+        return ", ".join("%s %s" % (name, ClientState.VERDICT_NAMES[verdict]) for name, verdict
+            in zip(ClientState.TEST_NAMES, self.verdicts))
+
+    def capture_state(self):
+        """State of the tests, which annotates the captured frames of this client. It's formatted by
+        the capture writer thread using format_capture_state."""
+        return (self.mac, self.test, self.state, tuple(self.verdicts))
+
+    def get_group_arp(self, template, clientip):
+        if self.group_arp[0] != clientip:
+            self.group_arp = (clientip, template.build(1, self.mac, clientip, broadcast=True))
+        return self.group_arp[1]
+
+    def cancel_timers(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers = dict()
 
     def get_encryption_key(self, hostapd_ctrl):
         if self.TK is None:
-            # Clear old replies and messages from the hostapd control interface
-            while hostapd_ctrl.pending():
-                hostapd_ctrl.recv()
             # Contact our modified Hostapd instance to request the pairwise key
-            response = hostapd_command(hostapd_ctrl, "GET_TK " + self.mac)
-            if not "FAIL" in response:
-                self.TK = response.strip().decode("hex")
+            start = time.time()
+            self.handle_tk_reply(hostapd_command(hostapd_ctrl, "GET_TK " + self.mac))
+            if metrics.enabled:
+                STAGE_KEY_FETCH.observe(time.time() - start)
         return self.TK
 
+    def handle_tk_reply(self, response):
+        if not "FAIL" in response and not "UNKNOWN COMMAND" in response:
+            self.set_encryption_key(response.strip().decode("hex"))
+
+    def set_encryption_key(self, tk):
+        # Only rebuild the cached crypto state when the key changed
+        if tk != self.TK:
+            self.TK = tk
+            self.crypto = CcmpContext(tk, self.mac)
+
+    def forget_encryption_key(self):
+        self.TK = None
+        self.crypto = None
+
+    def handle_ptk_installed(self, tk, generation):
+        """Hostapd (re)installed the pairwise key, reported by an event or by GET_TK_ALL"""
+        self.ptk_generation = generation
+        self.ptk_installed_time = time.time()
+        self.set_encryption_key(tk)
+        log(DEBUG, "%s: pairwise key installed (generation %d)", self.mac, generation)
+
+    def handle_poc_event(self, event):
+        """Hostapd executed part of a test against this client, e.g. it sent a Msg3"""
+        self.poc_events.append(event)
+        log(DEBUG, "%s: hostapd %s (replay counter %d, key index %d)", self.mac,
+            event.type, event.replay_counter, event.keyidx)
+
+        # A Msg3 is only an attempt to reinstall the key if the client already used the key
+        if event.type == "msg3":
+            self.pairkey_msg3_events = True
+            if self.ivs.highest is not None:
+                self.pairkey_msg3_times.append(event.recv_time)
+                self.pairkey_msg3_attempts += 1
+        elif event.type == "group-msg1" and self.is_testing_group():
+            self.groupkey_handshakes += 1
+
     def decrypt(self, p, hostapd_ctrl):
         payload = get_ccmp_payload(p)
         llcsnap, packet = payload[:8], payload[8:]
 
-        if payload.startswith("\xAA\xAA\x03\x00\x00\x00"):
+        if payload.startswith(LLC_SNAP_PREFIX):
             # On some kernels, the virtual interface associated to the real AP interface will return
             # frames where the payload is already decrypted (this happens when hardware decryption is
             # used). So if the payload seems decrypted, just extract the full plaintext from the frame.
             plaintext = payload
         else:
-            key       = self.get_encryption_key(hostapd_ctrl)
-            plaintext = decrypt_ccmp(p, key)
-
-            # If it still fails, try an all-zero key
-            if not plaintext.startswith("\xAA\xAA\x03\x00\x00\x00"):
-                plaintext = decrypt_ccmp(p, "\x00" * 16)
+            # Only decrypt the full frame with the key that seems to be used. If the pairwise key
+            # doesn't work, try an all-zero key.
+            self.get_encryption_key(hostapd_ctrl)
+            if self.crypto is not None and self.crypto.probe(p):
+                plaintext = self.crypto.decrypt(p)
+            else:
+                plaintext = self.allzero_crypto.decrypt(p)
 
         return plaintext
 
+    def handle_data(self, p):
+        """Run the pairwise key tests on an encrypted frame sent by this client"""
+        log(DEBUG, "%s: transmitted data using IV=%d (seq=%d)", self.mac, p.iv, dot11_get_seqnum(p))
+        if not self.is_testing_pairwise():
+            return
+        if self.state == ClientState.STARTED:
+            self.state = ClientState.GOT_CANARY
+
+        if not metrics.enabled:
+            if self.allzero_crypto.probe(p):
+                self.mark_allzero_key(p)
+            self.check_pairwise_reinstall(p)
+            self.track_used_iv(p)
+            return
+
+        start = time.time()
+        if self.allzero_crypto.probe(p):
+            self.mark_allzero_key(p)
+        decrypted = time.time()
+        STAGE_DECRYPT.observe(decrypted - start)
+        self.check_pairwise_reinstall(p)
+        self.track_used_iv(p)
+        STAGE_IV_CHECK.observe(time.time() - decrypted)
+
     def track_used_iv(self, p):
         return self.ivs.track_used_iv(p)
 
@@ -70,54 +383,163 @@ class ClientState():
 
         # If this is gaurenteed IV reuse (and not just a benign retransmission), mark the client as vulnerable
         if self.ivs.is_iv_reused(p):
-            if self.vuln_4way != ClientState.VULNERABLE:
+            if self.get_verdict() != ClientState.VULNERABLE:
                 iv = dot11_get_iv(p)
                 seq = dot11_get_seqnum(p)
-                log(INFO, ("%s: IV reuse detected (IV=%d, seq=%d). " +
-                    "Client is vulnerable to pairwise key reinstallations in the 4-way handshake!") % (self.mac, iv, seq), color="green")
-            self.vuln_4way = ClientState.VULNERABLE
+                log(INFO, ("%s: IV reuse detected (IV=%d, seq=%d). Client is vulnerable to pairwise " +
+                    "key reinstallations in the %s test!") % (self.mac, iv, seq, ClientState.TEST_NAMES[self.test]), color="green")
+            self.set_verdict(ClientState.VULNERABLE, self.frame_evidence(p), "IV reuse")
 
         # If it's a higher IV than all previous ones, try to check if the client seems patched
-        elif self.vuln_4way == ClientState.UNKNOWN and self.ivs.is_new_iv(p):
-            # Save how many intervals we received a data packet without IV reset. Use twice the
-            # transmission interval of message 3, in case one message 3 is lost due to noise.
-            if self.pairkey_sent_time_prev_iv is None:
+        elif self.get_verdict() == ClientState.UNKNOWN and self.ivs.is_new_iv(p):
+            patched = None
+            if self.pairkey_msg3_events:
+                # Hostapd reports when it sends message 3, so run a sequential probability ratio test.
+                # Stop as soon as it is unlikely enough that a vulnerable client sent this frame.
+                llr = self.pairkey_log_likelihood(p.time)
+                if llr <= math.log(PATCHED_ERROR_RATE):
+                    patched = "no IV reset after %d Msg3's (log likelihood ratio %.1f)" % (self.pairkey_msg3_attempts, llr)
+
+            # Otherwise save how many intervals we received a data packet without IV reset. Use twice
+            # the transmission interval of message 3, in case one message 3 is lost due to noise.
+            elif self.pairkey_sent_time_prev_iv is None:
                 self.pairkey_sent_time_prev_iv = p.time
             elif self.pairkey_sent_time_prev_iv + 2 * HANDSHAKE_TRANSMIT_INTERVAL + 1 <= p.time:
                 self.pairkey_intervals_no_iv_reuse += 1
                 self.pairkey_sent_time_prev_iv = p.time
-                log(DEBUG, "%s: no pairwise IV resets seem to have occured for one interval" % self.mac)
+                log(DEBUG, "%s: no pairwise IV resets seem to have occured for one interval", self.mac)
+                if self.pairkey_intervals_no_iv_reuse >= PATCHED_INTERVALS_NEEDED:
+                    patched = "no IV reset during %d intervals" % self.pairkey_intervals_no_iv_reuse
+
+            # If all IV reset attempts failed, the client is likely patched
+            if patched is not None:
+                self.set_verdict(ClientState.PATCHED, self.frame_evidence(p), patched)
+
+                msg = "%s: Client DOESN'T seem vulnerable to pairwise key reinstallation in the %s test."
+                log(INFO, msg % (self.mac, ClientState.TEST_NAMES[self.test]), color="green")
+
+    def pairkey_log_likelihood(self, now):
+        """Log of the likelihood ratio between a vulnerable and a patched client, given that the client
+        sent a frame at time now that doesn't reuse an IV. A vulnerable client keeps reusing IVs after
+        a reset, so this frame implies all earlier ones also didn't reuse an IV, and the ratio only
+        depends on the latest frame: each Msg3 sent at time s adds log(1 - msg3_reset_visible(now - s)).
+        A patched client never reuses an IV, so its likelihood is 1. Terms of Msg3's that were sent
+        long enough ago no longer change, and are summed once."""
+        llr = self.pairkey_msg3_settled
+        pending = []
+        for sent in self.pairkey_msg3_times:
+            term = math.log(1 - msg3_reset_visible(now - sent))
+            if now - sent >= 10 * MSG3_PROCESSING_TIME:
+                self.pairkey_msg3_settled += term
+            else:
+                pending.append(sent)
+            llr += term
+        self.pairkey_msg3_times = pending
+        log(DEBUG, "%s: no pairwise IV reset after %d Msg3's, log likelihood ratio %.2f", self.mac,
+            self.pairkey_msg3_attempts, llr)
+        return llr
+
+    def groupkey_track_request(self, tick):
+        """Called right before a replayed broadcast ARP request is sent to the client. When the previous
+        request was sent after a new group key handshake, and the client didn't reply to it, the attempt
+        to make the client reinstall the group key failed."""
+        if self.groupkey_request is not None and self.state == ClientState.GOT_CANARY and \
+                self.is_testing_group() and self.get_verdict() == ClientState.UNKNOWN:
+            prev_tick, handshakes = self.groupkey_request
+            if prev_tick != self.groupkey_reply_tick and handshakes > self.groupkey_attempt_handshakes:
+                self.groupkey_attempts_no_reply += 1
+                self.groupkey_attempt_handshakes = handshakes
+                log(DEBUG, "%s: no reply to the broadcast ARP request after group key handshake %d", self.mac, handshakes)
 
-            # If during several intervals all IV reset attempts failed, the client is likely patched.
-            # We wait for enough such intervals to occur, to avoid getting a wrong result.
-            if self.pairkey_intervals_no_iv_reuse >= 5 and self.vuln_4way == ClientState.UNKNOWN:
-                self.vuln_4way = ClientState.PATCHED
+            if self.groupkey_attempts_no_reply >= group_attempts_needed():
+                self.set_verdict(ClientState.PATCHED, detail="no reply after %d group key handshakes" % handshakes)
+                log(INFO, "%s: Client DOESN'T seem vulnerable to group key reinstallation in the group key handshake." \
+                    % self.mac, color="green")
 
-                msg = "Client DOESN'T seem vulnerable to pairwise key reinstallation in the 4-way handshake using standard attack."
-                log(INFO, msg, color="green")
+        self.groupkey_request = (tick, self.groupkey_handshakes)
+
+    def groupkey_handle_canary(self):
+        """The client replied to one of our ARP requests, so we can expect replies to accepted ones"""
+        if self.state == ClientState.STARTED and self.is_testing_group():
+            self.state = ClientState.GOT_CANARY
+
+    def groupkey_handle_reply(self):
+        """The client replied to a broadcast ARP request, which is matched to the last injection tick"""
+        self.groupkey_handle_canary()
+        if self.groupkey_request is None: return
+        tick, handshakes = self.groupkey_request
+        # Only count one reply per request, since the request may be retransmitted
+        if tick == self.groupkey_reply_tick: return
+        self.groupkey_reply_tick = tick
+
+        # Requests sent before the first group key handshake are expected to be accepted
+        if not self.is_testing_group() or handshakes == 0 or self.get_verdict() != ClientState.UNKNOWN:
+            return
+        self.groupkey_num_replies += 1
+        log(DEBUG, "%s: received %d replies to the replayed broadcast ARP requests (tick %d, group key handshake %d)",
+            self.mac, self.groupkey_num_replies, tick, handshakes)
+
+        if self.groupkey_num_replies >= GROUP_REPLIES_NEEDED:
+            self.set_verdict(ClientState.VULNERABLE, detail="%d replies to replayed broadcast ARPs, last at tick %d after group key handshake %d" \
+                % (self.groupkey_num_replies, tick, handshakes))
+            log(INFO, ("%s: Received %d unique replies to replayed broadcast ARP requests. Client is vulnerable to group " +
+                "key reinstallations in the group key handshake (or accepts replayed broadcast frames)!") \
+                % (self.mac, self.groupkey_num_replies), color="green")
 
     def mark_allzero_key(self, p):
-        if self.vuln_4way != ClientState.VULNERABLE:
+        if self.get_verdict() != ClientState.VULNERABLE:
             iv = dot11_get_iv(p)
             seq = dot11_get_seqnum(p)
             log(INFO, ("%s: usage of all-zero key detected (IV=%d, seq=%d). " +
                 "Client is vulnerable to (re)installation of an all-zero key in the 4-way handshake!") % (self.mac, iv, seq), color="green")
             log(WARNING, "%s: !!! Other tests are unreliable due to all-zero key usage, please fix this first !!!" % self.mac)
-        self.vuln_4way = ClientState.VULNERABLE
+        self.set_verdict(ClientState.VULNERABLE, self.frame_evidence(p), "all-zero key")
+
+
+def format_capture_state(state):
+    """Comment of a captured frame, given the ClientState.capture_state of its client"""
+    mac, test, teststate, verdicts = state
+    return "%s: %s test %s; %s" % (mac, ClientState.TEST_NAMES[test], ClientState.STATE_NAMES[teststate],
+        ", ".join("%s %s" % (name, ClientState.VERDICT_NAMES[verdict]) for name, verdict
+        in zip(ClientState.TEST_NAMES, verdicts)))
 
 
 class DetectKRACK():
-    def __init__ (self):
+    def __init__ (self, interface="wlo1", apmac=None, rx_ring=False, num_workers=0, subnet="192.168.100.0/24",
+                  lease_file=None, store=None, skip_known=False, metrics_address=None, profile=False,
+                  capture=None):
         self.script_path = os.path.dirname(os.path.realpath(__file__))
-        interface = "wlo1"  # Enter wifi interface here
         self.nic_iface = interface
         self.nic_mon = interface + "mon"
-        self.apmac = scapy.arch.get_if_hwaddr(interface)
+        if apmac is None:
+            self.apmac = scapy.arch.get_if_hwaddr(interface)
+        else:
+            self.apmac = apmac.lower()
+        self.apmac_raw = mac2raw(self.apmac)
+        self.rx_ring = rx_ring
+        self.num_workers = num_workers
+        self.subnet = subnet
+        self.lease_file = lease_file
+        self.store = store
+        self.skip_known = skip_known
+        self.metrics_address = metrics_address
+        self.metrics_server = None
+        self.profile = profile
+        self.capture_drops = 0
+        self.capture = capture
+        self.processes = []
+        self.queues = []
+        self.results = []
+        self.controls = []
         self.sock_mon = None
         self.sock_eth = None
+        self.eth_ring = None
+        self.dhcp = None
         self.hostapd = None
         self.hostapd_ctrl = None
         self.clients = dict()
+        self.group_arp_tick = 0
+        self.loop = EventLoop()
 
     def configure_interfaces(self):
         log(STATUS, "Note: disable Wi-Fi in network manager & disable hardware encryption. Both may interfere with this script.")
@@ -146,79 +568,497 @@ class DetectKRACK():
         try:
             self.hostapd_ctrl = Ctrl("hostapd_ctrl/" + self.nic_iface)
             self.hostapd_ctrl.attach()
+            # Don't handle events in the middle of processing a frame that requested a key
+            self.hostapd_ctrl.subscribe(self.handle_hostapd_event,
+                                        lambda callback: self.loop.call_later(0, callback))
         except:
             log(ERROR, "It seems hostapd did not start properly.")
             log(ERROR, "Did you disable Wi-Fi in the network manager?")
             raise
+        self.sync_encryption_keys()
+        # The group key handshake is periodically executed by hostapd, and must match our timing
+        hostapd_command(self.hostapd_ctrl, "SET_GROUP_REKEY_INTERVAL %d" % (HANDSHAKE_TRANSMIT_INTERVAL * 1000))
 
         self.sock_mon = MitmSocket(type=ETH_P_ALL, iface=self.nic_mon)
+        # Let the kernel drop beacons, ACKs, and frames of other networks
+        self.sock_mon.set_data_filter(self.apmac)
         self.sock_eth = L2Socket(type=ETH_P_ALL, iface=self.nic_iface)
+        if self.rx_ring:
+            self.sock_mon.enable_rx_ring()
+            self.eth_ring = PacketRing(self.sock_eth.ins)
 
+        leases = LeaseManager(self.subnet, lease_time=3600, filename=self.lease_file)
         self.dhcp = DHCP_sock(sock=self.sock_eth,
                         domain='krackattack.com',
-                        pool=Net('192.168.100.0/24'),
-                        network='192.168.100.0/24',
-                        gw='192.168.100.254',
+                        leases=leases,
+                        network=self.subnet,
+                        gw=leases.gateway,
                         renewal_time=600, lease_time=3600)
+        self.loop.call_later(10, self.expire_leases)
+        if self.store is not None:
+            self.loop.call_later(self.store.commit_interval, self.commit_verdicts)
         # Configure gateway IP: reply to ARP and ping requests
-        subprocess.check_output(["ifconfig", self.nic_iface, "192.168.100.254"])
+        subprocess.check_output(["ifconfig", self.nic_iface, leases.gateway, "netmask", leases.netmask])
 
         # Use a dedicated IP address for our broadcast ARP requests and replies
-        self.group_ip = self.dhcp.pool.pop()
+        self.group_ip = leases.reserve()
         self.group_arp = ARP_sock(sock=self.sock_eth, IP_addr=self.group_ip, ARP_addr=self.apmac)
+        self.group_arp_template = ArpTemplate(self.apmac, self.group_ip)
+        self.elicit_template = ArpTemplate(self.apmac, self.dhcp.server_ip)
+        # Targets of the ARP packets that process_eth_rx handles: requests for and replies to our IPs
+        self.eth_arp_ips = set([socket.inet_aton(self.group_ip), socket.inet_aton(self.dhcp.server_ip)])
+        self.loop.call_later(1, self.inject_group_arps)
+
+        # Monitor both the normal interface and virtual monitor interface of the AP, and the events
+        # of hostapd. When using worker processes, we receive their results instead of monitor frames.
+        self.loop.add_reader(self.sock_eth, self.handle_eth)
+        self.loop.add_reader(self.hostapd_ctrl, self.hostapd_ctrl.handle_read)
+        if self.metrics_address is not None:
+            self.start_metrics()
+        if self.num_workers > 0:
+            self.start_pipeline()
+            for results in self.results:
+                self.loop.add_reader(results, self.handle_results, results)
+        else:
+            self.loop.add_reader(self.sock_mon, self.handle_mon)
         log(STATUS, "Ready. Connect to this Access Point to start the tests.", color="green")
 
-        # Monitor both the normal interface and virtual monitor interface of the AP
-        self.next_arp = time.time() + 1
-        while True:
-            sel = select.select([self.sock_mon, self.sock_eth], [], [], 1)
-            if self.sock_mon in sel[0]:
-                self.handle_mon()
-            if self.sock_eth in sel[0]:
-                self.handle_eth()
-
-            # Periodically send the replayed broadcast ARP requests to test for group key reinstallations
-            if time.time() > self.next_arp:
-                self.next_arp = time.time() + HANDSHAKE_TRANSMIT_INTERVAL
-                for client in self.clients.values():
-                    # Also keep injecting to PATCHED clients (just to be sure they keep rejecting replayed frames)
-                    if client.vuln_group != ClientState.VULNERABLE and client.mac in self.dhcp.leases:
-                        clientip = self.dhcp.leases[client.mac]
-                        log(INFO, "%s: sending broadcast ARP to %s from %s" % (client.mac, clientip, self.group_ip))
-
-                        request = Ether(dst="ff:ff:ff:ff:ff:ff")/ARP(op=1, hwsrc=self.apmac, psrc=self.group_ip, pdst=clientip)
-                        self.sock_eth.send(request)
+        self.loop.run_forever()
+
+    def start_metrics(self):
+        """Expose the metrics, and the gauges of the detector itself, on a local socket"""
+        metrics.gauge("krack_clients", "Number of clients that are tracked.", lambda: len(self.clients))
+        metrics.gauge("krack_iv_index_bytes", "Memory used by the IV indexes of all clients.",
+            lambda: sum(client.ivs.memory_size() for client in self.clients.values()))
+        metrics.gauge("krack_dhcp_leases", "Number of active DHCP leases.", lambda: len(self.dhcp.leases))
+        metrics.counter("krack_capture_drops_total", "Monitor frames dropped by the kernel because they were not received in time.",
+            self.count_capture_drops)
+        metrics.counter("krack_pipeline_drops_total", "Monitor frames dropped because a worker process was behind.",
+            self.count_pipeline_drops)
+        self.metrics_server = MetricsServer(self.loop, self.metrics_address)
+        metrics.enabled = True
+        if self.profile:
+            self.metrics_server.profiler.start()
+        log(STATUS, "Serving metrics on %s" % self.metrics_address)
+
+    def count_capture_drops(self):
+        self.capture_drops += self.sock_mon.get_drops()
+        return self.capture_drops
+
+    def count_pipeline_drops(self):
+        return sum(queue.dropped for queue in self.queues)
+
+    def start_client(self, client):
+        """Schedule the periodic actions of a client that (re)connected, and (re)start its current test"""
+        client.cancel_timers()
+        if client.state == ClientState.FINISHED:
+            self.stop_tests(client)
+        elif client.get_verdict() != ClientState.UNKNOWN:
+            # The test already has a verdict from an earlier run
+            self.finish_test(client)
+        else:
+            self.start_test(client)
+
+    def start_test(self, client):
+        """Let hostapd execute the current test against the client. This is also done after the client
+        reconnected: hostapd keeps the state of a client that reconnects shortly after it was
+        deauthenticated, so it may still be executing the previous test."""
+        client.state = ClientState.STARTED
+        if client.test == ClientState.TEST_GROUP:
+            client.reset_groupkey()
+        if self.hostapd_ctrl is not None:
+            hostapd_command_async(self.hostapd_ctrl, "SET_RETRANSMIT_INTERVAL %s %d" % (client.mac,
+                HANDSHAKE_TRANSMIT_INTERVAL * 1000))
+            if client.test == ClientState.TEST_4WAY:
+                hostapd_command_async(self.hostapd_ctrl, "START_4WAY_TESTS " + client.mac)
+            elif client.test == ClientState.TEST_GROUP:
+                hostapd_command_async(self.hostapd_ctrl, "START_GROUP_TESTS " + client.mac)
+            elif client.test == ClientState.TEST_TPTK:
+                hostapd_command_async(self.hostapd_ctrl, "TEST_TPTK " + client.mac)
+            elif client.test == ClientState.TEST_TPTK_RAND:
+                hostapd_command_async(self.hostapd_ctrl, "TEST_TPTK_RAND " + client.mac)
+            log(STATUS, "%s: starting %s test" % (client.mac, ClientState.TEST_NAMES[client.test]))
+        client.timers["deadline"] = self.loop.call_later(VERDICT_TIMEOUT, self.finish_test, client)
+
+    def stop_tests(self, client):
+        """Let hostapd execute normal handshakes with a client whose tests are done, so it no longer
+        retransmits handshake messages to it"""
+        if self.hostapd_ctrl is not None:
+            hostapd_command_async(self.hostapd_ctrl, "STOP_TESTS " + client.mac)
+
+    def start_eliciting(self, client):
+        """Make the client send data frames right after it processed a Msg3 or group Msg1, so the IV
+        it uses after a possible key reinstallation can be observed immediately."""
+        if self.sock_eth is None or ELICIT_RATE <= 0: return
+        if "elicit" in client.timers:
+            client.timers["elicit"].cancel()
+        # Stop right before the next message, which will start a new burst
+        deadline = self.loop.clock() + HANDSHAKE_TRANSMIT_INTERVAL - MSG3_PROCESSING_TIME
+        client.timers["elicit"] = self.loop.call_later(MSG3_PROCESSING_TIME, self.elicit_traffic, client, deadline)
+
+    def elicit_traffic(self, client, deadline):
+        # Back off once the current test has a verdict
+        if client.state == ClientState.FINISHED or client.get_verdict() != ClientState.UNKNOWN: return
+        if self.loop.clock() >= deadline or not client.mac in self.dhcp.leases: return
+        client.timers["elicit"] = self.loop.call_later(1.0 / ELICIT_RATE, self.elicit_traffic, client, deadline)
+
+        clientip = self.dhcp.leases[client.mac]
+        log(DEBUG, "%s: sending unicast ARP to %s to elicit a data frame", client.mac, clientip)
+        start = time.time()
+        self.sock_eth.send(self.elicit_template.build(1, client.mac, clientip))
+        if metrics.enabled:
+            STAGE_INJECT.observe(time.time() - start)
+        FRAMES_INJECTED.inc()
+
+    def check_test_done(self, client):
+        """Continue with the next test once the current one has a verdict"""
+        if self.hostapd_ctrl is not None and client.state != ClientState.FINISHED \
+                and client.get_verdict() != ClientState.UNKNOWN:
+            self.finish_test(client)
+
+    def finish_test(self, client):
+        """Called when the current test has a verdict or when its deadline passed"""
+        if client.get_verdict() == ClientState.UNKNOWN:
+            log(WARNING, "%s: no verdict for the %s test after %d seconds. Is the client sending data frames?" % (client.mac,
+                ClientState.TEST_NAMES[client.test], VERDICT_TIMEOUT))
+        # Without hostapd, e.g. when replaying a capture, only the current test can be executed
+        if self.hostapd_ctrl is None: return
+        client.cancel_timers()
+
+        # Skip tests that already have a verdict from an earlier run
+        client.test += 1
+        while client.test < len(ClientState.TEST_NAMES) and client.get_verdict() != ClientState.UNKNOWN:
+            client.test += 1
+        if client.test == len(ClientState.TEST_NAMES):
+            client.test -= 1
+            client.state = ClientState.FINISHED
+            log(STATUS, "%s: finished all tests: %s" % (client.mac, client.report()), color="green")
+            self.stop_tests(client)
+            return
+        if client.test == ClientState.TEST_GROUP:
+            # Hostapd now accepts message 4 to complete the 4-way handshake, and then periodically
+            # executes the group key handshake.
+            self.start_test(client)
+        else:
+            # A new 4-way handshake is needed, so let the client reconnect. The test is started
+            # once it reconnected.
+            client.state = ClientState.IDLE
+            log(STATUS, "%s: disconnecting client to start the %s test" % (client.mac, ClientState.TEST_NAMES[client.test]))
+            hostapd_command_async(self.hostapd_ctrl, "DEAUTHENTICATE " + client.mac)
+
+    def reset_pairwise(self, client):
+        """Restart the pairwise tests of a client, e.g. because it reconnected"""
+        client.reset_pairwise()
+        client.epoch += 1
+        if len(self.controls) > 0:
+            control = self.controls[zlib.crc32(mac2raw(client.mac)) % len(self.controls)]
+            control.send((client.mac, client.epoch))
+
+    def inject_group_arps(self):
+        """Periodically send the replayed broadcast ARP requests to test for group key reinstallations.
+        The requests to all clients are sent using a single system call."""
+        self.loop.call_later(HANDSHAKE_TRANSMIT_INTERVAL, self.inject_group_arps)
+        self.group_arp_tick += 1
+
+        requests = []
+        for client in self.clients.values():
+            # Also keep injecting to PATCHED clients (just to be sure they keep rejecting replayed frames)
+            if client.verdicts[ClientState.TEST_GROUP] != ClientState.VULNERABLE and client.mac in self.dhcp.leases:
+                clientip = self.dhcp.leases[client.mac]
+                log(DEBUG, "%s: sending broadcast ARP to %s from %s", client.mac, clientip, self.group_ip)
+                client.groupkey_track_request(self.group_arp_tick)
+                requests.append(client.get_group_arp(self.group_arp_template, clientip))
+                self.check_test_done(client)
+        start = time.time()
+        FRAMES_INJECTED.inc(sendmmsg(self.sock_eth.outs, requests))
+        if metrics.enabled:
+            STAGE_INJECT.observe(time.time() - start)
+
+    def commit_verdicts(self):
+        """Periodically commit the recorded verdicts, so other programs see them"""
+        self.loop.call_later(self.store.commit_interval, self.commit_verdicts)
+        self.store.commit(self.store.commit_interval)
+
+    def expire_leases(self):
+        """Periodically free the IP addresses of expired DHCP leases, and save the leases if requested"""
+        self.loop.call_later(10, self.expire_leases)
+        self.dhcp.expire_leases()
+        self.dhcp.leases.save()
+
+    def replay(self, filename):
+        """Run the tests on a recorded monitor-mode capture (pcap or pcapng) instead of on live
+        radios. All tests use the timestamps of the captured frames as their clock, so the capture
+        is processed as fast as possible while giving the same results as a live run."""
+        log(STATUS, "Replaying %s as Access Point %s" % (filename, self.apmac))
+        reader = PcapReader(filename)
+        self.loop = None
+        try:
+            for p in reader:
+                if RadioTap in p:
+                    p = radiotap_parse_raw(str(p), p.time)
+                elif Ether in p:
+                    # Captures saved using --capture also contain the Ethernet frames of clients
+                    continue
+                else:
+                    p = dot11_parse_raw(str(p), p.time)
+                if p == None: continue
+
+                # Timers also run on the clock of the capture
+                self.replay_time = p.time
+                if self.loop is None:
+                    self.loop = EventLoop(clock=lambda: self.replay_time)
+                self.loop.run_timers()
+                self.process_mon_rx(p)
+        finally:
+            reader.close()
+
+    def report(self):
+        for client in self.clients.values():
+            log(STATUS, "%s: %s" % (client.mac, client.report()))
 
     def handle_mon (self):
-        p = self.sock_mon.recv()
+        if self.sock_mon.ring is not None:
+            for p in self.sock_mon.recv_raw_ring():
+                self.process_mon_rx(p)
+            return
+
+        p = self.sock_mon.recv_raw()
         if p == None: return
-        if p.type == 1: return
+        self.process_mon_rx(p)
+
+    def is_client_data(self, p):
+        """Returns True if the Dot11Raw frame p is an encrypted frame sent by a client to our AP"""
+        return p.type != 1 and (p.FCfield & 2) == 0 and p.iv is not None and p.a1 == self.apmac_raw
 
-        if (p.FCfield & 2) != 0:
-            clientmac, apmac = (p.addr1, p.addr2)
+    def get_client(self, clientmac):
+        if not clientmac in self.clients:
+            client = self.clients[clientmac] = ClientState(clientmac)
+            client.verdict_listener = self.record_verdict
+            if self.store is not None and self.skip_known:
+                client.restore_verdicts(self.store.final_verdicts(clientmac))
+                if client.state == ClientState.FINISHED:
+                    log(STATUS, "%s: skipping client, tested earlier: %s" % (clientmac, client.report()))
+            if self.loop is not None:
+                self.start_client(client)
+        return self.clients[clientmac]
+
+    def record_verdict(self, client, verdict, evidence, detail):
+        """Save a verdict transition of a client in the persistent store"""
+        if self.store is None or verdict == ClientState.UNKNOWN: return
+        timestamp, iv, seq = evidence if evidence is not None else (time.time(), None, None)
+        self.store.record(timestamp, client.mac, ClientState.TEST_NAMES[client.test], ClientState.VERDICT_NAMES[verdict],
+            iv, seq, client.ptk_generation, detail)
+
+    def process_mon_rx(self, p):
+        """Process a monitor frame that was parsed into a Dot11Raw"""
+        if metrics.enabled:
+            start = time.time()
+            isdata = self.is_client_data(p)
+            STAGE_FILTER.observe(time.time() - start)
         else:
-            clientmac, apmac = (p.addr2, p.addr1)
+            isdata = self.is_client_data(p)
+        if not isdata:
+            return
+        FRAMES_ANALYSED.inc()
+        client = self.get_client(p.addr2)
+        client.handle_data(p)
+        if self.capture is not None:
+            self.capture.put(LINKTYPE_IEEE802_11, buffer_slice(p.buf, p.start, p.end), p.time, client.capture_state())
+        self.check_test_done(client)
 
-        if apmac != self.apmac:
-            return None
+    def start_pipeline(self):
+        """Process monitor frames using one capture process and several worker processes. The
+        capture process only parses frame headers, and passes the encrypted frames of a client,
+        through shared memory, to the worker that owns the client. Workers report new clients and
+        changes of the pairwise verdict back over a pipe, and this process aggregates them in
+        self.clients. Workers are told over a second pipe when the pairwise test of a client restarts."""
+        self.queues = [SharedFrameQueue() for i in range(self.num_workers)]
+        for queue in self.queues:
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            control_reader, control_writer = multiprocessing.Pipe(duplex=False)
+            self.start_process(self.pipeline_worker, queue, control_reader, writer)
+            self.results.append(reader)
+            self.controls.append(control_writer)
+        self.start_process(self.pipeline_capture)
+        log(STATUS, "Started capture process and %d worker processes" % self.num_workers)
 
-        elif p.addr1 == self.apmac and Dot11WEP in p:
-            if not clientmac in self.clients:
-                self.clients[clientmac] = ClientState(clientmac)
-            client = self.clients[clientmac]
+    def start_process(self, target, *args):
+        process = multiprocessing.Process(target=self.run_process, args=(target,) + args)
+        process.daemon = True
+        process.start()
+        self.processes.append(process)
 
-            iv = dot11_get_iv(p)
-            log(DEBUG, "%s: transmitted data using IV=%d (seq=%d)" % (clientmac, iv, dot11_get_seqnum(p)))
+    def run_process(self, target, *args):
+        """Entry point of the pipeline processes. Multiprocessing exits them using os._exit, which
+        skips the atexit handlers, so queued log records are written here."""
+        # Clean up when stop() terminates this process
+        signal.signal(signal.SIGTERM, self.pipeline_terminated)
+        try:
+            target(*args)
+        finally:
+            close_log()
+
+    def pipeline_terminated(self, signum, frame):
+        # Multiprocessing may terminate the process again on exit, which must not interrupt the cleanup
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise SystemExit(0)
+
+    def pipeline_capture(self):
+        metrics.enabled = False
+        # The writer thread of the main process doesn't exist after the fork. Verdicts are only
+        # known by the main process, so frames captured here are annotated with the client only.
+        if self.capture is not None:
+            self.capture = PcapngWriter(self.capture.prefix + "-mon", self.capture.max_size, self.capture.max_age,
+                annotate=raw2mac)
+        try:
+            while True:
+                if self.sock_mon.ring is not None:
+                    select.select([self.sock_mon], [], [])
+                    frames = self.sock_mon.recv_raw_ring()
+                else:
+                    frames = [self.sock_mon.recv_raw()]
+
+                for p in frames:
+                    if p == None or not self.is_client_data(p): continue
+                    queue = self.queues[zlib.crc32(p.a2) % len(self.queues)]
+                    queue.put(p.buf, p.start, p.end, p.time)
+                    if self.capture is not None:
+                        self.capture.put(LINKTYPE_IEEE802_11, buffer_slice(p.buf, p.start, p.end), p.time, p.a2)
+        finally:
+            if self.capture is not None:
+                self.capture.close()
+
+    def pipeline_worker(self, queue, control, results):
+        # Periodic actions of clients, the order of their tests, and saving verdicts are handled by
+        # the main process.
+        self.loop = None
+        self.store = None
+        self.capture = None
+        # Only the main process exports metrics
+        metrics.enabled = False
+        while True:
+            while control.poll():
+                clientmac, epoch = control.recv()
+                client = self.get_client(clientmac)
+                client.reset_pairwise()
+                client.set_verdict(ClientState.UNKNOWN)
+                client.epoch = epoch
+
+            idle = True
+            for buf, start, end, timestamp in queue.frames():
+                idle = False
+                p = dot11_parse_raw(buf, timestamp, start, end)
+                if p == None: continue
+
+                clientmac = p.addr2
+                isnew = not clientmac in self.clients
+                client = self.get_client(clientmac)
+                if isnew: client.state = ClientState.STARTED
+                verdict = client.get_verdict()
+                client.handle_data(p)
+                if isnew or client.get_verdict() != verdict:
+                    results.send((clientmac, client.epoch, client.get_verdict(), client.verdict_evidence,
+                        client.verdict_detail))
+
+            if idle:
+                time.sleep(0.001)
 
-            if decrypt_ccmp(p, "\x00" * 16).startswith("\xAA\xAA\x03\x00\x00\x00"):
-                client.mark_allzero_key(p)
-            client.check_pairwise_reinstall(p)
-            client.track_used_iv(p)
+    def handle_results(self, results):
+        clientmac, epoch, verdict, evidence, detail = results.recv()
+        client = self.get_client(clientmac)
+        # Ignore results of frames that were sent before the current pairwise test started
+        if epoch == client.epoch and client.is_testing_pairwise():
+            client.state = ClientState.GOT_CANARY
+            client.set_verdict(verdict, evidence, detail)
+            self.check_test_done(client)
+
+    def sync_encryption_keys(self):
+        """Get the pairwise keys of all connected clients, e.g. when we (re)attach to hostapd. A
+        full reply ends with "MORE <offset>", and the next stations are then requested from there."""
+        offset = 0
+        while offset is not None:
+            lines = hostapd_command(self.hostapd_ctrl, "GET_TK_ALL %d" % offset).splitlines()
+            offset, more, numkeys = None, None, 0
+            for line in lines:
+                fields = line.split()
+                if len(fields) == 0:
+                    continue
+                elif fields[0] == "MORE":
+                    more = int(fields[1])
+                else:
+                    self.handle_ptk_installed(fields)
+                    numkeys += 1
+            if more is not None:
+                if numkeys == 0:
+                    log(WARNING, "Hostapd returned no keys starting from station %d, some keys are missing" % more)
+                else:
+                    offset = more
+
+    def handle_ptk_installed(self, fields):
+        # Format is "00:11:22:33:44:55 cipher=CCMP gen=2 tk=<hex>"
+        params = hostapd_event_params(fields[1:])
+        if params.get("cipher") != "CCMP" or not "tk" in params: return
+        client = self.get_client(fields[0].lower())
+        client.handle_ptk_installed(params["tk"].decode("hex"), int(params["gen"]))
+
+    def handle_poc_event(self, fields):
+        # Format is "00:11:22:33:44:55 type=msg3 replay=3 keyidx=1 ts=1042.000113"
+        params = hostapd_event_params(fields[1:])
+        event = PocEvent(params["type"], int(params["replay"]), int(params["keyidx"]), float(params["ts"]))
+        mac = fields[0].lower()
+        if mac == self.apmac:
+            log(STATUS, "Hostapd: %s (key index %d)" % (event.type, event.keyidx))
+        else:
+            client = self.get_client(mac)
+            client.handle_poc_event(event)
+            if event.type in ["msg3", "group-msg1"] and client.state != ClientState.FINISHED:
+                self.start_eliciting(client)
+
+    def handle_hostapd_event(self, event):
+        # Unsolicited events start with their level, e.g. "<3>AP-STA-CONNECTED 00:11:22:33:44:55"
+        fields = event[event.find(">") + 1:].split()
+        if len(fields) < 2: return
+        clientmac = fields[1].lower()
+
+        if fields[0] == "AP-STA-POC-EVENT":
+            self.handle_poc_event(fields[1:])
+        elif fields[0] == "AP-STA-PTK-INSTALLED":
+            self.handle_ptk_installed(fields[1:])
+        elif fields[0] == "AP-STA-CONNECTED":
+            if clientmac in self.clients:
+                client = self.clients[clientmac]
+                self.reset_pairwise(client)
+                self.start_client(client)
+            else:
+                self.get_client(clientmac)
+        elif fields[0] == "AP-STA-DISCONNECTED" and clientmac in self.clients:
+            client = self.clients[clientmac]
+            client.cancel_timers()
+            client.forget_encryption_key()
+            log(STATUS, "%s: disconnected (%s)" % (client.mac, client.report()))
 
     def handle_eth (self):
-        p = self.sock_eth.recv()
-        if p == None or not Ether in p: return
+        # Only frames that pass the byte-level filter are dissected using scapy
+        if self.eth_ring is not None:
+            for block in self.eth_ring.blocks():
+                for start, end, timestamp, pkttype in block:
+                    if pkttype == socket.PACKET_OUTGOING: continue
+                    if not ether_prefilter(self.eth_ring.buf, start, end, self.eth_arp_ips): continue
+                    self.process_eth_raw(buffer_slice(self.eth_ring.buf, start, end), timestamp)
+            return
+
+        data, sa_ll = self.sock_eth.ins.recvfrom(MTU)
+        if sa_ll[2] == socket.PACKET_OUTGOING: return
+        if not ether_prefilter(data, 0, len(data), self.eth_arp_ips): return
+        self.process_eth_raw(data, time.time())
+
+    def process_eth_raw(self, data, timestamp):
+        p = Ether(data)
+        p.time = timestamp
         self.process_eth_rx(p)
+        if self.capture is not None:
+            client = self.clients.get(p.src)
+            self.capture.put(LINKTYPE_ETHERNET, data, timestamp, client.capture_state() if client else None)
 
     def process_eth_rx(self, p):
         self.dhcp.reply(p)
@@ -228,8 +1068,24 @@ class DetectKRACK():
         if not clientmac in self.clients: return
         client = self.clients[clientmac]
 
+        # Replies to the replayed broadcast ARP requests, and to the requests that elicit traffic
+        if ARP in p and p[ARP].op == 2:
+            if p[ARP].pdst == self.group_ip:
+                client.groupkey_handle_reply()
+            elif p[ARP].pdst == self.dhcp.server_ip:
+                client.groupkey_handle_canary()
+            self.check_test_done(client)
+
     def stop(self):
+        self.report()
         log(STATUS, "Closing hostapd and cleaning up ...")
+        for process in self.processes:
+            process.terminate()
+        # Let them write their queued log records and captured frames
+        for process in self.processes:
+            process.join(5)
+        if self.count_pipeline_drops() > 0:
+            log(WARNING, "Dropped %d frames because the worker processes were behind" % self.count_pipeline_drops())
         if self.hostapd:
             self.hostapd.terminate()
             self.hostapd.wait()
@@ -237,6 +1093,16 @@ class DetectKRACK():
             self.sock_mon.close()
         if self.sock_eth:
             self.sock_eth.close()
+        if self.eth_ring:
+            self.eth_ring.close()
+        if self.dhcp:
+            self.dhcp.leases.save()
+        if self.store:
+            self.store.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        if self.capture:
+            self.capture.close()
 
 
 
@@ -244,6 +1110,63 @@ def cleanup():
     attack.stop()
 
 if __name__ == '__main__':
-    attack = DetectKRACK()
+    parser = argparse.ArgumentParser(description="Test clients for key reinstallation vulnerabilities.")
+    parser.add_argument("--iface", default="wlo1", help="Wireless interface to run the Access Point on.")
+    parser.add_argument("--replay", metavar="PCAP", help="Analyse a recorded monitor-mode capture instead of using live radios.")
+    parser.add_argument("--apmac", help="MAC address of the Access Point (required when replaying a capture).")
+    parser.add_argument("--rx-ring", action="store_true", help="Receive frames using memory-mapped TPACKET_V3 rings.")
+    parser.add_argument("--workers", type=int, default=0, help="Number of worker processes that analyse monitor frames (default: analyse them in this process).")
+    parser.add_argument("--interval", type=float, default=HANDSHAKE_TRANSMIT_INTERVAL, help="Seconds between retransmitted handshake messages (default: %(default)s).")
+    parser.add_argument("--error-rate", type=float, default=PATCHED_ERROR_RATE, help="Accepted chance of marking a vulnerable client as patched (default: %(default)s).")
+    parser.add_argument("--elicit-rate", type=float, default=ELICIT_RATE, help="Unicast ARP requests per second sent to a client after each handshake message, to make it send data frames (default: %(default)s, 0 to disable).")
+    parser.add_argument("--subnet", default="192.168.100.0/24", help="Subnet that clients get an IP address in, the highest address is used by the AP (default: %(default)s).")
+    parser.add_argument("--leases", metavar="FILE", help="Save the DHCP leases to this file, so clients keep their IP address when the script is restarted.")
+    parser.add_argument("--store", metavar="DB", help="Record all verdicts, and the evidence for them, in this SQLite database.")
+    parser.add_argument("--tag", help="Tag the recorded verdicts with this label, e.g. the firmware version of the tested devices.")
+    parser.add_argument("--skip-known", action="store_true", help="Skip the tests that a client already has a verdict for in the database (with the same tag).")
+    parser.add_argument("--query", metavar="MAC", nargs="?", const="", help="Show the recorded verdicts, optionally of one client and with the given tag, and exit.")
+    parser.add_argument("--since", metavar="TIME", type=parse_time, help="With --query, only show verdicts recorded at or after this local time (YYYY-MM-DD[ HH:MM[:SS]], or seconds since the epoch).")
+    parser.add_argument("--until", metavar="TIME", type=parse_time, help="With --query, only show verdicts recorded before this local time.")
+    parser.add_argument("--metrics", metavar="ADDR", help="Serve Prometheus metrics on this Unix socket path, or TCP [host:]port (default host is localhost).")
+    parser.add_argument("--profile", action="store_true", help="Start the sampling profiler immediately. It can also be started using the /profile/start path of the metrics endpoint.")
+    parser.add_argument("--capture", metavar="PREFIX", help="Save the frames of clients, annotated with their test state, to pcapng files starting with this prefix.")
+    parser.add_argument("--capture-size", metavar="MB", type=int, default=100, help="Start a new capture file when the current one is larger than this (default %(default)s MB).")
+    parser.add_argument("--capture-age", metavar="SECONDS", type=int, default=3600, help="Start a new capture file when the current one is older than this (default %(default)s seconds).")
+    parser.add_argument("--debug", action="store_true", help="Show debug output.")
+    parser.add_argument("--log-json", metavar="FILE", help="Also append all output as JSON Lines to this file.")
+    args = parser.parse_args()
+    if args.debug:
+        libwifi.global_log_level = DEBUG
+    if args.log_json:
+        libwifi.set_log_json(args.log_json)
+    HANDSHAKE_TRANSMIT_INTERVAL = args.interval
+    PATCHED_ERROR_RATE = args.error_rate
+    ELICIT_RATE = args.elicit_rate
+    if args.replay and args.apmac is None:
+        parser.error("--apmac is required when replaying a capture")
+    if (args.skip_known or args.query is not None) and args.store is None:
+        parser.error("--skip-known and --query require --store")
+    if (args.since is not None or args.until is not None) and args.query is None:
+        parser.error("--since and --until require --query")
+
+    store = VerdictStore(args.store, args.tag) if args.store else None
+    if args.query is not None:
+        for record in store.query(mac=args.query.lower() or None, tag=args.tag, since=args.since, until=args.until):
+            timestamp, mac, tag, test, verdict, iv, seq, generation, detail = record
+            evidence = " (IV=%d, seq=%d)" % (iv, seq) if iv is not None else ""
+            print "%s %s [%s] %s %s%s: %s" % (datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S"),
+                mac, tag or "", test, verdict, evidence, detail)
+        quit(0)
+
+    if args.profile and args.metrics is None:
+        parser.error("--profile requires --metrics")
+
+    capture = PcapngWriter(args.capture, args.capture_size << 20, args.capture_age,
+        annotate=format_capture_state) if args.capture else None
+    attack = DetectKRACK(args.iface, args.apmac, args.rx_ring, args.workers, args.subnet, args.leases,
+        store, args.skip_known, args.metrics, args.profile, capture)
     atexit.register(cleanup)
-    attack.run()
+    if args.replay:
+        attack.replay(args.replay)
+    else:
+        attack.run()
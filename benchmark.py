@@ -0,0 +1,292 @@
+from scapy.all import *
+import logging
+logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
+from libwifi import *
+from Cryptodome.Cipher import AES
+import os, sys, json, time, argparse, subprocess, resource
+import libwifi
+import KrackAttack
+from KrackAttack import DetectKRACK, ClientState
+
+# Offline benchmarks of the detection hot path. Synthetic CCMP-protected frames of many clients are
+# processed exactly like frames captured on the monitor interface, without needing a radio or hostapd.
+# Results are written as JSON, and can be compared against an earlier run to detect regressions.
+
+APMAC = "02:00:00:00:00:01"
+PLAINTEXT = LLC_SNAP_PREFIX + "\x08\x00" + "E" * 40
+IV_PATTERNS = ["none", "periodic", "mixed"]
+
+
+#### Synthetic frames ####
+
+def client_mac(index):
+    return raw2mac("\x02\x00" + struct.pack(">I", index))
+
+def build_frames(clientmac, key, ivs, seqs):
+    """Raw RadioTap frames of a client, encrypted using CCMP with the given packet numbers. The
+    keystream of all frames is computed using a single AES call. The MIC is not valid, since the
+    detector never verifies it."""
+    nonce_prefix = "\x00" + mac2raw(clientmac)
+    numblocks = (len(PLAINTEXT) + 15) // 16
+    counters = "".join("\x01" + nonce_prefix + struct.pack(">Q", iv)[2:] + struct.pack(">H", i)
+        for iv in ivs for i in range(1, numblocks + 1))
+    keystream = AES.new(key, AES.MODE_ECB).encrypt(counters)
+
+    # RadioTap header without fields, followed by a data frame sent to the AP with the Protected flag
+    header = struct.pack("<BBHI", 0, 0, 8, 0) + "\x08\x41\x00\x00" + mac2raw(APMAC) + mac2raw(clientmac) + mac2raw(APMAC)
+    frames = []
+    for i, (iv, seq) in enumerate(zip(ivs, seqs)):
+        pn = struct.pack("<Q", iv)
+        ccmp = pn[0:2] + "\x00\x20" + pn[2:6]
+        stream = keystream[16 * numblocks * i:16 * numblocks * i + len(PLAINTEXT)]
+        frames.append(header + struct.pack("<H", seq << 4) + ccmp + strxor(PLAINTEXT, stream) + "\x00" * 8)
+    return frames
+
+def generate_traffic(numclients, duration, rate, pattern, reset_interval, start=1000.0):
+    """Frames of all clients, as (time, raw frame) tuples ordered by time. Vulnerable clients reset
+    their packet number to 1 every reset_interval seconds, patched clients never do."""
+    traffic = []
+    keys = dict()
+    for index in range(numclients):
+        clientmac = client_mac(index)
+        vulnerable = pattern == "periodic" or (pattern == "mixed" and index % 2 == 0)
+        keys[clientmac] = os.urandom(16)
+
+        # Spread the frames of clients so they don't all arrive at the same time
+        offset = (index % 97) / 97.0 / rate
+        times, ivs, seqs = [], [], []
+        iv = 1
+        for i in range(int(duration * rate)):
+            t = i / float(rate)
+            if vulnerable and i > 0 and int(t / reset_interval) != int((t - 1.0 / rate) / reset_interval):
+                iv = 1
+            times.append(start + t + offset)
+            ivs.append(iv)
+            seqs.append(i % 4096)
+            iv += 1
+
+        frames = build_frames(clientmac, keys[clientmac], ivs, seqs)
+        traffic.extend(zip(times, frames))
+
+    traffic.sort(key=lambda frame: frame[0])
+    return traffic, keys
+
+
+#### Measurements ####
+
+def rss_bytes():
+    """Current resident memory of this process"""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(function, items, repeat, setup=None):
+    """Returns the highest number of items per second that function processed over several runs. If
+    given, setup creates fresh state for each run, which is passed to function but not timed."""
+    best = 0
+    for i in range(repeat):
+        args = [setup()] if setup is not None else []
+        start = time.time()
+        function(items, *args)
+        elapsed = time.time() - start
+        best = max(best, len(items) / elapsed if elapsed > 0 else 0)
+    return best
+
+def percentile(values, fraction):
+    if len(values) == 0: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class ReplaySocket():
+    """Stands in for the monitor socket of DetectKRACK, and returns the generated frames one by one"""
+    def __init__(self, traffic):
+        self.traffic = traffic
+        self.index = 0
+        self.ring = None
+
+    def recv_raw(self):
+        timestamp, frame = self.traffic[self.index]
+        self.index += 1
+        return radiotap_parse_raw(frame, timestamp)
+
+def bench_functions(traffic, keys, repeat):
+    """Frames per second of the individual functions that process a frame"""
+    frames = [radiotap_parse_raw(frame, timestamp) for timestamp, frame in traffic]
+    # The crypto functions always use the key of the first client, which doesn't influence their speed
+    clientmac = frames[0].addr2
+    key = keys[clientmac]
+    crypto = CcmpContext(key, clientmac)
+
+    def parse(traffic):
+        for timestamp, frame in traffic: radiotap_parse_raw(frame, timestamp)
+    def get_iv(frames):
+        for p in frames: dot11_get_iv(p)
+    def get_seqnum(frames):
+        for p in frames: dot11_get_seqnum(p)
+    def probe(frames):
+        for p in frames: ccmp_probe(key, p)
+    def context_probe(frames):
+        for p in frames: crypto.probe(p)
+    def decrypt(frames):
+        for p in frames: decrypt_ccmp(p, key)
+    def context_decrypt(frames):
+        for p in frames: crypto.decrypt(p)
+    def new_collections():
+        return dict((p.a2, IvCollection()) for p in frames)
+    def iv_collection(frames, collections):
+        for p in frames:
+            ivs = collections[p.a2]
+            ivs.is_iv_reused(p)
+            ivs.track_used_iv(p)
+    def new_clients():
+        clients = dict((p.a2, ClientState(p.addr2)) for p in frames)
+        for client in clients.values():
+            client.state = ClientState.STARTED
+        return clients
+    def handle_data(frames, clients):
+        for p in frames:
+            clients[p.a2].handle_data(p)
+
+    return {
+        "radiotap_parse_raw": measure(parse, traffic, repeat),
+        "dot11_get_iv": measure(get_iv, frames, repeat),
+        "dot11_get_seqnum": measure(get_seqnum, frames, repeat),
+        "ccmp_probe": measure(probe, frames, repeat),
+        "CcmpContext.probe": measure(context_probe, frames, repeat),
+        "decrypt_ccmp": measure(decrypt, frames, repeat),
+        "CcmpContext.decrypt": measure(context_decrypt, frames, repeat),
+        "IvCollection": measure(iv_collection, frames, repeat, new_collections),
+        "ClientState.handle_data": measure(handle_data, frames, repeat, new_clients),
+    }
+
+def bench_handle_mon(traffic, numclients, samples=10):
+    """End-to-end throughput of handle_mon, the memory used by the client states, and how long it
+    took (on the clock of the frames) until each client got a verdict"""
+    attack = DetectKRACK("bench0", APMAC)
+    attack.sock_mon = ReplaySocket(traffic)
+    # Timers run on the clock of the frames, like when replaying a capture
+    now = [traffic[0][0]]
+    attack.loop = EventLoop(clock=lambda: now[0])
+
+    first_seen = dict()
+    latencies, frames_needed = [], []
+    def record_verdict(client, verdict, evidence, detail):
+        timestamp = evidence[0] if evidence is not None else now[0]
+        latencies.append(timestamp - first_seen[mac2raw(client.mac)][0])
+        frames_needed.append(first_seen[mac2raw(client.mac)][1])
+    attack.record_verdict = record_verdict
+
+    rss_start = rss_bytes()
+    memory = []
+    interval = max(1, len(traffic) // samples)
+    start = time.time()
+    for i in range(len(traffic)):
+        now[0] = traffic[i][0]
+        # Count the frames of each client to also express the latency in frames
+        seen = first_seen.setdefault(traffic[i][1][18:24], [now[0], 0])
+        seen[1] += 1
+
+        attack.loop.run_timers()
+        attack.handle_mon()
+        if (i + 1) % interval == 0:
+            memory.append((i + 1, rss_bytes() - rss_start))
+    elapsed = time.time() - start
+
+    verdicts = [client.verdicts[ClientState.TEST_4WAY] for client in attack.clients.values()]
+    return {
+        "clients": numclients,
+        "frames": len(traffic),
+        "handle_mon_fps": len(traffic) / elapsed,
+        "memory": {
+            "bytes_per_client": float(memory[-1][1]) / numclients,
+            # Growth after all clients were seen, which should stay close to zero on long runs
+            "growth_bytes": memory[-1][1] - memory[0][1],
+            "samples": memory,
+        },
+        "verdicts": dict((name, verdicts.count(verdict)) for verdict, name in enumerate(ClientState.VERDICT_NAMES)),
+        "latency": {
+            "median_seconds": percentile(latencies, 0.5),
+            "p95_seconds": percentile(latencies, 0.95),
+            "max_seconds": max(latencies) if len(latencies) > 0 else None,
+            "median_frames": percentile(frames_needed, 0.5),
+        },
+    }
+
+
+#### Reporting ####
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.realpath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def throughput_metrics(results):
+    """All frames-per-second metrics of a result, by name"""
+    metrics = dict(("micro/" + name, fps) for name, fps in results["micro"].items())
+    for run in results["runs"]:
+        metrics["handle_mon/%d clients" % run["clients"]] = run["handle_mon_fps"]
+    return metrics
+
+def compare(results, baseline, threshold):
+    """Print the change of every throughput metric. Returns False if one dropped below threshold
+    times its baseline value."""
+    ok = True
+    current, previous = throughput_metrics(results), throughput_metrics(baseline)
+    for name in sorted(current):
+        if not name in previous: continue
+        ratio = current[name] / previous[name]
+        slower = ratio < threshold
+        ok = ok and not slower
+        log(ERROR if slower else STATUS, "%-36s %12.0f -> %12.0f frames/s (%+.1f%%)", name, previous[name],
+            current[name], (ratio - 1) * 100)
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the detection of key reinstallations on synthetic traffic.")
+    parser.add_argument("--clients", default="1,100,10000", help="Comma-separated numbers of simulated clients (default: %(default)s).")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of traffic per client, enough for a patched verdict without Msg3 events (default: %(default)s).")
+    parser.add_argument("--rate", type=float, default=5, help="Frames per second sent by each client (default: %(default)s).")
+    parser.add_argument("--pattern", choices=IV_PATTERNS, default="mixed", help="Which clients reset their IV: none, all (periodic), or every other client (mixed).")
+    parser.add_argument("--reset-interval", type=float, default=KrackAttack.HANDSHAKE_TRANSMIT_INTERVAL, help="Seconds between IV resets of vulnerable clients (default: %(default)s).")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions of each function benchmark, the best one is reported (default: %(default)s).")
+    parser.add_argument("--output", metavar="JSON", help="Write the results to this file.")
+    parser.add_argument("--compare", metavar="JSON", help="Compare the throughput against the results of an earlier run.")
+    parser.add_argument("--threshold", type=float, default=0.9, help="With --compare, fail if a throughput drops below this fraction of the earlier one (default: %(default)s).")
+    args = parser.parse_args()
+    # Don't let the terminal output of verdicts influence the measurements
+    libwifi.global_log_level = STATUS
+
+    results = {
+        "time": time.time(),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "runs": [],
+    }
+
+    # The functions are measured on the same traffic, independent of the numbers of clients to simulate
+    traffic, keys = generate_traffic(100, args.duration, args.rate, args.pattern, args.reset_interval)
+    results["micro"] = bench_functions(traffic, keys, args.repeat)
+    for name, fps in sorted(results["micro"].items()):
+        log(STATUS, "%-36s %12.0f frames/s", name, fps)
+
+    for numclients in [int(num) for num in args.clients.split(",")]:
+        traffic, keys = generate_traffic(numclients, args.duration, args.rate, args.pattern, args.reset_interval)
+        run = bench_handle_mon(traffic, numclients)
+        results["runs"].append(run)
+        log(STATUS, "handle_mon with %d clients: %.0f frames/s, %.0f bytes per client, median verdict after %s seconds (%s)",
+            numclients, run["handle_mon_fps"], run["memory"]["bytes_per_client"], run["latency"]["median_seconds"],
+            ", ".join("%d %s" % (count, name) for name, count in sorted(run["verdicts"].items())))
+        del traffic
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            if not compare(results, json.load(fp), args.threshold):
+                quit(1)
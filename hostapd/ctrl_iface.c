@@ -2289,29 +2289,152 @@ static int hostapd_ctrl_driver_flags(struct hostapd_iface *iface, char *buf,
 
 
 #ifdef KRACK_TEST_CLIENT
-static int hostapd_get_tk(struct hostapd_data *hapd, const char *txtaddr, char *buf, size_t buflen)
+static struct wpa_state_machine * hostapd_get_sta_wpa_sm(struct hostapd_data *hapd, const char *txtaddr)
 {
 	u8 addr[ETH_ALEN];
 	struct sta_info *sta;
+
+	if (hwaddr_aton(txtaddr, addr)) return NULL;
+	sta = ap_get_sta(hapd, addr);
+	if (!sta) return NULL;
+
+	return sta->wpa_sm;
+}
+
+
+static int hostapd_get_tk(struct hostapd_data *hapd, const char *txtaddr, char *buf, size_t buflen)
+{
+	struct wpa_state_machine *sm;
 	int klen;
 	int res;
 
 	wpa_printf(MSG_DEBUG, "CTRL_IFACE GET_TK %s", txtaddr);
 
-	if (hwaddr_aton(txtaddr, addr)) return -1;
-	sta = ap_get_sta(hapd, addr);
-	if (!sta) return -1;
-
-	if (sta->wpa_sm == NULL) return -1;
-	klen = wpa_cipher_key_len(sta->wpa_sm->pairwise);
+	sm = hostapd_get_sta_wpa_sm(hapd, txtaddr);
+	if (sm == NULL) return -1;
+	klen = wpa_cipher_key_len(sm->pairwise);
 	if (klen <= 0) return -1;
 
-	res = wpa_snprintf_hex(buf, buflen, sta->wpa_sm->PTK.tk, klen);
+	res = wpa_snprintf_hex(buf, buflen, sm->PTK.tk, klen);
 	buf[res++] = '\n';
 	buf[res] = '\0';
 
 	return res;
 }
+
+
+/* Handles "GET_TK_ALL [offset]". One line per station with an installed
+ * pairwise key, formatted the same as the AP-STA-PTK-INSTALLED event, so a
+ * client can resync its keys. The first offset stations are skipped. When the
+ * reply is full, it ends with "MORE <offset>", and the remaining stations are
+ * returned by requesting that offset. */
+static int hostapd_get_tk_all(struct hostapd_data *hapd, const char *cmd, char *buf, size_t buflen)
+{
+	struct sta_info *sta;
+	/* Keep room for the MORE line at the end of the buffer */
+	char *pos = buf, *end = buf + buflen - 32;
+	int index = 0, offset = 0;
+	int klen;
+	int res;
+
+	wpa_printf(MSG_DEBUG, "CTRL_IFACE GET_TK_ALL%s", cmd);
+	if (*cmd == ' ')
+		offset = atoi(cmd + 1);
+
+	for (sta = hapd->sta_list; sta; sta = sta->next) {
+		if (sta->wpa_sm == NULL || !sta->wpa_sm->pairwise_set)
+			continue;
+		klen = wpa_cipher_key_len(sta->wpa_sm->pairwise);
+		if (klen <= 0)
+			continue;
+		if (index++ < offset)
+			continue;
+
+		/* Each line needs room for the key in hex and a newline */
+		res = os_snprintf(pos, end - pos, MACSTR " cipher=%s gen=%u tk=",
+				  MAC2STR(sta->addr),
+				  wpa_cipher_txt(sta->wpa_sm->pairwise),
+				  sta->wpa_sm->ptk_generation);
+		if (os_snprintf_error(end - pos, res) ||
+		    end - pos - res < 2 * klen + 2) {
+			*pos = '\0';
+			pos += os_snprintf(pos, buf + buflen - pos, "MORE %d\n", index - 1);
+			break;
+		}
+		res += wpa_snprintf_hex(pos + res, end - pos - res,
+					sta->wpa_sm->PTK.tk, klen);
+		pos += res;
+		*pos++ = '\n';
+		*pos = '\0';
+	}
+
+	return pos - buf;
+}
+
+
+/* Handles "START_4WAY_TESTS <addr>", "TEST_TPTK <addr>", "TEST_TPTK_RAND <addr>",
+ * "START_GROUP_TESTS <addr>" and "STOP_TESTS <addr>", which only change the test
+ * executed against the given station. The TPTK tests also switch the station back
+ * to the 4-way handshake test, and STOP_TESTS lets it complete all handshakes. */
+static int hostapd_poc_sta_test(struct hostapd_data *hapd, const char *cmd)
+{
+	struct wpa_state_machine *sm;
+	const char *txtaddr;
+
+	wpa_printf(MSG_DEBUG, "CTRL_IFACE %s", cmd);
+
+	txtaddr = os_strchr(cmd, ' ');
+	if (txtaddr == NULL) return -1;
+	sm = hostapd_get_sta_wpa_sm(hapd, txtaddr + 1);
+	if (sm == NULL) return -1;
+
+	if (os_strncmp(cmd, "START_4WAY_TESTS ", 17) == 0)
+		poc_sta_start_testing_4way_handshake(sm);
+	else if (os_strncmp(cmd, "TEST_TPTK ", 10) == 0)
+		poc_sta_test_tptk_construction(sm, TEST_TPTK_REPLAY);
+	else if (os_strncmp(cmd, "TEST_TPTK_RAND ", 15) == 0)
+		poc_sta_test_tptk_construction(sm, TEST_TPTK_RAND);
+	else if (os_strncmp(cmd, "START_GROUP_TESTS ", 18) == 0)
+		poc_sta_start_testing_group_handshake(sm);
+	else if (os_strncmp(cmd, "STOP_TESTS ", 11) == 0)
+		poc_sta_stop_testing(sm);
+	else
+		return -1;
+
+	return 0;
+}
+
+
+/* Handles "SET_RETRANSMIT_INTERVAL <addr> <ms>", where 0 restores the default */
+static int hostapd_poc_sta_set_retransmit(struct hostapd_data *hapd, const char *cmd)
+{
+	struct wpa_state_machine *sm;
+	const char *pos;
+
+	wpa_printf(MSG_DEBUG, "CTRL_IFACE SET_RETRANSMIT_INTERVAL %s", cmd);
+
+	pos = os_strchr(cmd, ' ');
+	if (pos == NULL) return -1;
+	sm = hostapd_get_sta_wpa_sm(hapd, cmd);
+	if (sm == NULL) return -1;
+
+	poc_sta_set_retransmit_interval(sm, atoi(pos + 1));
+	return 0;
+}
+
+
+/* Handles "SET_GROUP_REKEY_INTERVAL <ms>", the period of the group key handshakes
+ * once any station executes the group key tests */
+static int hostapd_poc_set_group_rekey(struct hostapd_data *hapd, const char *cmd)
+{
+	int interval_ms = atoi(cmd);
+
+	wpa_printf(MSG_DEBUG, "CTRL_IFACE SET_GROUP_REKEY_INTERVAL %s", cmd);
+
+	if (interval_ms <= 0) return -1;
+	poc_set_group_rekey_interval(hapd->wpa_auth, interval_ms);
+	return 0;
+}
 #endif
 
 
@@ -2586,8 +2709,24 @@ static int hostapd_ctrl_iface_receive_process(struct hostapd_data *hapd,
 		poc_test_tptk_construction(hapd->wpa_auth, TEST_TPTK_RAND);
 	} else if (os_strcmp(buf, "START_GROUP_TESTS") == 0) {
 		poc_start_testing_group_handshake(hapd->wpa_auth);
+	} else if (os_strncmp(buf, "START_4WAY_TESTS ", 17) == 0 ||
+		   os_strncmp(buf, "TEST_TPTK ", 10) == 0 ||
+		   os_strncmp(buf, "TEST_TPTK_RAND ", 15) == 0 ||
+		   os_strncmp(buf, "START_GROUP_TESTS ", 18) == 0 ||
+		   os_strncmp(buf, "STOP_TESTS ", 11) == 0) {
+		if (hostapd_poc_sta_test(hapd, buf) < 0)
+			reply_len = -1;
+	} else if (os_strncmp(buf, "SET_RETRANSMIT_INTERVAL ", 24) == 0) {
+		if (hostapd_poc_sta_set_retransmit(hapd, buf + 24) < 0)
+			reply_len = -1;
+	} else if (os_strncmp(buf, "SET_GROUP_REKEY_INTERVAL ", 25) == 0) {
+		if (hostapd_poc_set_group_rekey(hapd, buf + 25) < 0)
+			reply_len = -1;
 	} else if (os_strncmp(buf, "GET_TK ", 7) == 0) {
 		reply_len = hostapd_get_tk(hapd, buf + 7, reply, reply_size);
+	} else if (os_strcmp(buf, "GET_TK_ALL") == 0 ||
+		   os_strncmp(buf, "GET_TK_ALL ", 11) == 0) {
+		reply_len = hostapd_get_tk_all(hapd, buf + 10, reply, reply_size);
 #endif
 	} else {
 		os_memcpy(reply, "UNKNOWN COMMAND\n", 16);
@@ -4,7 +4,10 @@
 # See README for more details.
 from scapy.all import *
 from Cryptodome.Cipher import AES
+from Cryptodome.Util.strxor import strxor
 from datetime import datetime
+import struct, socket, select, time, array, ctypes, ctypes.util, mmap, math, os, collections, json, sys
+import threading, Queue, atexit, heapq, stat
 
 #### Basic output and logging functionality ####
 
@@ -14,22 +17,696 @@ COLORCODES = { "gray"  : "\033[0;37m",
                "orange": "\033[0;33m",
                "red"   : "\033[0;31m" }
 
+LEVEL_NAMES = ["ALL", "DEBUG", "INFO", "STATUS", "WARNING", "ERROR"]
+
+class LogWriter():
+	"""Writes log records to the terminal, and optionally as JSON Lines to a file, in a background
+	thread. This way the caller never waits on terminal I/O, unless max_queue records are already
+	waiting. Threads don't survive a fork, so each process starts its own writer. Once closed, all
+	queued records are written, and later records are written directly. Records are also written
+	directly if the thread died, and failed writes are reported on stderr."""
+	def __init__(self, json_file=None, max_queue=10000):
+		self.queue = Queue.Queue(maxsize=max_queue)
+		self.json_file = json_file
+		self.pid = os.getpid()
+		self.closed = False
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, record):
+		if self.closed or not self.thread.is_alive():
+			self.write([record])
+		else:
+			self.queue.put(record)
+
+	def run(self):
+		while True:
+			# Write all records that are queued using a single write call
+			records = [self.queue.get()]
+			while not self.queue.empty():
+				records.append(self.queue.get_nowait())
+			try:
+				self.write(records)
+			finally:
+				for i in range(len(records)):
+					self.queue.task_done()
+
+	def write(self, records):
+		try:
+			sys.stdout.write("".join(line for timestamp, level, line, msg in records))
+			sys.stdout.flush()
+			if self.json_file is not None:
+				self.json_file.write("".join(json.dumps({"time": timestamp, "level": LEVEL_NAMES[level],
+					"msg": msg.decode("utf-8", "replace") if isinstance(msg, str) else msg}) + "\n"
+					for timestamp, level, line, msg in records))
+				self.json_file.flush()
+		except Exception as ex:
+			try:
+				sys.stderr.write("Failed to write %d log records: %s\n" % (len(records), ex))
+			except Exception:
+				pass
+
+	def close(self):
+		if os.getpid() != self.pid: return
+		if self.thread.is_alive():
+			self.queue.join()
+		self.closed = True
+		# Records that a dead thread left in the queue
+		records = []
+		while not self.queue.empty():
+			records.append(self.queue.get_nowait())
+		if len(records) > 0:
+			self.write(records)
+
 global_log_level = INFO
-def log(level, msg, color=None, showtime=True):
+global_log_json = None
+log_writer = None
+# Formatted timestamp of the last logged second
+log_time_cache = (None, "")
+
+def close_log():
+	"""Write all queued log records. It's registered when this module is imported, so it runs after
+	the exit handlers of scripts that use this module, and what they log is not lost."""
+	if log_writer is not None:
+		log_writer.close()
+
+atexit.register(close_log)
+
+def set_log_json(filename):
+	"""Also write all log messages as JSON Lines to the given file"""
+	global global_log_json
+	global_log_json = open(filename, "a")
+
+def log(level, msg, *args, **kwargs):
+	"""Log a message, which is only formatted with the given arguments when the level is enabled.
+	Supported keyword arguments are color and showtime."""
+	global log_writer, log_time_cache
 	if level < global_log_level: return
+	if len(args) > 0: msg = msg % args
+
+	color = kwargs.get("color")
 	if level == DEBUG   and color is None: color="gray"
 	if level == WARNING and color is None: color="orange"
 	if level == ERROR   and color is None: color="red"
-	print (datetime.now().strftime('[%H:%M:%S] ') if showtime else " "*11) + COLORCODES.get(color, "") + msg + "\033[1;0m"
+
+	now = time.time()
+	if kwargs.get("showtime", True):
+		second = int(now)
+		if log_time_cache[0] != second:
+			log_time_cache = (second, datetime.fromtimestamp(second).strftime('[%H:%M:%S] '))
+		prefix = log_time_cache[1]
+	else:
+		prefix = " "*11
+
+	if log_writer is None or log_writer.pid != os.getpid():
+		log_writer = LogWriter(global_log_json)
+	log_writer.put((now, level, prefix + COLORCODES.get(color, "") + msg + "\033[1;0m\n", msg))
+
+
+#### Event loop ####
+
+class Timer(object):
+	__slots__ = ("when", "tick", "callback", "args", "cancelled", "wheel")
+
+	def __init__(self, when, tick, callback, args, wheel):
+		self.when, self.tick, self.callback, self.args = when, tick, callback, args
+		self.cancelled = False
+		# The wheel that still has to call this timer, or None when it expired or was cancelled
+		self.wheel = wheel
+
+	def cancel(self):
+		self.cancelled = True
+		if self.wheel is not None:
+			self.wheel.remove(self)
+
+class TimerWheel():
+	"""Hashed timer wheel. A timer is stored in the slot of the tick at which it expires, so adding
+	and cancelling a timer takes constant time. Timers that expire more than one rotation in the
+	future stay in their slot until the wheel passes it in the correct rotation. To know how long
+	the event loop can wait, timers are also kept in a heap by their tick. Expired and cancelled
+	timers are only removed from the heap when they reach its top, or when they outnumber the
+	scheduled timers."""
+	def __init__(self, now, resolution=0.01, numslots=1024):
+		self.resolution = resolution
+		self.slots = [set() for i in range(numslots)]
+		self.heap = []
+		self.tick = int(now / resolution)
+		self.count = 0
+
+	def schedule(self, when, callback, *args):
+		# Never schedule a timer in a tick that was already processed
+		tick = int(math.ceil(when / self.resolution))
+		timer = Timer(when, max(tick, self.tick + 1), callback, args, self)
+		self.slots[timer.tick % len(self.slots)].add(timer)
+		heapq.heappush(self.heap, (timer.tick, id(timer), timer))
+		self.count += 1
+		return timer
+
+	def remove(self, timer):
+		self.slots[timer.tick % len(self.slots)].discard(timer)
+		timer.wheel = None
+		self.count -= 1
+		if len(self.heap) > 2 * self.count + 64:
+			self.heap = [entry for entry in self.heap if entry[2].wheel is not None]
+			heapq.heapify(self.heap)
+
+	def advance(self, now):
+		"""Call all timers that expired at time `now`"""
+		# Allow for rounding errors, so a timer expires at the time returned by next_expiry
+		target = int(now / self.resolution + 0.001)
+		if target - self.tick >= len(self.slots):
+			# All slots are passed, so check all timers at once and call them in order
+			slots = self.slots
+		else:
+			slots = [self.slots[tick % len(self.slots)] for tick in range(self.tick + 1, target + 1)]
+		self.tick = max(self.tick, target)
+		if self.count == 0: return
+
+		expired = []
+		for slot in slots:
+			if any(timer.tick <= target for timer in slot):
+				expired += [timer for timer in slot if timer.tick <= target]
+				slot.difference_update(expired)
+		self.count -= len(expired)
+		for timer in expired:
+			timer.wheel = None
+		# A callback may cancel timers that expired at the same time
+		for timer in sorted(expired, key=lambda timer: timer.when):
+			if not timer.cancelled:
+				timer.callback(*timer.args)
+
+	def next_expiry(self):
+		"""Returns the earliest time a timer may expire, or None when no timers are scheduled"""
+		while len(self.heap) > 0 and self.heap[0][2].wheel is None:
+			heapq.heappop(self.heap)
+		if len(self.heap) == 0: return None
+		return self.heap[0][0] * self.resolution
+
+class EventLoop():
+	"""Select-based event loop with reader and writer callbacks and timers. The clock can be replaced,
+	e.g. by the timestamps of captured frames, in which case timers are run using run_timers."""
+	def __init__(self, clock=time.time):
+		self.clock = clock
+		self.readers = dict()
+		self.writers = dict()
+		self.timers = TimerWheel(clock())
+		self.stopped = False
+
+	def add_reader(self, fileobj, callback, *args):
+		self.readers[fileobj] = (callback, args)
+
+	def remove_reader(self, fileobj):
+		self.readers.pop(fileobj, None)
+
+	def add_writer(self, fileobj, callback, *args):
+		self.writers[fileobj] = (callback, args)
+
+	def remove_writer(self, fileobj):
+		self.writers.pop(fileobj, None)
+
+	def call_at(self, when, callback, *args):
+		return self.timers.schedule(when, callback, *args)
+
+	def call_later(self, delay, callback, *args):
+		return self.timers.schedule(self.clock() + delay, callback, *args)
+
+	def run_timers(self, now=None):
+		self.timers.advance(self.clock() if now is None else now)
+
+	def run_once(self):
+		expiry = self.timers.next_expiry()
+		timeout = None if expiry is None else max(0, expiry - self.clock())
+		readable, writable, _ = select.select(list(self.readers.keys()), list(self.writers.keys()), [], timeout)
+		for fileobj in readable:
+			# A callback may have removed other readers
+			if fileobj in self.readers:
+				callback, args = self.readers[fileobj]
+				callback(*args)
+		for fileobj in writable:
+			if fileobj in self.writers:
+				callback, args = self.writers[fileobj]
+				callback(*args)
+		self.run_timers()
+
+	def run_forever(self):
+		self.stopped = False
+		while not self.stopped:
+			self.run_once()
+
+	def stop(self):
+		self.stopped = True
+
+
+#### Metrics and profiling ####
+
+def metric_labels(labels, extra=None):
+	items = sorted(labels.items()) + ([extra] if extra is not None else [])
+	return "{" + ",".join('%s="%s"' % item for item in items) + "}" if len(items) > 0 else ""
+
+class Gauge():
+	"""Value that is either set, or computed by calling function when the metrics are requested"""
+	type = "gauge"
+
+	def __init__(self, name, labels, function=None):
+		self.name, self.labels = name, labels
+		self.function = function
+		self.value = 0
+
+	def set(self, value):
+		self.value = value
+
+	def render(self):
+		value = self.function() if self.function is not None else self.value
+		return ["%s%s %s" % (self.name, metric_labels(self.labels), repr(value))]
+
+class Counter(Gauge):
+	"""Value that only increases, either by calling inc, or as computed by function"""
+	type = "counter"
+
+	def inc(self, amount=1):
+		self.value += amount
+
+class LatencyHistogram():
+	"""Histogram of durations in the style of HdrHistogram: every power of two from one microsecond up
+	to max_seconds is split in SUB_BUCKETS linear buckets. So the relative error of a bucket is at
+	most 1/SUB_BUCKETS over the whole range, and recording a value only increments an array entry."""
+	type = "histogram"
+	SUB_BUCKETS = 8
+
+	def __init__(self, name, labels, max_seconds=64):
+		self.name, self.labels = name, labels
+		octaves = int(math.ceil(math.log(max_seconds * 1e6, 2))) + 1
+		self.counts = array.array('L', [0]) * (octaves * self.SUB_BUCKETS)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, seconds):
+		mantissa, exponent = math.frexp(seconds * 1e6)
+		# The value is mantissa * 2^exponent with 0.5 <= mantissa < 1, so it lies in octave exponent - 1.
+		# Buckets include their upper bound, so a power of two is in the last bucket of the octave below.
+		index = (exponent - 1) * self.SUB_BUCKETS + int(math.ceil((mantissa - 0.5) * 2 * self.SUB_BUCKETS)) - 1
+		# Larger values are only counted in the +Inf bucket
+		if index < len(self.counts):
+			self.counts[max(0, index)] += 1
+		self.sum += seconds
+		self.count += 1
+
+	def upper_bound(self, index):
+		octave, sub = divmod(index, self.SUB_BUCKETS)
+		return (1 << octave) * (1 + (sub + 1.0) / self.SUB_BUCKETS) * 1e-6
+
+	def render(self):
+		# Only buckets up to the highest non-empty one are written, to keep the output short
+		last = max([i for i, count in enumerate(self.counts) if count > 0] or [-1])
+		lines, total = [], 0
+		for i in range(last + 1):
+			total += self.counts[i]
+			lines.append("%s_bucket%s %d" % (self.name, metric_labels(self.labels, ("le", "%.10g" % self.upper_bound(i))), total))
+		lines.append("%s_bucket%s %d" % (self.name, metric_labels(self.labels, ("le", "+Inf")), self.count))
+		lines.append("%s_sum%s %s" % (self.name, metric_labels(self.labels), repr(self.sum)))
+		lines.append("%s_count%s %d" % (self.name, metric_labels(self.labels), self.count))
+		return lines
+
+class MetricsRegistry():
+	"""All metrics of this process, which can be rendered in the Prometheus text format. Requesting a
+	metric with the same name and labels twice returns the same object. Durations of per-frame
+	processing stages should only be measured when enabled is set, since that costs several clock
+	reads per frame."""
+	def __init__(self):
+		self.metrics = collections.OrderedDict()
+		self.help = dict()
+		self.enabled = False
+
+	def get(self, cls, name, help, labels, *args):
+		key = (name, tuple(sorted(labels.items())))
+		if not key in self.metrics:
+			self.metrics[key] = cls(name, labels, *args)
+			self.help[name] = help
+		return self.metrics[key]
+
+	def counter(self, name, help, function=None, **labels):
+		return self.get(Counter, name, help, labels, function)
+
+	def gauge(self, name, help, function=None, **labels):
+		return self.get(Gauge, name, help, labels, function)
+
+	def histogram(self, name, help, **labels):
+		return self.get(LatencyHistogram, name, help, labels)
+
+	def render(self):
+		lines, described = [], set()
+		for metric in sorted(self.metrics.values(), key=lambda metric: metric.name):
+			if not metric.name in described:
+				described.add(metric.name)
+				lines.append("# HELP %s %s" % (metric.name, self.help[metric.name]))
+				lines.append("# TYPE %s %s" % (metric.name, metric.type))
+			lines += metric.render()
+		return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+def stage_histogram(stage):
+	return metrics.histogram("krack_stage_seconds", "Processing time per frame or request of each stage.", stage=stage)
+
+class SamplingProfiler():
+	"""Statistical profiler that can be started and stopped while running. A background thread
+	periodically records the call stack of the profiled thread. Signals are not used, since they
+	would interrupt the select call of the event loop. Stacks are reported in the folded format of
+	flame graph tools: one line per unique stack with the number of times it was sampled."""
+	def __init__(self, interval=0.005):
+		self.interval = interval
+		self.ident = threading.current_thread().ident
+		self.samples = collections.Counter()
+		self.thread = None
+
+	def start(self):
+		if self.thread is not None: return
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.thread = None
+
+	def run(self):
+		# A sampling thread that was stopped exits, even if a new one was started meanwhile
+		while self.thread is threading.current_thread():
+			time.sleep(self.interval)
+			frame = sys._current_frames().get(self.ident)
+			stack = []
+			while frame is not None:
+				code = frame.f_code
+				stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+				frame = frame.f_back
+			self.samples[";".join(reversed(stack))] += 1
+
+	def report(self):
+		return "".join("%s %d\n" % (stack, count) for stack, count in self.samples.most_common())
+
+class MetricsServer():
+	"""Serves the metrics in the Prometheus text format over HTTP on a Unix socket, if the address
+	contains a slash, or else on a TCP [host:]port that defaults to localhost. Connections are
+	non-blocking and handled by the event loop, and closed if they don't send their request and
+	read the reply within timeout seconds. The paths /profile/start and /profile/stop control the
+	sampling profiler, and /profile returns the samples it collected."""
+	def __init__(self, loop, address, registry=metrics, profiler=None, timeout=5):
+		self.loop = loop
+		self.registry = registry
+		self.profiler = profiler if profiler is not None else SamplingProfiler()
+		self.timeout = timeout
+		# Data received or still to be sent, and the timer that closes it, of each connection
+		self.connections = dict()
+		if "/" in address:
+			# Remove the socket of an earlier run, but never another kind of file
+			if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+				os.unlink(address)
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.sock.bind(address)
+		else:
+			host, port = address.rsplit(":", 1) if ":" in address else ("127.0.0.1", address)
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.sock.bind((host, int(port)))
+		self.sock.listen(8)
+		loop.add_reader(self.sock, self.handle_accept)
+
+	def handle_accept(self):
+		conn, addr = self.sock.accept()
+		conn.setblocking(0)
+		timer = self.loop.call_later(self.timeout, self.close_connection, conn)
+		self.connections[conn] = ["", timer]
+		self.loop.add_reader(conn, self.handle_request, conn)
+
+	def handle_request(self, conn):
+		try:
+			data = conn.recv(4096)
+		except socket.error as ex:
+			log(DEBUG, "Failed to receive metrics request: %s", ex)
+			data = ""
+		if data == "":
+			self.close_connection(conn)
+			return
+
+		# Only the request line is used, so wait until it was received
+		self.connections[conn][0] += data
+		request = self.connections[conn][0]
+		if not "\r\n" in request and len(request) < 4096: return
+		self.loop.remove_reader(conn)
+
+		request = request.split("\r\n")[0].split()
+		path = request[1] if len(request) >= 2 else "/metrics"
+		if path == "/profile/start":
+			self.profiler.start()
+			status, body = "200 OK", "Profiler started\n"
+		elif path == "/profile/stop":
+			self.profiler.stop()
+			status, body = "200 OK", "Profiler stopped\n"
+		elif path == "/profile":
+			status, body = "200 OK", self.profiler.report()
+		elif path in ["/", "/metrics"]:
+			status, body = "200 OK", self.registry.render()
+		else:
+			status, body = "404 Not Found", "Unknown path %s\n" % path
+
+		self.connections[conn][0] = "HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n%s" \
+			% (status, len(body), body)
+		self.loop.add_writer(conn, self.handle_write, conn)
+
+	def handle_write(self, conn):
+		try:
+			sent = conn.send(self.connections[conn][0])
+		except socket.error as ex:
+			log(DEBUG, "Failed to send metrics reply: %s", ex)
+			self.close_connection(conn)
+			return
+		self.connections[conn][0] = self.connections[conn][0][sent:]
+		if self.connections[conn][0] == "":
+			self.close_connection(conn)
+
+	def close_connection(self, conn):
+		if not conn in self.connections: return
+		data, timer = self.connections.pop(conn)
+		timer.cancel()
+		self.loop.remove_reader(conn)
+		self.loop.remove_writer(conn)
+		conn.close()
+
+	def close(self):
+		for conn in list(self.connections.keys()):
+			self.close_connection(conn)
+		self.loop.remove_reader(self.sock)
+		self.sock.close()
 
 
 #### Packet Processing Functions ####
 
+def ip2int(ip):
+	return struct.unpack(">I", socket.inet_aton(ip))[0]
+
+def int2ip(ip):
+	return socket.inet_ntoa(struct.pack(">I", ip))
+
+class LeaseManager():
+	"""DHCP leases of a subnet by client MAC address, which can be used like a dictionary from MAC
+	to IP address. Addresses are handed out using a counter and a queue of released addresses, so
+	allocating, renewing, and releasing a lease takes constant time, also for large subnets. All
+	leases have the same duration, so they expire in the order they were last renewed: the expiry
+	queue is a FIFO, where entries of leases that were renewed or released later are skipped. It's
+	compacted when most of its entries are outdated. Addresses that a client declined, because
+	another device uses them, are quarantined for one lease time. The leases can be saved to a JSON
+	file, so a restarted detector gives clients the same address."""
+	def __init__(self, subnet, lease_time=3600, filename=None):
+		network, prefixlen = (subnet.split("/") + ["32"])[:2]
+		mask = (0xFFFFFFFF << (32 - int(prefixlen))) & 0xFFFFFFFF
+		self.network = ip2int(network) & mask
+		self.broadcast = self.network | (~mask & 0xFFFFFFFF)
+		if self.broadcast - self.network < 3:
+			raise ValueError("Subnet %s is too small" % subnet)
+		# The highest usable address is the gateway, which is also our DHCP server
+		self.gateway = int2ip(self.broadcast - 1)
+		self.netmask = int2ip(mask)
+		self.lease_time = lease_time
+		self.filename = filename
+
+		# MAC address to (IP address, expiry time), where addresses are stored as integers
+		self.leases = dict()
+		self.in_use = set([self.broadcast - 1])
+		self.next_unused = self.network + 1
+		self.released = collections.deque()
+		self.expiry_queue = collections.deque()
+		# Declined addresses and when they can be used again, in that order
+		self.quarantine = collections.deque()
+		self.dirty = False
+		if filename is not None and os.path.exists(filename):
+			self.load()
+
+	def __contains__(self, clientmac):
+		return clientmac in self.leases
+
+	def has_key(self, clientmac):
+		# Used by older scapy versions
+		return clientmac in self.leases
+
+	def __getitem__(self, clientmac):
+		return int2ip(self.leases[clientmac][0])
+
+	def __len__(self):
+		return len(self.leases)
+
+	def take_address(self):
+		"""Returns a free address, preferring ones that were never used, or None if there are none"""
+		while self.next_unused < self.broadcast - 1:
+			ip = self.next_unused
+			self.next_unused += 1
+			if not ip in self.in_use:
+				return ip
+		while len(self.released) > 0:
+			ip = self.released.popleft()
+			if not ip in self.in_use:
+				return ip
+		return None
+
+	def reserve(self):
+		"""Permanently take a free address for our own use. Reserved addresses are not saved."""
+		ip = self.take_address()
+		if ip is None:
+			raise ValueError("No free IP address left to reserve")
+		self.in_use.add(ip)
+		return int2ip(ip)
+
+	def add_lease(self, clientmac, ip, expiry):
+		self.leases[clientmac] = (ip, expiry)
+		self.expiry_queue.append((expiry, clientmac))
+		self.dirty = True
+		if len(self.expiry_queue) > 2 * len(self.leases) + 64:
+			# Only keep the entries of the current leases, which are still ordered by expiry
+			self.expiry_queue = collections.deque(entry for entry in self.expiry_queue
+				if self.leases.get(entry[1], (None, None))[1] == entry[0])
+
+	def allocate(self, clientmac, now=None):
+		"""Give the client a new lease, or renew its current one. Returns the IP address of the client,
+		or None when the subnet is full, even after removing expired leases."""
+		now = time.time() if now is None else now
+		if clientmac in self.leases:
+			ip = self.leases[clientmac][0]
+		else:
+			ip = self.take_address()
+			if ip is None:
+				self.expire(now)
+				ip = self.take_address()
+				if ip is None: return None
+			self.in_use.add(ip)
+
+		self.add_lease(clientmac, ip, now + self.lease_time)
+		return int2ip(ip)
+
+	def release(self, clientmac):
+		ip, expiry = self.leases.pop(clientmac)
+		self.in_use.discard(ip)
+		self.released.append(ip)
+		self.dirty = True
+
+	def decline(self, clientmac, now=None):
+		"""The client found that its address is used by another device, so remove its lease without
+		handing out the address again for one lease time"""
+		now = time.time() if now is None else now
+		ip, expiry = self.leases.pop(clientmac)
+		self.quarantine.append((now + self.lease_time, ip))
+		self.dirty = True
+		log(WARNING, "%s: declined %s, which seems to be used by another device", clientmac, int2ip(ip))
+
+	def expire(self, now=None):
+		"""Release all leases that expired, and return the MAC addresses of their clients. Also ends
+		the quarantine of declined addresses."""
+		now = time.time() if now is None else now
+		while len(self.quarantine) > 0 and self.quarantine[0][0] <= now:
+			until, ip = self.quarantine.popleft()
+			self.in_use.discard(ip)
+			self.released.append(ip)
+
+		expired = []
+		while len(self.expiry_queue) > 0 and self.expiry_queue[0][0] <= now:
+			expiry, clientmac = self.expiry_queue.popleft()
+			lease = self.leases.get(clientmac)
+			if lease is not None and lease[1] == expiry:
+				self.release(clientmac)
+				expired.append(clientmac)
+		return expired
+
+	def save(self):
+		"""Atomically write the leases to the snapshot file, if they changed since the last save"""
+		if self.filename is None or not self.dirty: return
+		leases = dict((clientmac, [int2ip(ip), expiry]) for clientmac, (ip, expiry) in self.leases.items())
+		with open(self.filename + ".tmp", "w") as fp:
+			json.dump(leases, fp)
+		os.rename(self.filename + ".tmp", self.filename)
+		self.dirty = False
+
+	def load(self):
+		"""Restore the leases of the snapshot file that did not yet expire and are in our subnet"""
+		try:
+			with open(self.filename) as fp:
+				leases = json.load(fp)
+		except (IOError, ValueError) as ex:
+			log(WARNING, "Failed to load DHCP leases from %s: %s", self.filename, ex)
+			return
+
+		now = time.time()
+		for clientmac, (ip, expiry) in sorted(leases.items(), key=lambda lease: lease[1][1]):
+			ip = ip2int(ip)
+			if expiry <= now or ip <= self.network or ip >= self.broadcast or ip in self.in_use:
+				continue
+			self.in_use.add(ip)
+			self.add_lease(str(clientmac), ip, expiry)
+		log(STATUS, "Restored %d DHCP leases from %s" % (len(self.leases), self.filename))
+
 class DHCP_sock(DHCP_am):
+	# Offset of the BOOTP header and UDP checksum in replies, which have an IP header without options
+	BOOTP_OFFSET = 14 + 20 + 8
+	UDP_CHECKSUM_OFFSET = 14 + 20 + 6
+
 	def __init__(self, **kwargs):
 		self.sock = kwargs.pop("sock")
+		leases = kwargs.pop("leases")
 		self.server_ip = kwargs["gw"]
-		super(DHCP_sock, self).__init__(**kwargs)
+		# Raw replies and their scapy packet by client MAC address, see reply
+		self.reply_cache = dict()
+		super(DHCP_sock, self).__init__(pool=[], **kwargs)
+		# Scapy looks up the address of a client in self.leases, which we allocate in advance
+		self.leases = leases
+
+	def reply(self, req):
+		"""Answer a DHCP request. Only the first reply of each type to a client is built using scapy.
+		Later ones are copies of it, where only the transaction ID and elapsed seconds of the request
+		are patched in, and where the UDP checksum is omitted (which is allowed for IPv4)."""
+		if not self.is_request(req):
+			return
+
+		reqb = req[BOOTP]
+		msgtypes = [opt[1] for opt in req[DHCP].options if isinstance(opt, tuple) and opt[0] == "message-type"] \
+			if DHCP in req else []
+		# Don't reply to a DHCPDECLINE or DHCPRELEASE
+		if 4 in msgtypes or 7 in msgtypes:
+			if req.src in self.leases:
+				self.remove_client(req.src, declined=4 in msgtypes)
+			return
+		if self.leases.allocate(req.src) is None:
+			log(WARNING, "%s: no free IP address left to give to the client" % req.src)
+			return
+
+		# Fields of the request that determine the reply, apart from the patched ones
+		key = (tuple(msgtypes), reqb.flags, reqb.ciaddr, reqb.giaddr, reqb.chaddr)
+		cache = self.reply_cache.setdefault(req.src, dict())
+		if not key in cache:
+			reply = self.make_reply(req)
+			cache[key] = (bytearray(str(reply)), reply)
+		frame, reply = cache[key]
+
+		struct.pack_into(">IH", frame, self.BOOTP_OFFSET + 4, reqb.xid, reqb.secs)
+		struct.pack_into(">H", frame, self.UDP_CHECKSUM_OFFSET, 0)
+		self.send_reply(str(frame))
+		self.print_reply(req, reply)
 
 	def make_reply(self, req):
 		rep = super(DHCP_sock, self).make_reply(req)
@@ -51,16 +728,39 @@ class DHCP_sock(DHCP_am):
 	def print_reply(self, req, reply):
 		log(STATUS, "%s: DHCP reply %s to %s" % (reply.getlayer(Ether).dst, reply.getlayer(BOOTP).yiaddr, reply.dst), color="green")
 
-	def remove_client(self, clientmac):
-		clientip = self.leases[clientmac]
-		self.pool.append(clientip)
-		del self.leases[clientmac]
+	def remove_client(self, clientmac, declined=False):
+		if declined:
+			self.leases.decline(clientmac)
+		else:
+			self.leases.release(clientmac)
+		self.reply_cache.pop(clientmac, None)
+
+	def expire_leases(self):
+		for clientmac in self.leases.expire():
+			self.reply_cache.pop(clientmac, None)
+			log(DEBUG, "%s: DHCP lease expired", clientmac)
 
 class ARP_sock(ARP_am):
 	def __init__(self, **kwargs):
 		self.sock = kwargs.pop("sock")
+		# Raw reply by client MAC address, and the request fields it was built for
+		self.reply_cache = dict()
 		super(ARP_am, self).__init__(**kwargs)
 
+	def reply(self, req):
+		"""Answer an ARP request, using the cached reply to the client if it asked the same before"""
+		if not self.is_request(req):
+			return
+
+		arp = req[ARP]
+		key = (arp.hwsrc, arp.psrc)
+		cached = self.reply_cache.get(req.src)
+		if cached is None or cached[0] != key:
+			reply = self.make_reply(req)
+			cached = self.reply_cache[req.src] = (key, str(reply), reply)
+		self.send_reply(cached[1])
+		self.print_reply(req, cached[2])
+
 	def send_reply(self, reply):
 		self.sock.send(reply, **self.optsend)
 
@@ -73,57 +773,291 @@ class ARP_sock(ARP_am):
 class MitmSocket(L2Socket):
 	def __init__(self, **kwargs):
 		super(MitmSocket, self).__init__(**kwargs)
+		self.ring = None
+		self.capture_latency = stage_histogram("capture")
+		self.parse_latency = stage_histogram("parse")
 
 	def send(self, p):
 		# Hack: set the More Data flag so we can detect injected frames (and so clients stay awake longer)
 		p[Dot11].FCfield |= 0x20
 		L2Socket.send(self, RadioTap()/p)
 
-	def _strip_fcs(self, p):
-		# Scapy can't handle the optional Frame Check Sequence (FCS) field automatically
-		if p[RadioTap].present & 2 != 0:
-			rawframe = str(p[RadioTap])
-			pos = 8
-			while ord(rawframe[pos - 1]) & 0x80 != 0: pos += 4
+	def recv(self, x=MTU):
+		p = L2Socket.recv(self, x)
+		if p == None: return None
+		return radiotap_to_dot11(p)
 
-			# If the TSFT field is present, it must be 8-bytes aligned
-			if p[RadioTap].present & 1 != 0:
-				pos += (8 - (pos % 8))
-				pos += 8
+	def recv_raw(self, x=MTU):
+		"""Receive a frame without dissecting it using scapy. Returns a Dot11Raw or None."""
+		if not metrics.enabled:
+			data, sa_ll = self.ins.recvfrom(x)
+			if sa_ll[2] == socket.PACKET_OUTGOING: return None
+			return radiotap_parse_raw(data, time.time())
 
-			# Remove FCS if present
-			if ord(rawframe[pos]) & 0x10 != 0:
-				return Dot11(str(p[Dot11])[:-4])
+		start = time.time()
+		data, sa_ll = self.ins.recvfrom(x)
+		received = time.time()
+		self.capture_latency.observe(received - start)
+		if sa_ll[2] == socket.PACKET_OUTGOING: return None
+		p = radiotap_parse_raw(data, received)
+		self.parse_latency.observe(time.time() - received)
+		return p
 
-		return p[Dot11]
+	def enable_rx_ring(self, **kwargs):
+		"""Receive frames through a memory-mapped ring, see PacketRing and recv_raw_ring"""
+		self.ring = PacketRing(self.ins, **kwargs)
 
-	def recv(self, x=MTU):
-		p = L2Socket.recv(self, x)
-		if p == None or not Dot11 in p: return None
+	def recv_raw_ring(self):
+		"""Generator over all frames that are ready in the RX ring, parsed as Dot11Raw frames. The
+		payload of a frame points into the ring, so it must be processed before requesting the
+		next frame: the kernel may reuse the memory afterwards."""
+		for block in self.ring.blocks():
+			for start, end, timestamp, pkttype in block:
+				if pkttype == socket.PACKET_OUTGOING: continue
+				# Frames are already in memory, so there is no per-frame capture time
+				if metrics.enabled:
+					parsing = time.time()
+					p = radiotap_parse_raw(self.ring.buf, timestamp, start, end)
+					self.parse_latency.observe(time.time() - parsing)
+				else:
+					p = radiotap_parse_raw(self.ring.buf, timestamp, start, end)
+				if p is not None:
+					yield p
+
+	def send_batch(self, frames):
+		"""Send several Dot11 frames using a single system call, see send"""
+		raw = []
+		for p in frames:
+			p[Dot11].FCfield |= 0x20
+			raw.append(str(RadioTap()/p))
+		return sendmmsg(self.outs, raw)
 
-		# Hack: ignore frames that we just injected and are echoed back by the kernel
-		if p[Dot11].FCfield & 0x20 != 0:
-			return None
+	def get_drops(self):
+		"""Number of frames the kernel dropped since the previous call, because they were not received
+		fast enough. The first two fields of struct tpacket_stats(_v3) are the packets and drops."""
+		stats = self.ins.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12)
+		return struct.unpack_from("II", stats)[1]
 
-		# Strip the FCS if present, and drop the RadioTap header
-		return self._strip_fcs(p)
+	def set_data_filter(self, bssid):
+		"""Let the kernel drop all frames except protected data frames sent to the given BSSID.
+		Frames that were queued before the filter was attached can still be received."""
+		attach_bpf_program(self.ins, dot11_data_filter(bssid))
 
 	def close(self):
 		super(MitmSocket, self).close()
+		if self.ring:
+			self.ring.close()
+
+# Constants of linux/if_packet.h
+SOL_PACKET, PACKET_RX_RING, PACKET_STATISTICS, PACKET_VERSION, TPACKET_V3 = 263, 5, 6, 10, 2
+TP_STATUS_KERNEL, TP_STATUS_USER = 0, 1
+
+class PacketRing():
+	"""Memory-mapped TPACKET_V3 receive ring of a packet socket. The kernel fills whole blocks with
+	frames, and they are handed out as offsets into the mapped ring without copying them. So one
+	wakeup handles a full block of frames, instead of doing a select and recv call for each frame.
+	The socket stays readable (for select) while a block is ready."""
+	def __init__(self, sock, block_size=1 << 20, block_nr=16, frame_size=1 << 11, timeout_ms=10):
+		self.sock = sock
+		self.block_size = block_size
+		self.block_nr = block_nr
+		self.current = 0
+
+		sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+		# struct tpacket_req3: block size/count, frame size/count, block timeout, priv size, features
+		req = struct.pack("7I", block_size, block_nr, frame_size, block_size * block_nr // frame_size,
+			timeout_ms, 0, 0)
+		sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+		self.buf = mmap.mmap(sock.fileno(), block_size * block_nr, mmap.MAP_SHARED,
+			mmap.PROT_READ | mmap.PROT_WRITE)
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def blocks(self):
+		"""Generator over all blocks that are ready. Each block is a list of (start, end, timestamp,
+		pkttype) tuples, where buf[start:end] is the captured frame. A block is given back to the
+		kernel when the next block is requested, or when the generator is closed."""
+		while True:
+			# struct tpacket_block_desc: version, offset_to_priv, then struct tpacket_hdr_v1
+			base = self.current * self.block_size
+			status, num_pkts, offset = struct.unpack_from("3I", self.buf, base + 8)
+			if status & TP_STATUS_USER == 0:
+				return
+
+			frames = []
+			pos = base + offset
+			for i in range(num_pkts):
+				# struct tpacket3_hdr, followed by struct sockaddr_ll at offset 48
+				next_offset, sec, nsec, snaplen = struct.unpack_from("4I", self.buf, pos)
+				mac = struct.unpack_from("H", self.buf, pos + 24)[0]
+				pkttype = struct.unpack_from("B", self.buf, pos + 58)[0]
+				frames.append((pos + mac, pos + mac + snaplen, sec + nsec / 1e9, pkttype))
+				pos += next_offset
+
+			try:
+				yield frames
+			finally:
+				struct.pack_into("I", self.buf, base + 8, TP_STATUS_KERNEL)
+				self.current = (self.current + 1) % self.block_nr
+
+	def close(self):
+		self.buf.close()
+
+class SharedFrameQueue():
+	"""Single-producer single-consumer queue of frames in shared memory, to pass frames between
+	processes created using fork without pickling them. Frames are stored as records (length,
+	timestamp, frame) in a ring buffer. The head and tail are byte counters in the first bytes of
+	the shared memory. When the queue is full, frames are dropped so the producer never blocks. The
+	number of dropped frames is also kept in shared memory, so the consumer can report it."""
+	HEADER_SIZE = 64
+	WRAP_MARKER = 0xFFFFFFFF
+
+	def __init__(self, size=1 << 22):
+		self.size = size
+		self.shm = mmap.mmap(-1, self.HEADER_SIZE + size)
+
+	@property
+	def dropped(self):
+		return struct.unpack_from("Q", self.shm, 16)[0]
+
+	def put(self, buf, start, end, timestamp):
+		"""Copy the frame buf[start:end] into the queue. Returns False if it was dropped."""
+		length = end - start
+		needed = 16 + ((length + 7) & ~7)
+		head, tail = struct.unpack_from("QQ", self.shm, 0)
+
+		# Records are not split, so skip the end of the ring if the record doesn't fit there
+		pos = head % self.size
+		skipped = self.size - pos if pos + needed > self.size else 0
+		if head + skipped + needed - tail > self.size:
+			struct.pack_into("Q", self.shm, 16, self.dropped + 1)
+			return False
+		if skipped:
+			struct.pack_into("I", self.shm, self.HEADER_SIZE + pos, self.WRAP_MARKER)
+			head, pos = head + skipped, 0
+
+		offset = self.HEADER_SIZE + pos
+		struct.pack_into("Id", self.shm, offset, length, timestamp)
+		self.shm[offset + 16:offset + 16 + length] = buffer_slice(buf, start, end)
+		# Only publish the new head after the record has been written
+		struct.pack_into("Q", self.shm, 0, head + needed)
+		return True
+
+	def frames(self):
+		"""Generator over all queued frames as (buf, start, end, timestamp) tuples. The frames are
+		not copied out of shared memory, and they are released when the generator finishes."""
+		head, tail = struct.unpack_from("QQ", self.shm, 0)
+		try:
+			while tail < head:
+				pos = tail % self.size
+				offset = self.HEADER_SIZE + pos
+				length = struct.unpack_from("I", self.shm, offset)[0]
+				if length == self.WRAP_MARKER:
+					tail += self.size - pos
+					continue
+				timestamp = struct.unpack_from("d", self.shm, offset + 8)[0]
+				tail += 16 + ((length + 7) & ~7)
+				yield self.shm, offset + 16, offset + 16 + length, timestamp
+		finally:
+			struct.pack_into("Q", self.shm, 8, tail)
+
+def radiotap_strip_fcs(p):
+	# Scapy can't handle the optional Frame Check Sequence (FCS) field automatically
+	if p[RadioTap].present & 2 != 0:
+		rawframe = str(p[RadioTap])
+		pos = 8
+		while ord(rawframe[pos - 1]) & 0x80 != 0: pos += 4
+
+		# If the TSFT field is present, it must be 8-bytes aligned
+		if p[RadioTap].present & 1 != 0:
+			pos += (8 - (pos % 8))
+			pos += 8
+
+		# Remove FCS if present
+		if ord(rawframe[pos]) & 0x10 != 0:
+			return Dot11(str(p[Dot11])[:-4])
+
+	return p[Dot11]
+
+def radiotap_to_dot11(p):
+	"""Convert a captured monitor frame to the Dot11 frame that is processed by the tests. Works
+	both for frames received on a live monitor interface and for frames read from a capture file."""
+	if not Dot11 in p: return None
+
+	# Hack: ignore frames that we just injected and are echoed back by the kernel
+	if p[Dot11].FCfield & 0x20 != 0:
+		return None
+
+	# Strip the FCS if present, and drop the RadioTap header. The capture time of the frame is
+	# used as the clock of all tests, so explicitly keep it.
+	if RadioTap in p:
+		dot11 = radiotap_strip_fcs(p)
+	else:
+		dot11 = p[Dot11]
+	dot11.time = p.time
+	return dot11
+
+# Classic BPF opcodes, see linux/filter.h
+BPF_LD_B_ABS, BPF_LD_H_IND, BPF_LD_W_IND, BPF_LD_B_IND = 0x30, 0x48, 0x40, 0x50
+BPF_ALU_LSH_K, BPF_ALU_AND_K, BPF_ALU_OR_X = 0x64, 0x54, 0x4c
+BPF_TAX, BPF_JEQ_K, BPF_RET_K = 0x07, 0x15, 0x06
+SO_ATTACH_FILTER = 26
+
+def dot11_data_filter(bssid):
+	"""Classic BPF program, for a monitor socket, that only accepts protected data frames sent to
+	the given BSSID by a station (i.e. without the FromDS flag). The variable-length RadioTap header
+	is skipped. Frames we injected (More Data flag set) are also dropped."""
+	bssid = mac2raw(bssid)
+	bssid_high, bssid_low = struct.unpack(">IH", bssid)
+	# Instructions are (code, jump if true, jump if false, k). Jumps are relative to the next one.
+	return [
+		# X = length of the RadioTap header (little endian)
+		(BPF_LD_B_ABS,   0, 0, 3),
+		(BPF_ALU_LSH_K,  0, 0, 8),
+		(BPF_TAX,        0, 0, 0),
+		(BPF_LD_B_ABS,   0, 0, 2),
+		(BPF_ALU_OR_X,   0, 0, 0),
+		(BPF_TAX,        0, 0, 0),
+		# Frame type must be data
+		(BPF_LD_B_IND,   0, 0, 0),
+		(BPF_ALU_AND_K,  0, 0, 0x0C),
+		(BPF_JEQ_K,      0, 8, 0x08),
+		# Protected flag set, FromDS and More Data flags not set
+		(BPF_LD_B_IND,   0, 0, 1),
+		(BPF_ALU_AND_K,  0, 0, 0x62),
+		(BPF_JEQ_K,      0, 5, 0x40),
+		# Receiver address must be the BSSID
+		(BPF_LD_W_IND,   0, 0, 4),
+		(BPF_JEQ_K,      0, 3, bssid_high),
+		(BPF_LD_H_IND,   0, 0, 8),
+		(BPF_JEQ_K,      0, 1, bssid_low),
+		(BPF_RET_K,      0, 0, 0x40000),
+		(BPF_RET_K,      0, 0, 0),
+	]
+
+def attach_bpf_program(sock, program):
+	bytecode = "".join([struct.pack("HBBI", *instruction) for instruction in program])
+	buf = ctypes.create_string_buffer(bytecode, len(bytecode))
+	fprog = struct.pack("HL", len(program), ctypes.addressof(buf))
+	sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
 
 def dot11_get_seqnum(p):
+	if isinstance(p, Dot11Raw): return p.SC >> 4
 	return p[Dot11].SC >> 4
 
 def dot11_get_iv(p):
 	"""Scapy can't handle Extended IVs, so do this properly ourselves (only works for CCMP)"""
-	if Dot11WEP not in p:
+	if (isinstance(p, Dot11Raw) and p.iv is None) or (not isinstance(p, Dot11Raw) and Dot11WEP not in p):
 		log(ERROR, "INTERNAL ERROR: Requested IV of plaintext frame")
 		return 0
+	elif isinstance(p, Dot11Raw):
+		return p.iv
 
 	wep = p[Dot11WEP]
 	if wep.keyid & 32:
 		# FIXME: Only CCMP is supported (TKIP uses a different IV structure)
-		return ord(wep.iv[0]) + (ord(wep.iv[1]) << 8) + (struct.unpack(">I", wep.wepdata[:4])[0] << 16)
+		return ord(wep.iv[0]) + (ord(wep.iv[1]) << 8) + (struct.unpack("<I", wep.wepdata[:4])[0] << 16)
 	else:
 		return ord(wep.iv[0]) + (ord(wep.iv[1]) << 8) + (ord(wep.iv[2]) << 16)
 
@@ -137,59 +1071,446 @@ def get_tlv_value(p, type):
 	return None
 
 def dot11_get_priority(p):
+	if isinstance(p, Dot11Raw): return p.priority
 	if not Dot11QoS in p: return 0
-	return ord(str(p[Dot11QoS])[0])
+	return ord(str(p[Dot11QoS])[0]) & 0x0F
+
+
+#### Frame templates and batched injection ####
+
+def ether_prefilter(buf, start, end, arp_ips):
+	"""Returns True if the raw Ethernet frame buf[start:end] may be a DHCP request, or is an ARP
+	packet whose target is one of the raw IPv4 addresses in arp_ips. Other frames can be skipped
+	without dissecting them using scapy. The buffer can also be an mmap, e.g. of a PacketRing."""
+	if end - start < 42:
+		return False
+	ethertype, = struct.unpack_from(">H", buf, start + 12)
+	if ethertype == ETH_P_ARP:
+		return buffer_slice(buf, start + 38, start + 42) in arp_ips
+	elif ethertype != ETH_P_IP:
+		return False
+
+	# The UDP destination port comes after the variable-length IP header
+	version_ihl, = struct.unpack_from("B", buf, start + 14)
+	protocol, = struct.unpack_from("B", buf, start + 23)
+	udp = start + 14 + (version_ihl & 0xF) * 4
+	if protocol != 17 or udp + 8 > end:
+		return False
+	return struct.unpack_from(">H", buf, udp + 2)[0] == 67
+
+class ArpTemplate():
+	"""Ether/ARP frame from a fixed sender, built once using scapy. Probes are made by patching
+	the opcode and target fields into a copy of the raw frame. Like scapy, broadcast requests keep
+	an all-zero target hardware address."""
+	def __init__(self, srcmac, srcip):
+		# Give a destination, so scapy doesn't try to resolve one while building the frame
+		self.frame = bytearray(str(Ether(dst="ff:ff:ff:ff:ff:ff", src=srcmac)/ARP(hwsrc=srcmac, psrc=srcip)))
+
+	def build(self, op, dstmac, dstip, broadcast=False):
+		frame = self.frame[:]
+		frame[0:6] = "\xff" * 6 if broadcast else mac2raw(dstmac)
+		struct.pack_into(">H", frame, 20, op)
+		if not broadcast:
+			frame[32:38] = mac2raw(dstmac)
+		frame[38:42] = socket.inet_aton(dstip)
+		return str(frame)
+
+class iovec(ctypes.Structure):
+	_fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+	_fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+		    ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+		    ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+		    ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+	_fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+def sendmmsg(sock, frames):
+	"""Send a list of raw frames using one sendmmsg system call. The socket must be connected or
+	bound to an interface, since no destination addresses are given. Falls back to one send call
+	per frame if the C library doesn't support sendmmsg. Returns the number of frames sent."""
+	if not hasattr(libc, "sendmmsg"):
+		for frame in frames:
+			sock.send(frame)
+		return len(frames)
+
+	num = len(frames)
+	iovs = (iovec * num)()
+	msgs = (mmsghdr * num)()
+	for i, frame in enumerate(frames):
+		# The frames list keeps the strings alive, so pointing into them is safe
+		iovs[i].iov_base = ctypes.cast(ctypes.c_char_p(frame), ctypes.c_void_p)
+		iovs[i].iov_len = len(frame)
+		msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+		msgs[i].msg_hdr.msg_iovlen = 1
+
+	sent = 0
+	while sent < num:
+		res = libc.sendmmsg(sock.fileno(), ctypes.byref(msgs, sent * ctypes.sizeof(mmsghdr)), num - sent, 0)
+		if res < 0:
+			errno = ctypes.get_errno()
+			raise socket.error(errno, os.strerror(errno))
+		sent += res
+	return sent
+
+
+#### Raw frame parsing: fast path that avoids scapy dissection ####
+
+def mac2raw(mac):
+	return mac.replace(':','').decode("hex")
+
+def raw2mac(raw):
+	return ("%02x:%02x:%02x:%02x:%02x:%02x" % struct.unpack("6B", raw))
+
+def buffer_slice(buf, start, end):
+	"""Copy buf[start:end] into a string, where buf is a string, memoryview, or mmap"""
+	if isinstance(buf, memoryview):
+		return buf[start:end].tobytes()
+	return buf[start:end]
+
+class Dot11Raw(object):
+	"""802.11 frame parsed directly from the received buffer, without building scapy layers.
+	Only the fields used by the tests are extracted. Addresses are kept as 6-byte strings, and the
+	payload is only copied out of the buffer when it is requested."""
+	__slots__ = ("buf", "start", "end", "time", "type", "subtype", "FCfield", "a1", "a2", "SC",
+		"priority", "iv", "payload_start", "payload_end")
+
+	@property
+	def addr1(self):
+		return raw2mac(self.a1)
+
+	@property
+	def addr2(self):
+		return raw2mac(self.a2)
+
+	def payload(self):
+		return buffer_slice(self.buf, self.payload_start, self.payload_end)
+
+def dot11_parse_raw(buf, timestamp, start=0, end=None):
+	"""Parse the 802.11 frame in buf[start:end]. Returns None if the frame is too short."""
+	if end is None: end = len(buf)
+	if end - start < 24: return None
+
+	p = Dot11Raw()
+	p.buf, p.start, p.end = buf, start, end
+	p.time = timestamp
+	fc, p.FCfield = struct.unpack_from("BB", buf, start)
+	p.type = (fc >> 2) & 3
+	p.subtype = fc >> 4
+	p.a1 = buffer_slice(buf, start + 4, start + 10)
+	p.a2 = buffer_slice(buf, start + 10, start + 16)
+	p.SC = struct.unpack_from("<H", buf, start + 22)[0]
+
+	# Skip the optional fourth address and parse the QoS control field
+	pos = start + 24
+	if p.FCfield & 3 == 3: pos += 6
+	p.priority = 0
+	if p.type == 2 and p.subtype & 8:
+		if pos + 2 > end: return None
+		p.priority = struct.unpack_from("B", buf, pos)[0] & 0x0F
+		pos += 2
+
+	p.iv = None
+	p.payload_start, p.payload_end = pos, end
+	if p.FCfield & 0x40:
+		# Only CCMP is supported: 8-byte header with Extended IV, and 8-byte MIC
+		if pos + 16 > end: return None
+		pn0, pn1, keyid, pn2 = struct.unpack_from("<BBxBI", buf, pos)
+		if keyid & 0x20:
+			p.iv = pn0 + (pn1 << 8) + (pn2 << 16)
+			p.payload_start, p.payload_end = pos + 8, end - 8
+		else:
+			p.iv = pn0 + (pn1 << 8) + (struct.unpack_from("B", buf, pos + 2)[0] << 16)
+			p.payload_start, p.payload_end = pos + 4, end - 4
+
+	return p
+
+def radiotap_parse_raw(buf, timestamp, start=0, end=None):
+	"""Parse a frame with RadioTap header (as received on a monitor interface). The FCS is
+	stripped if present. Returns None for invalid frames and for frames that we injected."""
+	if end is None: end = len(buf)
+	if end - start < 8: return None
+	rtlen, present = struct.unpack_from("<2xHI", buf, start)
+
+	# Check the Flags field to see whether the frame includes the Frame Check Sequence
+	if present & 2:
+		pos = start + 4
+		while struct.unpack_from("<I", buf, pos)[0] & 0x80000000: pos += 4
+		pos += 4
+		# If the TSFT field is present, it must be 8-bytes aligned
+		if present & 1:
+			pos = start + ((pos - start + 7) & ~7) + 8
+		if pos >= start + rtlen: return None
+		if struct.unpack_from("B", buf, pos)[0] & 0x10:
+			end -= 4
+
+	p = dot11_parse_raw(buf, timestamp, start + rtlen, end)
+
+	# Hack: ignore frames that we just injected and are echoed back by the kernel
+	if p is None or p.FCfield & 0x20 != 0:
+		return None
+
+	return p
+
+
+#### Rotating pcapng capture ####
+
+# Link-layer types of the frames that are captured
+LINKTYPE_ETHERNET, LINKTYPE_IEEE802_11 = 1, 105
+
+def pcapng_block(blocktype, body):
+	body += "\x00" * (-len(body) % 4)
+	return struct.pack("<II", blocktype, len(body) + 12) + body + struct.pack("<I", len(body) + 12)
+
+def pcapng_option(code, value):
+	return struct.pack("<HH", code, len(value)) + value + "\x00" * (-len(value) % 4)
+
+class PcapngWriter():
+	"""Writes frames, each with an optional comment, to pcapng files in a background thread. This
+	way the caller never waits on the disk. A new file is started when the current one is larger
+	than max_size bytes or older than max_age seconds. At most max_queue frames wait to be written:
+	when the thread can't keep up, new frames are dropped and counted instead. If annotate is given,
+	comments are passed to it by the writer thread to format them, so the caller only has to queue
+	the values they are based on."""
+	def __init__(self, prefix, max_size=100 << 20, max_age=3600, max_queue=10000, annotate=None):
+		self.prefix = prefix
+		self.max_size = max_size
+		self.max_age = max_age
+		self.annotate = annotate
+		self.queue = Queue.Queue(maxsize=max_queue)
+		self.dropped = metrics.counter("krack_capture_dropped_total", "Frames that were not saved because the capture writer was behind.")
+		# The interfaces in the written files, identified by their index, which have these link-layer types
+		self.linktypes = [LINKTYPE_IEEE802_11, LINKTYPE_ETHERNET]
+		self.fp = None
+		self.num_files = 0
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def put(self, linktype, data, timestamp, comment=None):
+		"""Queue a frame given as a string, which is dropped if the queue is full. The comment must
+		not change afterwards, since it may be formatted later."""
+		try:
+			self.queue.put_nowait((linktype, data, timestamp, comment))
+		except Queue.Full:
+			self.dropped.inc()
+
+	def run(self):
+		while True:
+			# Write all queued frames using a single write call
+			frames = [self.queue.get()]
+			while not self.queue.empty():
+				frames.append(self.queue.get_nowait())
+			if frames[-1] is None:
+				self.write(frames[:-1])
+				if self.fp is not None:
+					self.fp.close()
+				return
+			self.write(frames)
+
+	def write(self, frames):
+		if len(frames) == 0: return
+		try:
+			if self.fp is None or self.fp.tell() >= self.max_size or time.time() - self.opened >= self.max_age:
+				self.rotate()
+			self.fp.write("".join(self.packet_block(*frame) for frame in frames))
+			self.fp.flush()
+		except IOError as ex:
+			log(ERROR, "Failed to write captured frames: %s", ex)
+			self.dropped.inc(len(frames))
+
+	def rotate(self):
+		if self.fp is not None:
+			self.fp.close()
+		filename = "%s-%s-%d.pcapng" % (self.prefix, time.strftime("%Y%m%d-%H%M%S"), self.num_files)
+		self.fp = open(filename, "wb")
+		self.opened = time.time()
+		self.num_files += 1
+		log(STATUS, "Saving captured frames to %s", filename)
+
+		# Section header with byte-order magic and an unknown section length, and the interfaces
+		self.fp.write(pcapng_block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)))
+		for linktype in self.linktypes:
+			self.fp.write(pcapng_block(1, struct.pack("<HHI", linktype, 0, 0)))
+
+	def packet_block(self, linktype, data, timestamp, comment):
+		# Enhanced packet block with timestamps in microseconds, the default resolution
+		usec = int(round(timestamp * 1000000))
+		body = struct.pack("<IIIII", self.linktypes.index(linktype), usec >> 32, usec & 0xFFFFFFFF, len(data), len(data))
+		body += data + "\x00" * (-len(data) % 4)
+		if comment is not None:
+			if self.annotate is not None:
+				comment = self.annotate(comment)
+			body += pcapng_option(1, comment) + pcapng_option(0, "")
+		return pcapng_block(6, body)
+
+	def close(self):
+		"""Write all queued frames and close the current file"""
+		self.queue.put(None)
+		self.thread.join()
+		if self.dropped.value > 0:
+			log(WARNING, "Dropped %d frames because the capture writer was behind", self.dropped.value)
 
 
 #### Crypto functions and util ####
 
 def get_ccmp_payload(p):
+	if isinstance(p, Dot11Raw): return p.payload()
+
 	# Extract encrypted payload:
 	# - Skip extended IV (4 bytes in total)
 	# - Exclude first 4 bytes of the CCMP MIC (note that last 4 are saved in the WEP ICV field)
 	return str(p.wepdata[4:-4])
 
-def decrypt_ccmp(p, key):
-	payload   = get_ccmp_payload(p)
-	sendermac = p[Dot11].addr2
+def ccmp_nonce(p):
+	sendermac = p.a2 if isinstance(p, Dot11Raw) else mac2raw(p[Dot11].addr2)
 	priority  = dot11_get_priority(p)
 	iv        = dot11_get_iv(p)
-	pn        = struct.pack(">I", iv >> 16) + struct.pack(">H", iv & 0xFFFF)
-	nonce     = chr(priority) + sendermac.replace(':','').decode("hex") + pn
+	pn        = struct.pack(">Q", iv)[2:]
+	return chr(priority) + sendermac + pn
+
+def decrypt_ccmp(p, key):
+	payload   = get_ccmp_payload(p)
+	nonce     = ccmp_nonce(p)
 	cipher    = AES.new(key, AES.MODE_CCM, nonce, mac_len=8)
 	plaintext = cipher.decrypt(payload)
 	return plaintext
 
-class IvInfo():
-	def __init__(self, p):
-		self.iv = dot11_get_iv(p)
-		self.seq = dot11_get_seqnum(p)
-		self.time = p.time
+LLC_SNAP_PREFIX = "\xAA\xAA\x03\x00\x00\x00"
 
-	def is_reused(self, p):
-		"""Return true if frame p reuses an IV and if p is not a retransmitted frame"""
-		iv = dot11_get_iv(p)
-		seq = dot11_get_seqnum(p)
-		return self.iv == iv and self.seq != seq and p.time >= self.time + 1
+def ccmp_get_payload_prefix(p, length):
+	if isinstance(p, Dot11Raw):
+		end = min(p.payload_start + length, p.payload_end)
+		return buffer_slice(p.buf, p.payload_start, end)
+	return str(p.wepdata[4:-4])[:length]
+
+def ccmp_probe_keystream(ecb, nonce, p):
+	# CCM counter block: flags (L - 1 = 1), the 13-byte nonce, and the 2-byte counter
+	keystream = ecb.encrypt("\x01" + nonce + "\x00\x01")
+	prefix = ccmp_get_payload_prefix(p, 6)
+	return len(prefix) == 6 and strxor(prefix, keystream[:6]) == LLC_SNAP_PREFIX
+
+def ccmp_probe(key, p):
+	"""Returns True if the frame seems to be encrypted using the given key, meaning it decrypts to an
+	LLC/SNAP header. Instead of decrypting the full frame, only the first CTR keystream block of CCM
+	is computed."""
+	return ccmp_probe_keystream(AES.new(key, AES.MODE_ECB), ccmp_nonce(p), p)
+
+class CcmpContext():
+	"""Cached CCMP state to decrypt frames sent by one transmitter using one key: the AES key
+	schedule in a reusable ECB cipher, and the nonce prefix of every priority. Decryption runs CCM's
+	CTR mode on top of the ECB cipher, so no cipher object is created per frame. Like decrypt_ccmp,
+	the MIC is not verified. Create a new context when the key changes."""
+	def __init__(self, key, sendermac):
+		self.key = key
+		self.ecb = AES.new(key, AES.MODE_ECB)
+		self.nonce_prefixes = [chr(priority) + mac2raw(sendermac) for priority in range(16)]
+
+	def nonce(self, p):
+		return self.nonce_prefixes[dot11_get_priority(p)] + struct.pack(">Q", dot11_get_iv(p))[2:]
+
+	def probe(self, p):
+		return ccmp_probe_keystream(self.ecb, self.nonce(p), p)
+
+	def decrypt(self, p):
+		payload = get_ccmp_payload(p)
+		prefix = "\x01" + self.nonce(p)
+		numblocks = (len(payload) + 15) // 16
+		counters = "".join([prefix + struct.pack(">H", i) for i in range(1, numblocks + 1)])
+		keystream = self.ecb.encrypt(counters)
+		return strxor(payload, keystream[:len(payload)])
+
+# CCMP and TKIP use 48-bit IVs, so store them in 64 bits also where a C long is only 32 bits. Python
+# 2 has no 'q' typecode, but a double represents all 48-bit integers exactly.
+try:
+	IV_TYPECODE = array.array('q').typecode
+except ValueError:
+	IV_TYPECODE = 'd'
 
 class IvCollection():
-	def __init__(self):
-		self.ivs = dict() # maps IV values to IvInfo objects
+	"""Index of the IVs used by a client. All operations take amortized constant time, and the memory
+	usage is bounded. The highest IV is kept as a running maximum (CCMP uses a single packet number
+	for all TIDs). Two windows of IVs are remembered: the first IVs after a key (re)installation,
+	since these get reused when a key is reinstalled, and the most recent IVs below the highest one,
+	stored in a ring buffer indexed by IV. The first window grows as these IVs are used, and the ring
+	grows to the largest reorder depth observed, i.e. how far below the highest IV a frame arrived,
+	both up to `window` IVs. Older IVs are evicted."""
+	def __init__(self, window=1024, ring_size=16):
+		self.window = window
+		self.initial_ring_size = min(ring_size, window)
+		self.reset()
 
 	def reset(self):
-		self.ivs = dict()
+		self.highest = None
+		self.low_ivs, self.low_seqs, self.low_times = self._new_window(0)
+		self.ring_ivs, self.ring_seqs, self.ring_times = self._new_window(self.initial_ring_size)
+
+	def _new_window(self, size):
+		return array.array(IV_TYPECODE, [-1]) * size, array.array('H', [0]) * size, \
+			array.array('d', [0]) * size
+
+	def _grow_low_window(self, iv):
+		size = min(self.window, max(iv + 1, 2 * len(self.low_ivs)))
+		ivs, seqs, times = self._new_window(size - len(self.low_ivs))
+		self.low_ivs.extend(ivs)
+		self.low_seqs.extend(seqs)
+		self.low_times.extend(times)
+
+	def _grow_ring(self, depth):
+		size = len(self.ring_ivs)
+		while size <= depth:
+			size *= 2
+		size = min(size, self.window)
+		ring_ivs, ring_seqs, ring_times = self._new_window(size)
+		for iv, seq, time in zip(self.ring_ivs, self.ring_seqs, self.ring_times):
+			slot = int(iv) % size
+			if iv > ring_ivs[slot]:
+				ring_ivs[slot], ring_seqs[slot], ring_times[slot] = iv, seq, time
+		self.ring_ivs, self.ring_seqs, self.ring_times = ring_ivs, ring_seqs, ring_times
 
 	def track_used_iv(self, p):
 		iv = dot11_get_iv(p)
-		self.ivs[iv] = IvInfo(p)
+		seq = dot11_get_seqnum(p)
+		if iv < self.window:
+			if iv >= len(self.low_ivs):
+				self._grow_low_window(iv)
+			self.low_ivs[iv], self.low_seqs[iv], self.low_times[iv] = iv, seq, p.time
+		# Every IV is stored in the ring. The ring only grows for reordered IVs above the first
+		# window, since lower IVs are also found in the first window, and a larger drop below the
+		# highest IV is treated as a key reinstallation instead of reordering.
+		if iv >= self.window and self.highest is not None \
+				and len(self.ring_ivs) <= self.highest - iv < self.window:
+			self._grow_ring(self.highest - iv)
+		slot = iv % len(self.ring_ivs)
+		self.ring_ivs[slot], self.ring_seqs[slot], self.ring_times[slot] = iv, seq, p.time
+		if self.highest is None or iv > self.highest:
+			self.highest = iv
 
 	def is_iv_reused(self, p):
 		"""Returns True if this is an *observed* IV reuse and not just a retransmission"""
 		iv = dot11_get_iv(p)
-		return iv in self.ivs and self.ivs[iv].is_reused(p)
+		if iv < self.window:
+			if iv >= len(self.low_ivs):
+				return False
+			ivs, seqs, times, slot = self.low_ivs, self.low_seqs, self.low_times, iv
+		else:
+			ivs, seqs, times, slot = self.ring_ivs, self.ring_seqs, self.ring_times, iv % len(self.ring_ivs)
+		if ivs[slot] != iv:
+			return False
+
+		# Same IV but different sequence number, and not a quick retransmission
+		return seqs[slot] != dot11_get_seqnum(p) and p.time >= times[slot] + 1
+
+	def memory_size(self):
+		"""Bytes used by the IV windows"""
+		return sum(a.itemsize * len(a) for a in [self.low_ivs, self.low_seqs, self.low_times,
+			self.ring_ivs, self.ring_seqs, self.ring_times])
 
 	def is_new_iv(self, p):
 		"""Returns True if the IV in this frame is higher than all previously observed ones"""
 		iv = dot11_get_iv(p)
-		if len(self.ivs) == 0: return True
-		return iv > max(self.ivs.keys())
+		return self.highest is None or iv > self.highest
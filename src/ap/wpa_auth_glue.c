@@ -161,6 +161,50 @@ static void hostapd_wpa_auth_psk_failure_report(void *ctx, const u8 *addr)
 }
 
 
+#ifdef KRACK_TEST_CLIENT
+static void hostapd_wpa_auth_ptk_installed(void *ctx, const u8 *addr,
+					   int cipher, const u8 *tk,
+					   size_t tk_len,
+					   unsigned int generation)
+{
+	struct hostapd_data *hapd = ctx;
+	char txt[2 * WPA_TK_MAX_LEN + 1];
+
+	/* Only sent to monitors of the control interface, so the key is never
+	 * written to stdout or the log. wpa_msg_ctrl() still formats the message
+	 * when nobody is attached, so skip it in that case. */
+	if (dl_list_empty(&hapd->ctrl_dst))
+		return;
+	wpa_snprintf_hex(txt, sizeof(txt), tk, tk_len);
+	wpa_msg_ctrl(hapd->msg_ctx, MSG_INFO, AP_STA_PTK_INSTALLED MACSTR
+		     " cipher=%s gen=%u tk=%s", MAC2STR(addr),
+		     wpa_cipher_txt(cipher), generation, txt);
+}
+
+
+static void hostapd_wpa_auth_poc_event(void *ctx, const u8 *addr,
+				       const char *type,
+				       const u8 *replay_counter, int keyidx)
+{
+	struct hostapd_data *hapd = ctx;
+	struct os_reltime now;
+
+	/* Only sent to monitors of the control interface, so a test event never
+	 * costs a write to stdout. wpa_msg_ctrl() still formats the message when
+	 * nobody is attached, so skip it in that case. The timestamp is a
+	 * monotonic clock. */
+	if (dl_list_empty(&hapd->ctrl_dst))
+		return;
+	os_get_reltime(&now);
+	wpa_msg_ctrl(hapd->msg_ctx, MSG_INFO, AP_STA_POC_EVENT MACSTR
+		     " type=%s replay=%llu keyidx=%d ts=%ld.%06ld",
+		     MAC2STR(addr), type, replay_counter ?
+		     (unsigned long long) WPA_GET_BE64(replay_counter) : 0ULL,
+		     keyidx, (long) now.sec, (long) now.usec);
+}
+#endif
+
+
 static void hostapd_wpa_auth_set_eapol(void *ctx, const u8 *addr,
 				       wpa_eapol_variable var, int value)
 {
@@ -609,6 +653,10 @@ int hostapd_setup_wpa(struct hostapd_data *hapd)
 	cb.disconnect = hostapd_wpa_auth_disconnect;
 	cb.mic_failure_report = hostapd_wpa_auth_mic_failure_report;
 	cb.psk_failure_report = hostapd_wpa_auth_psk_failure_report;
+#ifdef KRACK_TEST_CLIENT
+	cb.ptk_installed = hostapd_wpa_auth_ptk_installed;
+	cb.poc_event = hostapd_wpa_auth_poc_event;
+#endif
 	cb.set_eapol = hostapd_wpa_auth_set_eapol;
 	cb.get_eapol = hostapd_wpa_auth_get_eapol;
 	cb.get_psk = hostapd_wpa_auth_get_psk;
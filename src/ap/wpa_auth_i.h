@@ -65,6 +65,12 @@ struct wpa_state_machine {
 	struct wpa_ptk PTK;
 	Boolean PTK_valid;
 	Boolean pairwise_set;
+#ifdef KRACK_TEST_CLIENT
+	unsigned int ptk_generation; /* number of times the PTK was installed */
+	int poc_testing_handshake; /* handshake being tested against this STA */
+	int poc_testing_tptk_construction;
+	unsigned int poc_retransmit_ms; /* EAPOL-Key retransmit interval, 0 for default */
+#endif
 	int keycount;
 	Boolean Pair;
 	struct wpa_key_replay_counter {
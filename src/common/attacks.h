@@ -12,4 +12,17 @@
 // against the client.
 #define KRACK_TEST_CLIENT
 
+// Control interface event sent each time a pairwise key is (re)installed
+#define AP_STA_PTK_INSTALLED "AP-STA-PTK-INSTALLED "
+// Control interface event sent for each action of the handshake tests
+#define AP_STA_POC_EVENT "AP-STA-POC-EVENT "
+
+// Types of the test events
+#define POC_EVENT_MSG3			"msg3"
+#define POC_EVENT_EARLY_INSTALL		"early-install"
+#define POC_EVENT_TPTK_MSG1		"tptk-msg1"
+#define POC_EVENT_TPTK_RAND_MSG1	"tptk-rand-msg1"
+#define POC_EVENT_GROUP_START		"group-start"
+#define POC_EVENT_GROUP_MSG1		"group-msg1"
+
 #endif // ATTACKS_H_
@@ -0,0 +1,81 @@
+import os, unittest
+from libwifi import *
+
+def drain(queue):
+    return [(buffer_slice(buf, start, end), timestamp) for buf, start, end, timestamp in queue.frames()]
+
+class TestSharedFrameQueue(unittest.TestCase):
+    def test_fifo(self):
+        queue = SharedFrameQueue(size=1024)
+        frames = [("frame%d" % i, float(i)) for i in range(10)]
+        for frame, timestamp in frames:
+            self.assertTrue(queue.put(frame, 0, len(frame), timestamp))
+        self.assertEqual(drain(queue), frames)
+        self.assertEqual(drain(queue), [])
+
+    def test_slice_of_buffer(self):
+        queue = SharedFrameQueue(size=1024)
+        buf = memoryview("headerFRAMEtrailer")
+        queue.put(buf, 6, 11, 1.5)
+        self.assertEqual(drain(queue), [("FRAME", 1.5)])
+
+    def test_wraparound(self):
+        # Record sizes that don't divide the ring, so records regularly don't fit at its end
+        queue = SharedFrameQueue(size=256)
+        expected = []
+        for i in range(1000):
+            frame = chr(i % 256) * (1 + i % 50)
+            self.assertTrue(queue.put(frame, 0, len(frame), float(i)))
+            expected.append((frame, float(i)))
+            if i % 2 == 1:
+                self.assertEqual(drain(queue), expected)
+                expected = []
+        self.assertEqual(drain(queue), expected)
+
+    def test_full_queue_drops(self):
+        queue = SharedFrameQueue(size=256)
+        # Each record takes 16 bytes of header and 48 bytes of frame
+        for i in range(4):
+            self.assertTrue(queue.put("A" * 48, 0, 48, float(i)))
+        self.assertFalse(queue.put("B", 0, 1, 4.0))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(len(drain(queue)), 4)
+        self.assertTrue(queue.put("B", 0, 1, 5.0))
+        self.assertEqual(drain(queue), [("B", 5.0)])
+
+    def test_skipped_end_counts_as_used(self):
+        queue = SharedFrameQueue(size=256)
+        for i in range(3):
+            queue.put("A" * 48, 0, 48, float(i))
+        self.assertEqual(len(drain(queue)), 3)
+        # 64 bytes are left at the end of the ring, so this record is stored at its start
+        self.assertTrue(queue.put("C" * 100, 0, 100, 1.0))
+        self.assertEqual(drain(queue), [("C" * 100, 1.0)])
+        # Two records and the 16 bytes skipped at the end of the ring exactly fill it
+        self.assertTrue(queue.put("D" * 100, 0, 100, 2.0))
+        self.assertTrue(queue.put("E" * 100, 0, 100, 3.0))
+        self.assertFalse(queue.put("F", 0, 1, 4.0))
+        self.assertEqual(drain(queue), [("D" * 100, 2.0), ("E" * 100, 3.0)])
+
+    def test_between_processes(self):
+        queue = SharedFrameQueue(size=4096)
+        pid = os.fork()
+        if pid == 0:
+            for i in range(20):
+                queue.put("frame%d" % i, 0, len("frame%d" % i), float(i))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(drain(queue), [("frame%d" % i, float(i)) for i in range(20)])
+
+    def test_drops_between_processes(self):
+        queue = SharedFrameQueue(size=256)
+        pid = os.fork()
+        if pid == 0:
+            for i in range(6):
+                queue.put("A" * 48, 0, 48, float(i))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(queue.dropped, 2)
+
+if __name__ == "__main__":
+    unittest.main()
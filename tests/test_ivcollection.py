@@ -0,0 +1,114 @@
+import struct, unittest
+from libwifi import *
+
+def frame(iv, seq, time):
+    """Parsed CCMP-protected data frame with the given packet number and sequence number"""
+    pn = struct.pack("<Q", iv)
+    raw = "\x08\x41\x00\x00" + "\x02" * 18 + struct.pack("<H", seq << 4) + pn[0:2] + "\x00\x20" + pn[2:6] \
+        + "ciphertext" + "M" * 8
+    return dot11_parse_raw(raw, time)
+
+class TestIvCollection(unittest.TestCase):
+    def track(self, ivs, iv, seq=None, time=0.0):
+        ivs.track_used_iv(frame(iv, iv % 4096 if seq is None else seq, time))
+
+    def test_new_iv(self):
+        ivs = IvCollection()
+        self.assertTrue(ivs.is_new_iv(frame(5, 5, 0.0)))
+        self.track(ivs, 5)
+        self.assertFalse(ivs.is_new_iv(frame(5, 5, 0.0)))
+        self.assertFalse(ivs.is_new_iv(frame(3, 3, 0.0)))
+        self.assertTrue(ivs.is_new_iv(frame(6, 6, 0.0)))
+
+    def test_reuse_and_retransmission(self):
+        ivs = IvCollection()
+        for iv in range(1, 100):
+            self.track(ivs, iv)
+        # Retransmission: same sequence number
+        self.assertFalse(ivs.is_iv_reused(frame(10, 10, 5.0)))
+        # Different sequence number, but too quickly after the original frame
+        self.assertFalse(ivs.is_iv_reused(frame(10, 50, 0.5)))
+        self.assertTrue(ivs.is_iv_reused(frame(10, 50, 5.0)))
+        # Never used
+        self.assertFalse(ivs.is_iv_reused(frame(500, 50, 5.0)))
+        self.assertFalse(ivs.is_iv_reused(frame(5000, 50, 5.0)))
+
+    def test_first_window_is_kept(self):
+        ivs = IvCollection(window=64)
+        for iv in range(1, 10000):
+            self.track(ivs, iv)
+        # IVs after the key installation are remembered, older IVs above the first window are evicted
+        self.assertTrue(ivs.is_iv_reused(frame(1, 50, 5.0)))
+        self.assertTrue(ivs.is_iv_reused(frame(63, 50, 5.0)))
+        self.assertFalse(ivs.is_iv_reused(frame(100, 50, 5.0)))
+        self.assertTrue(ivs.is_iv_reused(frame(9999, 50, 5.0)))
+        self.assertEqual(ivs.highest, 9999)
+
+    def test_ring_wraparound(self):
+        ivs = IvCollection(window=64, ring_size=16)
+        for iv in range(64, 200):
+            self.track(ivs, iv)
+        # Only the last 16 IVs are in the ring, and their slots were reused by newer IVs
+        for iv in range(184, 200):
+            self.assertTrue(ivs.is_iv_reused(frame(iv, 1, 5.0)))
+        for iv in [64, 168, 183]:
+            self.assertFalse(ivs.is_iv_reused(frame(iv, 1, 5.0)))
+        self.assertEqual(len(ivs.ring_ivs), 16)
+
+    def test_ring_grows_to_reorder_depth(self):
+        ivs = IvCollection(window=64, ring_size=16)
+        for iv in range(64, 200):
+            self.track(ivs, iv)
+        # Frame that arrived 20 IVs late: the ring grows, and keeps the IVs it still had
+        self.track(ivs, 179)
+        self.assertEqual(len(ivs.ring_ivs), 32)
+        for iv in [179] + list(range(184, 200)):
+            self.assertTrue(ivs.is_iv_reused(frame(iv, 1, 5.0)))
+        for iv in range(200, 240):
+            self.track(ivs, iv)
+        for iv in range(208, 240):
+            self.assertTrue(ivs.is_iv_reused(frame(iv, 1, 5.0)))
+        self.assertFalse(ivs.is_iv_reused(frame(207, 1, 5.0)))
+
+    def test_ring_size_is_bounded(self):
+        ivs = IvCollection(window=256, ring_size=16)
+        for iv in range(1, 1000):
+            self.track(ivs, iv)
+        # A drop of more than the window is a key reinstallation and not reordering
+        self.track(ivs, 300)
+        self.track(ivs, 1)
+        self.assertEqual(len(ivs.ring_ivs), 16)
+        self.track(ivs, 900)
+        self.assertEqual(len(ivs.ring_ivs), 128)
+        self.track(ivs, 749)
+        self.assertEqual(len(ivs.ring_ivs), 256)
+
+    def test_memory_grows_with_use(self):
+        ivs = IvCollection(window=1024)
+        empty = ivs.memory_size()
+        for iv in range(1, 100):
+            self.track(ivs, iv)
+        self.assertLessEqual(ivs.memory_size(), empty + 2 * 100 * 18)
+        for iv in range(100, 5000):
+            self.track(ivs, iv)
+        self.assertEqual(len(ivs.low_ivs), 1024)
+        self.assertEqual(len(ivs.ring_ivs), 16)
+
+    def test_48bit_ivs(self):
+        ivs = IvCollection()
+        for iv in range(2**47, 2**47 + 10):
+            self.track(ivs, iv)
+        self.assertEqual(ivs.highest, 2**47 + 9)
+        self.assertTrue(ivs.is_iv_reused(frame(2**47 + 5, 1, 5.0)))
+        self.assertFalse(ivs.is_iv_reused(frame(2**47 + 5 + 2**32, 1, 5.0)))
+
+    def test_reset(self):
+        ivs = IvCollection()
+        for iv in range(1, 10):
+            self.track(ivs, iv)
+        ivs.reset()
+        self.assertIsNone(ivs.highest)
+        self.assertFalse(ivs.is_iv_reused(frame(5, 50, 5.0)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os, shutil, tempfile, time, unittest
+import libwifi
+from libwifi import *
+
+class TestLeaseManager(unittest.TestCase):
+    def setUp(self):
+        self.log_level = libwifi.global_log_level
+        libwifi.global_log_level = ERROR
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        libwifi.global_log_level = self.log_level
+        shutil.rmtree(self.tmpdir)
+
+    def test_subnet(self):
+        leases = LeaseManager("192.168.100.0/24")
+        self.assertEqual((leases.gateway, leases.netmask), ("192.168.100.254", "255.255.255.0"))
+        self.assertRaises(ValueError, LeaseManager, "192.168.100.0/31")
+
+    def test_allocate(self):
+        leases = LeaseManager("192.168.100.0/24")
+        self.assertEqual(leases.allocate("aa", now=0), "192.168.100.1")
+        self.assertEqual(leases.allocate("bb", now=0), "192.168.100.2")
+        # Renewing keeps the address
+        self.assertEqual(leases.allocate("aa", now=10), "192.168.100.1")
+        self.assertEqual(leases["bb"], "192.168.100.2")
+        self.assertTrue("aa" in leases and leases.has_key("aa"))
+        self.assertFalse("cc" in leases or leases.has_key("cc"))
+        self.assertEqual(len(leases), 2)
+
+    def test_reserve(self):
+        leases = LeaseManager("192.168.100.0/29")
+        self.assertEqual(leases.reserve(), "192.168.100.1")
+        self.assertEqual(leases.allocate("aa", now=0), "192.168.100.2")
+
+    def test_full_subnet(self):
+        # Addresses .1 to .5 are free, .6 is the gateway
+        leases = LeaseManager("192.168.100.0/29", lease_time=100)
+        for i in range(5):
+            self.assertIsNotNone(leases.allocate("client%d" % i, now=i))
+        self.assertIsNone(leases.allocate("late", now=50))
+        # Once the first lease expired, its address is handed out again
+        self.assertEqual(leases.allocate("late", now=100.5), "192.168.100.1")
+        self.assertFalse("client0" in leases)
+
+    def test_release(self):
+        leases = LeaseManager("192.168.100.0/29")
+        for i in range(5):
+            leases.allocate("client%d" % i, now=0)
+        leases.release("client3")
+        self.assertEqual(leases.allocate("new", now=0), "192.168.100.4")
+        self.assertIsNone(leases.allocate("other", now=0))
+
+    def test_expire(self):
+        leases = LeaseManager("192.168.100.0/24", lease_time=100)
+        leases.allocate("aa", now=0)
+        leases.allocate("bb", now=10)
+        leases.allocate("cc", now=20)
+        # A renewed lease expires later, and a released one doesn't expire again
+        leases.allocate("aa", now=30)
+        leases.release("bb")
+        self.assertEqual(leases.expire(now=99), [])
+        self.assertEqual(leases.expire(now=125), ["cc"])
+        self.assertEqual(leases.expire(now=200), ["aa"])
+        self.assertEqual(len(leases), 0)
+        self.assertEqual(len(leases.expiry_queue), 0)
+
+    def test_expiry_queue_is_compacted(self):
+        leases = LeaseManager("192.168.100.0/24", lease_time=100)
+        for i in range(1000):
+            leases.allocate("aa", now=i)
+        self.assertLess(len(leases.expiry_queue), 100)
+        self.assertEqual(leases.expire(now=1098), [])
+        self.assertEqual(leases.expire(now=1099), ["aa"])
+
+    def test_decline(self):
+        leases = LeaseManager("192.168.100.0/29", lease_time=100)
+        for i in range(5):
+            leases.allocate("client%d" % i, now=0)
+        leases.release("client1")
+        leases.decline("client2", now=10)
+        self.assertFalse("client2" in leases)
+        # The declined address is only handed out again after one lease time
+        self.assertEqual(leases.allocate("client2", now=20), "192.168.100.2")
+        self.assertIsNone(leases.allocate("other", now=20))
+        leases.expire(now=110)
+        self.assertEqual(leases.allocate("other", now=110), "192.168.100.3")
+
+    def test_save_and_load(self):
+        filename = os.path.join(self.tmpdir, "leases.json")
+        leases = LeaseManager("192.168.100.0/24", filename=filename)
+        leases.allocate("aa", now=time.time())
+        leases.allocate("bb", now=time.time())
+        leases.allocate("cc", now=time.time() - 7200)
+        leases.save()
+        self.assertFalse(leases.dirty)
+
+        restored = LeaseManager("192.168.100.0/24", filename=filename)
+        self.assertEqual(sorted(restored.leases.keys()), ["aa", "bb"])
+        self.assertEqual(restored["bb"], leases["bb"])
+        # Restored addresses are not handed out to other clients, but the one of the expired lease is
+        self.assertEqual(restored.allocate("dd"), "192.168.100.3")
+
+        # Leases of another subnet are ignored
+        other = LeaseManager("10.0.0.0/24", filename=filename)
+        self.assertEqual(len(other), 0)
+
+    def test_load_invalid_file(self):
+        filename = os.path.join(self.tmpdir, "leases.json")
+        with open(filename, "w") as fp:
+            fp.write("{invalid")
+        self.assertEqual(len(LeaseManager("192.168.100.0/24", filename=filename)), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import json, os, shutil, StringIO, sys, tempfile, threading, unittest
+from libwifi import *
+
+class BrokenStream():
+    def write(self, data):
+        raise IOError(32, "Broken pipe")
+
+    def flush(self):
+        pass
+
+class TestLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, msg, level=INFO):
+        return (1000.0, level, "[00:00:00] " + msg + "\n", msg)
+
+    def test_write(self):
+        filename = os.path.join(self.tmpdir, "log.json")
+        writer = LogWriter(open(filename, "w"))
+        writer.put(self.record("first"))
+        writer.put(self.record("second", WARNING))
+        writer.close()
+        self.assertEqual(sys.stdout.getvalue(), "[00:00:00] first\n[00:00:00] second\n")
+        with open(filename) as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertEqual(records, [{"time": 1000.0, "level": "INFO", "msg": "first"},
+            {"time": 1000.0, "level": "WARNING", "msg": "second"}])
+
+        # Records are written directly once closed
+        writer.put(self.record("third"))
+        self.assertTrue(sys.stdout.getvalue().endswith("third\n"))
+
+    def test_failed_write(self):
+        sys.stdout = BrokenStream()
+        writer = LogWriter(max_queue=10)
+        # More records than fit in the queue, which must not block once writes fail
+        for i in range(100):
+            writer.put(self.record("message %d" % i))
+        writer.close()
+        self.assertTrue(writer.thread.is_alive())
+        self.assertIn("Broken pipe", sys.stderr.getvalue())
+
+    def test_invalid_utf8(self):
+        filename = os.path.join(self.tmpdir, "log.json")
+        writer = LogWriter(open(filename, "w"))
+        writer.put(self.record("SSID \xff\xfe"))
+        writer.put(self.record("next"))
+        writer.close()
+        with open(filename) as fp:
+            self.assertEqual([json.loads(line)["msg"] for line in fp], [u"SSID \ufffd\ufffd", "next"])
+
+    def test_dead_thread(self):
+        writer = LogWriter(max_queue=1)
+        # Stop the thread, and leave a record in its queue
+        def exit(records):
+            raise SystemExit()
+        writer.write = exit
+        writer.put(self.record("lost"))
+        writer.thread.join()
+        del writer.write
+        writer.queue.put(self.record("queued"))
+        writer.put(self.record("direct"))
+        writer.close()
+        self.assertEqual(sys.stdout.getvalue(), "[00:00:00] direct\n[00:00:00] queued\n")
+
+if __name__ == "__main__":
+    unittest.main()
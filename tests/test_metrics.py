@@ -0,0 +1,121 @@
+import os, shutil, socket, tempfile, unittest
+from libwifi import *
+
+class TestLatencyHistogram(unittest.TestCase):
+    def bucket(self, histogram, seconds):
+        """Index of the only bucket that counts the observed value"""
+        before = list(histogram.counts)
+        histogram.observe(seconds)
+        changed = [i for i, count in enumerate(histogram.counts) if count != before[i]]
+        self.assertLessEqual(len(changed), 1)
+        return changed[0] if changed else None
+
+    def test_bucket_bounds(self):
+        histogram = LatencyHistogram("latency", {})
+        for seconds in [1e-6, 1.1e-6, 3e-6, 4e-6, 4.1e-6, 123e-6, 0.0157, 0.5, 1.0, 1.7, 33.3, 63.9]:
+            index = self.bucket(histogram, seconds)
+            # The value lies in (lower bound, upper bound] of its bucket
+            self.assertLessEqual(seconds, histogram.upper_bound(index) * (1 + 1e-9))
+            if index > 0:
+                self.assertGreater(seconds, histogram.upper_bound(index - 1) * (1 + 1e-9))
+            # The relative error is at most 1/SUB_BUCKETS
+            self.assertLessEqual(histogram.upper_bound(index) / seconds, 1 + 1.0 / LatencyHistogram.SUB_BUCKETS + 1e-9)
+
+    def test_bounds_are_increasing(self):
+        histogram = LatencyHistogram("latency", {})
+        bounds = [histogram.upper_bound(i) for i in range(len(histogram.counts))]
+        self.assertEqual(bounds, sorted(set(bounds)))
+        self.assertGreaterEqual(bounds[-1], 64)
+
+    def test_exact_bounds(self):
+        histogram = LatencyHistogram("latency", {})
+        for index in [0, 7, 8, 9, 100, len(histogram.counts) - 1]:
+            self.assertEqual(self.bucket(histogram, histogram.upper_bound(index)), index)
+
+    def test_small_and_large_values(self):
+        histogram = LatencyHistogram("latency", {}, max_seconds=1)
+        self.assertEqual(self.bucket(histogram, 0), 0)
+        self.assertEqual(self.bucket(histogram, 1e-9), 0)
+        # Values above the highest bucket are only counted in the +Inf bucket
+        self.assertIsNone(self.bucket(histogram, 1000))
+        self.assertEqual(histogram.count, 3)
+
+    def test_render(self):
+        histogram = LatencyHistogram("latency", {"stage": "parse"})
+        for seconds in [2e-6, 2e-6, 5e-6, 100]:
+            histogram.observe(seconds)
+        lines = histogram.render()
+        buckets = [line for line in lines if line.startswith("latency_bucket")]
+        # Buckets are cumulative, and their bound is written exactly
+        self.assertEqual(buckets[-1], 'latency_bucket{stage="parse",le="+Inf"} 4')
+        for line in buckets[:-1]:
+            le = float(line.split('le="')[1].split('"')[0])
+            expected = sum(1 for seconds in [2e-6, 2e-6, 5e-6, 100] if seconds <= le)
+            self.assertEqual(int(line.split()[-1]), expected)
+        self.assertIn('latency_count{stage="parse"} 4', lines)
+
+class TestMetricsServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "metrics.sock")
+        self.now = 1000.0
+        self.loop = EventLoop(clock=lambda: self.now)
+        self.registry = MetricsRegistry()
+        self.registry.counter("frames_total", "Received frames.").inc(3)
+        self.registry.gauge("clients", "Connected clients.", lambda: 2, band="2.4")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, server, request):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+        client.sendall(request)
+        self.loop.run_once()
+        while server.connections:
+            self.loop.run_once()
+        reply = ""
+        while True:
+            data = client.recv(4096)
+            if data == "": break
+            reply += data
+        client.close()
+        return reply
+
+    def test_metrics(self):
+        server = MetricsServer(self.loop, self.path, self.registry)
+        reply = self.fetch(server, "GET /metrics HTTP/1.0\r\n\r\n")
+        header, body = reply.split("\r\n\r\n", 1)
+        self.assertTrue(header.startswith("HTTP/1.0 200 OK"))
+        self.assertIn("Content-Length: %d" % len(body), header)
+        self.assertEqual(body, "# HELP clients Connected clients.\n# TYPE clients gauge\nclients{band=\"2.4\"} 2\n"
+            "# HELP frames_total Received frames.\n# TYPE frames_total counter\nframes_total 3\n")
+        self.assertTrue(self.fetch(server, "GET /unknown HTTP/1.0\r\n\r\n").startswith("HTTP/1.0 404"))
+        server.close()
+
+    def test_idle_connection_is_closed(self):
+        server = MetricsServer(self.loop, self.path, self.registry, timeout=5)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+        client.sendall("GET /met")
+        self.loop.run_once()
+        self.loop.run_once()
+        self.assertEqual(len(server.connections), 1)
+        self.now += 6
+        self.loop.run_timers()
+        self.assertEqual(len(server.connections), 0)
+        self.assertEqual(client.recv(4096), "")
+        client.close()
+        server.close()
+
+    def test_socket_path(self):
+        # The socket of an earlier run is replaced, but never another file
+        MetricsServer(self.loop, self.path, self.registry).close()
+        MetricsServer(self.loop, self.path, self.registry).close()
+        with open(self.path + ".txt", "w") as fp:
+            fp.write("data")
+        self.assertRaises(socket.error, MetricsServer, self.loop, self.path + ".txt", self.registry)
+        self.assertTrue(os.path.exists(self.path + ".txt"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import struct, unittest
+from scapy.all import *
+from libwifi import *
+
+APMAC = "02:00:00:00:00:01"
+CLIENTMAC = "02:00:00:00:00:aa"
+
+def radiotap(fcs=False, tsft=False):
+    """RadioTap header with only the requested fields"""
+    present, fields = 0, ""
+    if tsft:
+        present |= 1
+        fields += struct.pack("<Q", 123456789)
+    if fcs is not None:
+        present |= 2
+        fields += "\x10" if fcs else "\x00"
+    return struct.pack("<BBHI", 0, 0, 8 + len(fields), present) + fields
+
+def dot11(fcfield=0x01, qos=False, tid=0, seq=100, addr4=False):
+    """802.11 data frame header from the client to the AP"""
+    if addr4: fcfield |= 0x03
+    fc = 0x88 if qos else 0x08
+    header = struct.pack("<BBH", fc, fcfield, 0) + mac2raw(APMAC) + mac2raw(CLIENTMAC) + mac2raw(APMAC) \
+        + struct.pack("<H", seq << 4)
+    if addr4: header += mac2raw(CLIENTMAC)
+    if qos: header += struct.pack("<BB", tid, 0)
+    return header
+
+def ccmp_header(pn):
+    pn = struct.pack("<Q", pn)
+    return pn[0:2] + "\x00\x20" + pn[2:6]
+
+class TestRawParsing(unittest.TestCase):
+    """The raw parsers must extract the same fields as scapy"""
+
+    def assertSameAsScapy(self, raw, frame, pn=None):
+        p = radiotap_parse_raw(raw, 5.0)
+        self.assertIsNotNone(p)
+        ref = Dot11(frame)
+        self.assertEqual(p.time, 5.0)
+        self.assertEqual((p.type, p.subtype, p.FCfield), (ref.type, ref.subtype, int(ref.FCfield)))
+        self.assertEqual((p.addr1, p.addr2), (ref.addr1, ref.addr2))
+        self.assertEqual(dot11_get_seqnum(p), dot11_get_seqnum(ref))
+        self.assertEqual(dot11_get_priority(p), dot11_get_priority(ref))
+        if pn is not None:
+            self.assertEqual(dot11_get_iv(p), dot11_get_iv(ref))
+            self.assertEqual(dot11_get_iv(p), pn)
+        return p
+
+    def test_protected(self):
+        for qos in [False, True]:
+            for addr4 in [False, True]:
+                for pn in [1, 0x10203, 0x050403020100]:
+                    frame = dot11(fcfield=0x41, qos=qos, tid=5, seq=pn % 4096, addr4=addr4) + ccmp_header(pn) \
+                        + "ciphertext" + "M" * 8
+                    p = self.assertSameAsScapy(radiotap() + frame, frame, pn)
+                    self.assertEqual(p.payload(), "ciphertext")
+
+    def test_plaintext(self):
+        frame = dot11(qos=True, tid=3) + LLC_SNAP_PREFIX + "\x08\x00" + "E" * 20
+        p = self.assertSameAsScapy(radiotap(fcs=None) + frame, frame)
+        self.assertIsNone(p.iv)
+        self.assertEqual(p.payload(), LLC_SNAP_PREFIX + "\x08\x00" + "E" * 20)
+
+    def test_fcs_is_stripped(self):
+        frame = dot11(fcfield=0x41) + ccmp_header(7) + "ciphertext" + "M" * 8
+        for tsft in [False, True]:
+            p = self.assertSameAsScapy(radiotap(fcs=True, tsft=tsft) + frame + "FCS!", frame, 7)
+            self.assertEqual(p.payload(), "ciphertext")
+
+    def test_buffer_offsets(self):
+        frame = dot11(fcfield=0x41, qos=True, tid=2) + ccmp_header(42) + "ciphertext" + "M" * 8
+        raw = radiotap() + frame
+        buf = memoryview("x" * 10 + raw + "y" * 10)
+        p = radiotap_parse_raw(buf, 1.0, 10, 10 + len(raw))
+        self.assertEqual((p.addr2, p.iv, p.priority), (CLIENTMAC, 42, 2))
+        self.assertEqual(p.payload(), "ciphertext")
+
+    def test_invalid_frames(self):
+        frame = dot11(fcfield=0x41) + ccmp_header(1) + "ciphertext" + "M" * 8
+        self.assertIsNone(radiotap_parse_raw(radiotap()[:6], 1.0))
+        self.assertIsNone(radiotap_parse_raw(radiotap() + frame[:20], 1.0))
+        # Protected flag but no room for the CCMP header and MIC
+        self.assertIsNone(radiotap_parse_raw(radiotap() + dot11(fcfield=0x41) + "short", 1.0))
+        # QoS data frame without QoS control field
+        self.assertIsNone(dot11_parse_raw(dot11(qos=True)[:-2], 1.0))
+        # Frames that we injected have the More Data flag set
+        self.assertIsNone(radiotap_parse_raw(radiotap() + dot11(fcfield=0x61) + frame[24:], 1.0))
+
+class TestArpTemplate(unittest.TestCase):
+    def test_matches_scapy(self):
+        template = ArpTemplate(APMAC, "192.168.100.254")
+        self.assertEqual(template.build(1, CLIENTMAC, "192.168.100.2", broadcast=True),
+            str(Ether(dst="ff:ff:ff:ff:ff:ff", src=APMAC)/ARP(op=1, hwsrc=APMAC, psrc="192.168.100.254",
+                pdst="192.168.100.2")))
+        self.assertEqual(template.build(2, CLIENTMAC, "192.168.100.2"),
+            str(Ether(dst=CLIENTMAC, src=APMAC)/ARP(op=2, hwsrc=APMAC, psrc="192.168.100.254",
+                hwdst=CLIENTMAC, pdst="192.168.100.2")))
+
+if __name__ == "__main__":
+    unittest.main()
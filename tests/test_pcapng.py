@@ -0,0 +1,83 @@
+import glob as globmodule, os, shutil, struct, tempfile, unittest
+from scapy.all import *
+import libwifi
+from libwifi import *
+
+def read_comments(filename):
+    """Comments of the enhanced packet blocks in a pcapng file, or None for frames without one"""
+    with open(filename, "rb") as fp:
+        data = fp.read()
+    comments, pos = [], 0
+    while pos < len(data):
+        blocktype, length = struct.unpack_from("<II", data, pos)
+        if blocktype == 6:
+            caplen = struct.unpack_from("<I", data, pos + 20)[0]
+            options = pos + 28 + caplen + (-caplen % 4)
+            comment = None
+            while options < pos + length - 4:
+                code, optlen = struct.unpack_from("<HH", data, options)
+                if code == 0: break
+                if code == 1: comment = data[options + 4:options + 4 + optlen]
+                options += 4 + optlen + (-optlen % 4)
+            comments.append(comment)
+        pos += length
+    return comments
+
+class TestPcapngWriter(unittest.TestCase):
+    def setUp(self):
+        self.log_level = libwifi.global_log_level
+        libwifi.global_log_level = ERROR
+        self.tmpdir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpdir, "capture")
+
+    def tearDown(self):
+        libwifi.global_log_level = self.log_level
+        shutil.rmtree(self.tmpdir)
+
+    def files(self):
+        return sorted(globmodule.glob(self.prefix + "-*.pcapng"), key=lambda name: int(name.split("-")[-1].split(".")[0]))
+
+    def test_read_back(self):
+        dot11 = str(Dot11(type=2, FCfield=0x01, addr1="02:00:00:00:00:01", addr2="02:00:00:00:00:aa", SC=0x120)/LLC()/SNAP()/IP())
+        ether = str(Ether(dst="ff:ff:ff:ff:ff:ff", src="02:00:00:00:00:01")/ARP(psrc="192.168.100.254"))
+        writer = PcapngWriter(self.prefix)
+        writer.put(LINKTYPE_IEEE802_11, dot11, 1500000000.25, "02:00:00:00:00:aa: 4-way handshake vulnerable")
+        writer.put(LINKTYPE_ETHERNET, ether, 1500000000.5)
+        writer.put(LINKTYPE_IEEE802_11, dot11 + "x", 1500000001.000001, "odd length")
+        writer.close()
+
+        files = self.files()
+        self.assertEqual(len(files), 1)
+        packets = list(PcapReader(files[0]))
+        self.assertEqual([str(p) for p in packets], [dot11, ether, dot11 + "x"])
+        self.assertTrue(Dot11 in packets[0] and Ether in packets[1])
+        self.assertEqual(packets[0].addr2, "02:00:00:00:00:aa")
+        self.assertEqual(packets[1][ARP].psrc, "192.168.100.254")
+        self.assertEqual([p.time for p in packets], [1500000000.25, 1500000000.5, 1500000001.000001])
+        self.assertEqual(read_comments(files[0]), ["02:00:00:00:00:aa: 4-way handshake vulnerable", None, "odd length"])
+
+    def test_annotate(self):
+        writer = PcapngWriter(self.prefix, annotate=lambda state: "%s: %s" % state)
+        writer.put(LINKTYPE_ETHERNET, "\x00" * 60, 1.0, ("02:00:00:00:00:aa", "patched"))
+        writer.put(LINKTYPE_ETHERNET, "\x00" * 60, 2.0)
+        writer.close()
+        self.assertEqual(read_comments(self.files()[0]), ["02:00:00:00:00:aa: patched", None])
+
+    def test_rotate(self):
+        writer = PcapngWriter(self.prefix, max_size=1000)
+        for i in range(50):
+            writer.put(LINKTYPE_ETHERNET, chr(i) * 100, float(i))
+            # Frames are written in batches, so wait on each of them to get predictable files
+            while not writer.queue.empty():
+                time.sleep(0.001)
+        writer.close()
+
+        files = self.files()
+        self.assertGreater(len(files), 3)
+        packets = [p for filename in files for p in PcapReader(filename)]
+        self.assertEqual([str(p) for p in packets], [chr(i) * 100 for i in range(50)])
+        for filename in files[:-1]:
+            self.assertLess(os.path.getsize(filename), 1000 + 200)
+
+if __name__ == "__main__":
+    unittest.main()
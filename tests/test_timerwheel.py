@@ -0,0 +1,99 @@
+import unittest
+from libwifi import *
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(100.0, resolution=0.01, numslots=16)
+        self.called = []
+
+    def schedule(self, when, name=None):
+        return self.wheel.schedule(when, self.called.append, when if name is None else name)
+
+    def test_order(self):
+        for when in [100.5, 100.03, 100.2, 100.021, 100.025]:
+            self.schedule(when)
+        self.wheel.advance(100.02)
+        self.assertEqual(self.called, [])
+        self.wheel.advance(100.03)
+        self.assertEqual(self.called, [100.021, 100.025, 100.03])
+        self.wheel.advance(101.0)
+        self.assertEqual(self.called, [100.021, 100.025, 100.03, 100.2, 100.5])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_later_rotations(self):
+        # With 16 slots of 10 ms, a rotation takes 160 ms
+        for when in [100.05, 100.21, 100.37, 105.0]:
+            self.schedule(when)
+        self.wheel.advance(100.1)
+        self.assertEqual(self.called, [100.05])
+        self.wheel.advance(100.3)
+        self.assertEqual(self.called, [100.05, 100.21])
+        # Skipping more than a rotation checks all slots
+        self.wheel.advance(104.0)
+        self.assertEqual(self.called, [100.05, 100.21, 100.37])
+        self.wheel.advance(105.0)
+        self.assertEqual(self.called, [100.05, 100.21, 100.37, 105.0])
+
+    def test_past_timer_runs_at_next_tick(self):
+        self.wheel.advance(101.0)
+        self.schedule(100.5)
+        self.assertAlmostEqual(self.wheel.next_expiry(), 101.01)
+        self.wheel.advance(101.0)
+        self.assertEqual(self.called, [])
+        self.wheel.advance(self.wheel.next_expiry())
+        self.assertEqual(self.called, [100.5])
+
+    def test_next_expiry(self):
+        self.assertIsNone(self.wheel.next_expiry())
+        self.schedule(103.0)
+        first = self.schedule(102.0)
+        self.assertAlmostEqual(self.wheel.next_expiry(), 102.0)
+        first.cancel()
+        self.assertAlmostEqual(self.wheel.next_expiry(), 103.0)
+        self.wheel.advance(self.wheel.next_expiry())
+        self.assertEqual(self.called, [103.0])
+        self.assertIsNone(self.wheel.next_expiry())
+
+    def test_cancel(self):
+        timers = [self.schedule(100.1 + i * 0.1) for i in range(5)]
+        timers[1].cancel()
+        timers[3].cancel()
+        # Cancelled timers are removed from their slot, and cancelling twice has no effect
+        timers[3].cancel()
+        self.assertEqual(self.wheel.count, 3)
+        self.assertEqual(sum(len(slot) for slot in self.wheel.slots), 3)
+        self.wheel.advance(101.0)
+        self.assertEqual(self.called, [100.1, 100.3, 100.5])
+        # Cancelling a timer that already expired has no effect
+        timers[0].cancel()
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_cancel_from_callback(self):
+        later = self.schedule(100.2)
+        self.wheel.schedule(100.1, later.cancel)
+        self.wheel.advance(101.0)
+        self.assertEqual(self.called, [])
+
+    def test_cancelled_timers_dont_accumulate(self):
+        for i in range(10000):
+            self.schedule(200.0 + i).cancel()
+        self.assertEqual(self.wheel.count, 0)
+        self.assertLess(len(self.wheel.heap), 100)
+        self.assertIsNone(self.wheel.next_expiry())
+
+class TestEventLoopTimers(unittest.TestCase):
+    def test_replaced_clock(self):
+        now = [1000.0]
+        loop = EventLoop(clock=lambda: now[0])
+        called = []
+        def periodic():
+            called.append(now[0])
+            loop.call_later(1, periodic)
+        loop.call_later(1, periodic)
+        for i in range(48):
+            now[0] += 0.125
+            loop.run_timers()
+        self.assertEqual(called, [1001.0, 1002.0, 1003.0, 1004.0, 1005.0, 1006.0])
+
+if __name__ == "__main__":
+    unittest.main()
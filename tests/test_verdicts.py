@@ -0,0 +1,155 @@
+import os, shutil, tempfile, unittest
+import libwifi
+from libwifi import *
+from KrackAttack import DetectKRACK, ClientState, PocEvent, VerdictStore
+
+APMAC = "02:00:00:00:00:01"
+CLIENTMAC = "02:00:00:00:00:aa"
+
+class FakeCtrl():
+    """Records the commands sent to hostapd"""
+    def __init__(self, replies={}):
+        self.commands = []
+        self.replies = replies
+
+    def request(self, cmd):
+        self.commands.append(cmd)
+        return self.replies.get(cmd, "OK")
+
+    def request_async(self, cmd, callback):
+        self.commands.append(cmd)
+        callback("OK")
+
+class TestVerdictStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "verdicts.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_query(self):
+        store = VerdictStore(self.filename, "v1")
+        store.record(100.0, "aa", "4-way handshake", "vulnerable", 1, 20, 2, "IV reuse")
+        store.record(200.0, "bb", "4-way handshake", "patched")
+        store.record(300.0, "aa", "group key handshake", "patched")
+        self.assertEqual(store.query(mac="aa")[0], (100.0, "aa", "v1", "4-way handshake", "vulnerable", 1, 20, 2, "IV reuse"))
+        self.assertEqual([row[1] for row in store.query()], ["aa", "bb", "aa"])
+        self.assertEqual([row[0] for row in store.query(since=200.0)], [200.0, 300.0])
+        self.assertEqual([row[0] for row in store.query(until=200.0)], [100.0])
+        self.assertEqual([row[0] for row in store.query(mac="aa", since=150.0, until=400.0)], [300.0])
+        self.assertEqual(store.query(tag="v2"), [])
+        store.close()
+
+    def test_final_verdicts(self):
+        store = VerdictStore(self.filename, "v1")
+        store.record(100.0, "aa", "4-way handshake", "patched")
+        store.record(200.0, "aa", "4-way handshake", "vulnerable")
+        store.record(300.0, "aa", "group key handshake", "patched")
+        store.close()
+        # Only the verdicts recorded with the same tag are used
+        self.assertEqual(VerdictStore(self.filename, "v1").final_verdicts("aa"),
+            {"4-way handshake": "vulnerable", "group key handshake": "patched"})
+        self.assertEqual(VerdictStore(self.filename, "v2").final_verdicts("aa"), {})
+        self.assertEqual(VerdictStore(self.filename, "v1").final_verdicts("bb"), {})
+
+    def test_batched_commits(self):
+        store = VerdictStore(self.filename, commit_interval=3600)
+        reader = VerdictStore(self.filename)
+        store.record(100.0, "aa", "4-way handshake", "patched")
+        self.assertEqual(reader.query(), [])
+        store.commit(store.commit_interval)
+        self.assertEqual(reader.query(), [])
+        store.commit()
+        self.assertEqual(len(reader.query()), 1)
+        # Closing commits the pending records
+        store.record(200.0, "aa", "4-way handshake", "vulnerable")
+        store.close()
+        self.assertEqual(len(reader.query()), 2)
+
+class TestSkipKnown(unittest.TestCase):
+    def setUp(self):
+        self.log_level = libwifi.global_log_level
+        libwifi.global_log_level = ERROR
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = VerdictStore(os.path.join(self.tmpdir, "verdicts.db"), "v1")
+
+    def tearDown(self):
+        self.store.close()
+        libwifi.global_log_level = self.log_level
+        shutil.rmtree(self.tmpdir)
+
+    def detector(self):
+        attack = DetectKRACK("test0", APMAC, store=self.store, skip_known=True)
+        attack.hostapd_ctrl = FakeCtrl()
+        return attack
+
+    def test_restore_verdicts(self):
+        client = ClientState(CLIENTMAC)
+        client.restore_verdicts({"4-way handshake": "patched", "unknown test": "patched", "group key handshake": "bogus"})
+        self.assertEqual(client.verdicts, [ClientState.PATCHED] + [ClientState.UNKNOWN] * 3)
+        self.assertEqual(client.state, ClientState.IDLE)
+        client.restore_verdicts(dict((name, "vulnerable") for name in ClientState.TEST_NAMES))
+        self.assertEqual(client.state, ClientState.FINISHED)
+
+    def test_verdicts_are_recorded(self):
+        attack = self.detector()
+        client = attack.get_client(CLIENTMAC)
+        client.set_verdict(ClientState.VULNERABLE, (100.0, 1, 20), "IV reuse")
+        self.assertEqual(self.store.query(mac=CLIENTMAC)[0][3:], ("4-way handshake", "vulnerable", 1, 20, 0, "IV reuse"))
+
+    def test_known_client_is_not_tested(self):
+        for name in ClientState.TEST_NAMES:
+            self.store.record(100.0, CLIENTMAC, name, "patched")
+        attack = self.detector()
+        client = attack.get_client(CLIENTMAC)
+        self.assertEqual(client.state, ClientState.FINISHED)
+        self.assertEqual(attack.hostapd_ctrl.commands, ["STOP_TESTS " + CLIENTMAC])
+        self.assertEqual(client.timers, {})
+        # Handshake messages to the client don't start eliciting data frames
+        attack.sock_eth = object()
+        attack.handle_poc_event([CLIENTMAC, "type=msg3", "replay=3", "keyidx=0", "ts=1000.0"])
+        self.assertEqual(client.timers, {})
+
+    def test_known_tests_are_skipped(self):
+        self.store.record(100.0, CLIENTMAC, "4-way handshake", "vulnerable")
+        self.store.record(100.0, CLIENTMAC, "TPTK construction", "patched")
+        attack = self.detector()
+        client = attack.get_client(CLIENTMAC)
+        # The 4-way handshake test already has a verdict, so the group key test is started
+        self.assertEqual(client.test, ClientState.TEST_GROUP)
+        self.assertEqual(client.state, ClientState.STARTED)
+        self.assertIn("START_GROUP_TESTS " + CLIENTMAC, attack.hostapd_ctrl.commands)
+
+        # The TPTK test is skipped, and the client reconnects for the one with a random ANonce
+        client.set_verdict(ClientState.PATCHED)
+        attack.finish_test(client)
+        self.assertEqual(client.test, ClientState.TEST_TPTK_RAND)
+        self.assertEqual(client.state, ClientState.IDLE)
+        self.assertEqual(attack.hostapd_ctrl.commands[-1], "DEAUTHENTICATE " + CLIENTMAC)
+
+        del attack.hostapd_ctrl.commands[:]
+        attack.handle_hostapd_event("<3>AP-STA-CONNECTED " + CLIENTMAC)
+        self.assertIn("TEST_TPTK_RAND " + CLIENTMAC, attack.hostapd_ctrl.commands)
+        client.set_verdict(ClientState.VULNERABLE)
+        attack.finish_test(client)
+        self.assertEqual(client.state, ClientState.FINISHED)
+        self.assertEqual(attack.hostapd_ctrl.commands[-1], "STOP_TESTS " + CLIENTMAC)
+        self.assertEqual(client.verdicts, [ClientState.VULNERABLE, ClientState.PATCHED, ClientState.PATCHED,
+            ClientState.VULNERABLE])
+
+class TestSyncKeys(unittest.TestCase):
+    def test_sync_encryption_keys(self):
+        tk = "\x11" * 16
+        attack = DetectKRACK("test0", APMAC)
+        attack.hostapd_ctrl = FakeCtrl({
+            "GET_TK_ALL 0": "\n%s cipher=CCMP gen=1 tk=%s\n\nMORE 1\n" % (CLIENTMAC, tk.encode("hex")),
+            "GET_TK_ALL 1": "02:00:00:00:00:bb cipher=TKIP gen=1 tk=%s\n" % tk.encode("hex")})
+        attack.sync_encryption_keys()
+        self.assertEqual([cmd for cmd in attack.hostapd_ctrl.commands if cmd.startswith("GET_TK_ALL")],
+            ["GET_TK_ALL 0", "GET_TK_ALL 1"])
+        self.assertEqual(attack.clients[CLIENTMAC].crypto.key, tk)
+        self.assertNotIn("02:00:00:00:00:bb", attack.clients)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import os, shutil, socket, tempfile, threading, time, unittest
+from wpaspy import Ctrl
+
+class FakeDaemon(threading.Thread):
+    """Control interface that replies to every request, optionally after sending events"""
+    def __init__(self, path, events=[]):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.events = list(events)
+        self.delay = 0
+
+    def run(self):
+        while True:
+            cmd, addr = self.sock.recvfrom(4096)
+            if cmd == "QUIT": break
+            time.sleep(self.delay)
+            for event in self.events:
+                self.sock.sendto(event, addr)
+            self.sock.sendto("reply-" + cmd, addr)
+
+class TestCtrl(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "wlan0")
+
+    def tearDown(self):
+        self.ctrl.send("QUIT")
+        self.daemon.join()
+        self.daemon.sock.close()
+        self.ctrl.close()
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, events=[]):
+        self.daemon = FakeDaemon(self.path, events)
+        self.daemon.start()
+        self.ctrl = Ctrl(self.path)
+
+    def test_request(self):
+        self.start()
+        self.assertEqual(self.ctrl.request("PING"), "reply-PING")
+
+    def test_async_replies_in_order(self):
+        self.start(["<3>EVENT"])
+        replies = []
+        self.ctrl.request_async("GET_TK a", lambda reply: replies.append(("a", reply)))
+        self.ctrl.request_async("GET_TK b", lambda reply: replies.append(("b", reply)))
+        # The synchronous request only returns after the earlier replies were dispatched
+        self.assertEqual(self.ctrl.request("PING"), "reply-PING")
+        self.assertEqual(replies, [("a", "reply-GET_TK a"), ("b", "reply-GET_TK b")])
+        # Events are queued for recv when there are no subscribers
+        self.assertEqual([self.ctrl.recv() for i in range(3)], ["<3>EVENT"] * 3)
+        self.assertFalse(self.ctrl.pending())
+
+    def test_subscribers_called_after_request(self):
+        self.start(["<3>AP-STA-CONNECTED", "<3>AP-STA-DISCONNECTED"])
+        calls = []
+        self.ctrl.subscribe(calls.append)
+        calls.append(self.ctrl.request("PING"))
+        # Without a scheduler, the events are dispatched right before request returns
+        self.assertEqual(calls, ["<3>AP-STA-CONNECTED", "<3>AP-STA-DISCONNECTED", "reply-PING"])
+        self.assertFalse(self.ctrl.pending())
+
+    def test_subscribers_scheduled(self):
+        self.start(["<3>AP-STA-CONNECTED"])
+        calls, scheduled = [], []
+        self.ctrl.subscribe(calls.append, scheduled.append)
+        calls.append(self.ctrl.request("PING"))
+        calls.append(self.ctrl.request("PING"))
+        self.assertEqual(calls, ["reply-PING", "reply-PING"])
+        # A single dispatch is scheduled for all events
+        self.assertEqual(len(scheduled), 1)
+        scheduled.pop()()
+        self.assertEqual(calls[2:], ["<3>AP-STA-CONNECTED"] * 2)
+
+    def test_request_from_subscriber(self):
+        self.start(["<3>EVENT"])
+        calls, scheduled = [], []
+        def handle_event(event):
+            calls.append(event)
+            if len(calls) == 1:
+                calls.append(self.ctrl.request("STATUS"))
+        self.ctrl.subscribe(handle_event, scheduled.append)
+        self.ctrl.request("PING")
+        while scheduled:
+            scheduled.pop(0)()
+        self.assertEqual(calls, ["<3>EVENT", "reply-STATUS", "<3>EVENT"])
+
+    def test_timeout(self):
+        self.start()
+        # The late reply to the request that timed out must not be returned for the next one
+        self.daemon.delay = 0.3
+        self.assertRaises(Exception, self.ctrl.request, "PING", timeout=0.1)
+        self.daemon.delay = 0
+        self.assertEqual(self.ctrl.request("STATUS"), "reply-STATUS")
+
+if __name__ == "__main__":
+    unittest.main()
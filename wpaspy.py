@@ -10,6 +10,8 @@ import os
 import stat
 import socket
 import select
+import time
+from collections import deque
 
 counter = 0
 
@@ -20,6 +22,20 @@ class Ctrl:
         self.attached = False
         self.path = path
         self.port = port
+        # Datagrams are never split, so this must be larger than the largest reply
+        self.bufsize = 65536
+        # Callbacks of requests that are waiting on a reply, in the order they were sent
+        self.outstanding = deque()
+        # Unsolicited event messages, unless they are handled by subscribers
+        self.events = deque()
+        self.subscribers = []
+        # Number of synchronous requests waiting on their reply, and the events that arrived
+        # meanwhile. Subscribers are only called once the requests returned to their caller.
+        self.waiting = 0
+        self.deferred = deque()
+        # Runs a function once control is back in the event loop, see subscribe
+        self.schedule = None
+        self.dispatch_scheduled = False
 
         try:
             mode = os.stat(path).st_mode
@@ -80,15 +96,82 @@ class Ctrl:
                 os.unlink(self.local)
             self.started = False
 
-    def request(self, cmd, timeout=10):
+    def fileno(self):
+        return self.s.fileno()
+
+    def send(self, cmd):
         if self.udp:
             self.s.sendto(self.cookie + cmd, self.sockaddr)
         else:
             self.s.send(cmd)
-        [r, w, e] = select.select([self.s], [], [], timeout)
-        if r:
-            return self.s.recv(4096)
-        raise Exception("Timeout on waiting response")
+
+    def request_async(self, cmd, callback):
+        """Send a request without waiting for its reply. The daemon handles requests in order,
+        so replies are matched to requests in the order they were sent. The callback is called
+        with the reply from handle_read."""
+        self.send(cmd)
+        self.outstanding.append(callback)
+
+    def request(self, cmd, timeout=10):
+        reply = []
+        self.request_async(cmd, reply.append)
+        deadline = time.time() + timeout
+        self.waiting += 1
+        try:
+            while not reply:
+                [r, w, e] = select.select([self.s], [], [], max(0, deadline - time.time()))
+                if not r:
+                    # A late reply must still be matched to this request, so just ignore it
+                    for i, callback in enumerate(self.outstanding):
+                        if callback == reply.append:
+                            self.outstanding[i] = lambda reply: None
+                            break
+                    raise Exception("Timeout on waiting response")
+                self.handle_read()
+        finally:
+            self.waiting -= 1
+        if self.deferred and not self.waiting:
+            if self.schedule is None:
+                self._dispatch_deferred()
+            elif not self.dispatch_scheduled:
+                self.dispatch_scheduled = True
+                self.schedule(self._dispatch_deferred)
+        return reply[0]
+
+    def subscribe(self, callback, schedule=None):
+        """Call the callback for every unsolicited event, instead of queueing them for recv. Events
+        that arrive while request waits on its reply are dispatched after it returned: by calling
+        schedule with a function that dispatches them, which it should call from the event loop, or
+        else right before request returns."""
+        self.subscribers.append(callback)
+        if schedule is not None:
+            self.schedule = schedule
+
+    def handle_read(self):
+        """Read and dispatch all received replies and events without blocking"""
+        while select.select([self.s], [], [], 0)[0]:
+            self._dispatch(self.s.recv(self.bufsize))
+        self._dispatch_deferred()
+
+    def _dispatch(self, msg):
+        # Unsolicited events start with their level, e.g. "<3>AP-STA-CONNECTED"
+        if msg.startswith("<") or not self.outstanding:
+            if self.subscribers:
+                self.deferred.append(msg)
+            else:
+                self.events.append(msg)
+        else:
+            self.outstanding.popleft()(msg)
+
+    def _dispatch_deferred(self):
+        # Don't run subscribers in the middle of a synchronous request of their caller
+        if self.waiting:
+            return
+        self.dispatch_scheduled = False
+        while self.deferred and not self.waiting:
+            msg = self.deferred.popleft()
+            for callback in self.subscribers:
+                callback(msg)
 
     def attach(self):
         if self.attached:
@@ -121,11 +204,15 @@ class Ctrl:
         self.close()
 
     def pending(self, timeout=0):
+        if self.events:
+            return True
         [r, w, e] = select.select([self.s], [], [], timeout)
         if r:
-            return True
-        return False
+            self.handle_read()
+        return len(self.events) > 0
 
     def recv(self):
-        res = self.s.recv(4096)
-        return res
+        while not self.events:
+            select.select([self.s], [], [])
+            self.handle_read()
+        return self.events.popleft()